@@ -22,7 +22,11 @@ def clamp_score(val):
     return max(1, min(5, val))
 
 def load_vectors(dataset_path: Path, source: Literal["embedding", "umap"]):
-    if source == "embedding":
+    if source == "embedding" and (dataset_path / "embeddings.npy").exists():
+        # float32の行列をメモリマップで読み込む（embedding_ids.csvに行ごとのarg-idがある）
+        vectors = np.load(dataset_path / "embeddings.npy", mmap_mode="r")
+        arg_ids = pd.read_csv(dataset_path / "embedding_ids.csv", dtype=str)["arg-id"].tolist()
+    elif source == "embedding":
         df = pd.read_pickle(dataset_path / "embeddings.pkl")
         vectors = np.vstack(df["embedding"].values)
         arg_ids = df["arg-id"].tolist()
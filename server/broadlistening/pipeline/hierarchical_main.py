@@ -38,6 +38,11 @@ def parse_arguments():
         action="store_true",
         help="Skip the html output.",
     )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add new comments to a completed report without re-running the whole pipeline.",
+    )
     return parser.parse_args()
 
 
@@ -54,6 +59,8 @@ def main():
         new_argv.append("-skip-interaction")
     if args.without_html:
         new_argv.append("--without-html")
+    if args.append:
+        new_argv.append("--append")
 
     config = initialization(new_argv)
 
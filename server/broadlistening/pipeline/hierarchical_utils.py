@@ -3,6 +3,22 @@ import os
 import traceback
 from datetime import datetime, timedelta
 
+from services.adaptive_concurrency import AUTO_WORKERS, DEFAULT_MAX_CONCURRENCY
+from services.batch_runner import configure_batch
+from services.checkpoint_journal import extraction_journal
+from services.hedging import configure_hedging, get_hedging_stats
+from services.llm import (
+    configure_embedding_cache,
+    configure_llm_cache,
+    configure_local_embedding,
+    get_embedding_cache_stats,
+    get_llm_cache_stats,
+    supports_embedding_dimensions,
+)
+from services.llm_clients import configure_llm_clients, get_llm_client_stats
+from services.rate_limiter import configure_rate_limits, get_rate_limiter_stats
+from services.umap_cache import UMAP_MODEL_FILENAME
+
 with open("./hierarchical_specs.json") as f:
     specs = json.load(f)
 
@@ -22,6 +38,12 @@ def validate_config(config):
         "is_embedded_at_local",
         "provider",
         "local_llm_address",
+        "llm_cache",
+        "embedding_cache",
+        "local_embedding",
+        "rate_limits",
+        "hedging",
+        "batch",
     ]
     step_names = [x["step"] for x in specs]
     for key in config:
@@ -71,6 +93,8 @@ def decide_what_to_run(config, previous):
         if stepname == "hierarchical_visualization" and config.get("without-html", False):
             reason = "skipping html output"
             run = False
+        elif config.get("append", False):
+            reason = "appending new comments with --append"
         elif config.get("force", False):
             reason = "forced with -f"
         elif config.get("only", None) is not None and config["only"] != stepname:
@@ -95,10 +119,65 @@ def decide_what_to_run(config, previous):
                 else:
                     run = False
                     reason = "nothing changed"
-        plan.append({"step": stepname, "run": run, "reason": reason})
+        entry = {"step": stepname, "run": run, "reason": reason}
+        if run and can_resume_from_journal(config, step):
+            entry["resume"] = True
+            entry["reason"] = f"{reason} (resuming from journal)"
+        plan.append(entry)
     return plan
 
 
+def can_resume_from_journal(config, step):
+    # steps that keep a journal can skip work recorded by an interrupted or previous run.
+    # the step itself discards the journal if it was written with different settings.
+    if "journal" not in step:
+        return False
+    if config.get("force", False) or config.get("only") == step["step"]:
+        return False
+    return os.path.exists(f"outputs/{config['output_dir']}/{step['journal']}")
+
+
+def validate_append(config, previous):
+    # --append only adds new comments to the clusters of a completed run, so everything
+    # that decides the embedding space and the clusters has to be the same as before.
+    if config.get("force", False) or config.get("only") is not None:
+        raise Exception("--append cannot be combined with -f or -o")
+    if not previous or previous.get("status") != "completed":
+        raise Exception("--append requires a previously completed run of this report")
+    output_dir = config["output_dir"]
+    for filename in ["hierarchical_clusters.csv", "hierarchical_merge_labels.csv"]:
+        if not os.path.exists(f"outputs/{output_dir}/{filename}"):
+            raise Exception(f"--append requires outputs/{output_dir}/{filename} from a previous run")
+    # new comments are found by skipping those recorded in the extraction journal. without a journal
+    # written with the current settings, every comment would be extracted again with paid LLM calls.
+    extraction_spec = next(step for step in specs if step["step"] == "extraction")
+    journal = extraction_journal(config)
+    if not can_resume_from_journal(config, extraction_spec) or not journal.is_resumable():
+        raise Exception(
+            f"--append requires {journal.path} written with the current extraction provider, model, prompt "
+            "and pack_comments. Otherwise every comment would be extracted again."
+        )
+    # the fitted UMAP is large, so hierarchical_clustering only saves it when enable_append is set
+    if not config["hierarchical_clustering"].get("enable_append", False):
+        raise Exception("--append requires hierarchical_clustering.enable_append to be true")
+    if not os.path.exists(f"outputs/{output_dir}/{UMAP_MODEL_FILENAME}"):
+        raise Exception(
+            f"--append requires outputs/{output_dir}/{UMAP_MODEL_FILENAME}, which hierarchical_clustering saves "
+            "only with enable_append set to true. Set it and run once without --append first."
+        )
+    previous_jobs = previous.get("completed_jobs", []) + previous.get("previously_completed_jobs", [])
+    for step, keys in [("embedding", ["model", "dimensions"]), ("hierarchical_clustering", ["cluster_nums"])]:
+        prev = next((job["params"] for job in previous_jobs if job["step"] == step), {})
+        for key in keys:
+            if prev.get(key) != config[step].get(key):
+                raise Exception(f"--append requires the same {step}.{key} as the previous run")
+    dimensions = config["embedding"].get("dimensions")
+    if dimensions and not supports_embedding_dimensions(
+        config["embedding"]["model"], config.get("is_embedded_at_local", False), config.get("provider", "openai")
+    ):
+        raise Exception("--append is not supported when embedding.dimensions is applied with PCA")
+
+
 def initialization(sysargv):
     job_file = sysargv[1]
     job_name = os.path.basename(job_file).split(".")[0]
@@ -118,6 +197,8 @@ def initialization(sysargv):
             config["skip-interaction"] = True
         if option == "--without-html":
             config["without-html"] = True
+        if option == "--append":
+            config["append"] = True
 
     output_dir = config["output_dir"]
 
@@ -168,6 +249,9 @@ def initialization(sysargv):
                 if "model" in config:
                     config[step]["model"] = config["model"]
 
+    if config.get("append", False):
+        validate_append(config, previous)
+
     # create output directory if needed
     if not os.path.exists(f"outputs/{output_dir}"):
         os.makedirs(f"outputs/{output_dir}")
@@ -181,6 +265,21 @@ def initialization(sysargv):
         print("Looks good? Press enter to continue or Ctrl+C to abort.")
         input()
 
+    # share identical LLM responses across re-runs (see services/llm_cache.py)
+    configure_llm_cache(config.get("llm_cache"))
+    # share embeddings of identical texts across reports (see services/embedding_cache.py)
+    configure_embedding_cache(config.get("embedding_cache"))
+    # batch size, processes, ONNX backend or a resident server for is_embedded_at_local
+    configure_local_embedding(config.get("local_embedding"))
+    # RPM/TPM budgets shared by every LLM call in this process (see services/rate_limiter.py)
+    configure_rate_limits(config.get("rate_limits"))
+    # duplicate slow LLM requests and fail over to other providers (see services/hedging.py)
+    configure_hedging(config.get("hedging"))
+    # polling interval and endpoint for execution_mode "batch" (see services/batch_runner.py)
+    configure_batch(config.get("batch"))
+    # keep-alive connection pools sized to the largest number of concurrent LLM requests
+    configure_llm_clients(max_llm_concurrency(config))
+
     # ready to start!
     update_status(
         config,
@@ -195,6 +294,15 @@ def initialization(sysargv):
     return config
 
 
+def max_llm_concurrency(config):
+    concurrency = [
+        DEFAULT_MAX_CONCURRENCY if config[step]["workers"] == AUTO_WORKERS else config[step]["workers"]
+        for step in (step_spec["step"] for step_spec in specs)
+        if "workers" in config.get(step, {})
+    ]
+    return max(concurrency, default=None)
+
+
 # (!) make sure to always use this function to update status...
 def update_status(config, updates):
     output_dir = config["output_dir"]
@@ -235,6 +343,19 @@ def run_step(step, func, config):
     func(config)
     token_usage_after = config.get("total_token_usage", token_usage_before)
     token_usage_step = token_usage_after - token_usage_before
+    llm_cache_stats = get_llm_cache_stats()
+    if llm_cache_stats is not None:
+        update_status(config, {"llm_cache_stats": llm_cache_stats})
+    embedding_cache_stats = get_embedding_cache_stats()
+    if embedding_cache_stats is not None:
+        update_status(config, {"embedding_cache_stats": embedding_cache_stats})
+    rate_limiter_stats = get_rate_limiter_stats()
+    if rate_limiter_stats is not None:
+        update_status(config, {"rate_limiter_stats": rate_limiter_stats})
+    hedging_stats = get_hedging_stats()
+    if hedging_stats is not None:
+        update_status(config, {"hedging_stats": hedging_stats})
+    update_status(config, {"llm_client_stats": get_llm_client_stats()})
     # update status after running...
     update_status(
         config,
@@ -0,0 +1,266 @@
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterator
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+
+import openai
+
+AUTO_WORKERS = "auto"
+DEFAULT_INITIAL_CONCURRENCY = 2
+DEFAULT_MAX_CONCURRENCY = 32
+# 直近のレイテンシの移動平均が、観測した中で最良の値のこの倍数を超えたら混雑とみなす
+DEFAULT_LATENCY_TOLERANCE = 3.0
+DECREASE_FACTOR = 0.5
+LATENCY_EWMA_ALPHA = 0.2
+
+_current_controller: contextvars.ContextVar["AdaptiveConcurrencyController | None"] = contextvars.ContextVar(
+    "current_concurrency_controller", default=None
+)
+
+
+def is_throttling_error(error: BaseException) -> bool:
+    """レート制限(429)・タイムアウトなど、同時実行数を減らすべきエラーかどうか"""
+    return isinstance(error, openai.RateLimitError | openai.APITimeoutError | TimeoutError)
+
+
+class AdaptiveConcurrencyController:
+    """AIMD(加算増加・乗算減少)で同時実行数を調整する
+
+    レイテンシとエラーが健全な間は、同時実行数分のリクエストが成功するごとに同時実行数を1増やす。
+    429・タイムアウトが起きた場合やレイテンシが悪化した場合は、同時実行数を半分に減らす。
+    同じ混雑に対して連続で減らしすぎないよう、減らした後の1リクエスト分の時間は再度減らさない。
+    """
+
+    def __init__(
+        self,
+        initial: int = DEFAULT_INITIAL_CONCURRENCY,
+        min_limit: int = 1,
+        max_limit: int = DEFAULT_MAX_CONCURRENCY,
+        latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self._limit = min(max(initial, min_limit), max_limit)
+        self._latency_ewma: float | None = None
+        self._best_latency: float | None = None
+        self._last_decrease_at = float("-inf")
+        self._healthy_in_window = 0
+        self._lock = threading.Lock()
+        self.initial_limit = self._limit
+        self.peak_limit = self._limit
+        self.successes = 0
+        self.errors = 0
+        self.throttled = 0
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def limit(self) -> int:
+        """現在の同時実行数の上限"""
+        with self._lock:
+            return self._limit
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            self.successes += 1
+            if self._latency_ewma is None:
+                self._latency_ewma = latency
+            else:
+                self._latency_ewma = LATENCY_EWMA_ALPHA * latency + (1 - LATENCY_EWMA_ALPHA) * self._latency_ewma
+            if self._best_latency is None or self._latency_ewma < self._best_latency:
+                self._best_latency = self._latency_ewma
+
+            if self._latency_ewma > self._best_latency * self.latency_tolerance:
+                self._decrease()
+            elif self._limit < self.max_limit:
+                # 現在の同時実行数分のリクエストが続けて健全に完了したら1増やす
+                self._healthy_in_window += 1
+                if self._healthy_in_window >= self._limit:
+                    self._healthy_in_window = 0
+                    self._limit += 1
+                    self.increases += 1
+                    self.peak_limit = max(self.peak_limit, self._limit)
+
+    def record_error(self, error: BaseException) -> None:
+        with self._lock:
+            self.errors += 1
+            if is_throttling_error(error):
+                self.throttled += 1
+                self._decrease()
+
+    def _decrease(self) -> None:
+        now = time.monotonic()
+        if now - self._last_decrease_at < (self._latency_ewma or 0):
+            return
+        self._last_decrease_at = now
+        self._healthy_in_window = 0
+        decreased = max(self.min_limit, int(self._limit * DECREASE_FACTOR))
+        if decreased < self._limit:
+            self.decreases += 1
+        self._limit = decreased
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "initial": self.initial_limit,
+                "final": self._limit,
+                "peak": self.peak_limit,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "successes": self.successes,
+                "errors": self.errors,
+                "throttled": self.throttled,
+            }
+
+
+def create_concurrency_controller(workers: int | str) -> AdaptiveConcurrencyController | None:
+    """configのworkersが"auto"の場合はAIMDで同時実行数を調整するコントローラーを返す。整数の場合はNone"""
+    if workers == AUTO_WORKERS:
+        return AdaptiveConcurrencyController()
+    if isinstance(workers, str):
+        raise ValueError(f'workers must be an integer or "{AUTO_WORKERS}", got: {workers}')
+    return None
+
+
+def record_adaptive_concurrency(config: dict, step: str, controller: AdaptiveConcurrencyController) -> None:
+    """調整した同時実行数をconfigに記録する。ステップ終了時にhierarchical_status.jsonへ書き出される"""
+    stats = controller.stats()
+    config.setdefault("adaptive_concurrency", {})[step] = stats
+    print(f"Adaptive concurrency ({step}): initial={stats['initial']}, final={stats['final']}, peak={stats['peak']}")
+
+
+def report_request_outcome(latency: float, error: BaseException | None = None) -> None:
+    """LLMリクエストの結果を、実行中のタスクを管理しているコントローラーに通知する
+
+    run_in_sliding_window などから実行されたタスク内でのみ有効で、それ以外から呼ばれた場合は何もしない。
+    """
+    controller = _current_controller.get()
+    if controller is None:
+        return
+    if error is None:
+        controller.record_success(latency)
+    else:
+        controller.record_error(error)
+
+
+def bind_concurrency_controller(controller: AdaptiveConcurrencyController | None) -> None:
+    """現在のスレッド・非同期タスク内のLLMリクエストの結果を通知するコントローラーを設定する"""
+    _current_controller.set(controller)
+
+
+class RequestTimeoutError(TimeoutError):
+    """タスクが期限内に完了せず、再投入の上限にも達した場合に、そのタスクのFutureに設定される例外"""
+
+
+@dataclass
+class TaskRunStats:
+    """run_in_sliding_window などでの期限切れ・再投入の件数"""
+
+    timed_out_attempts: int = 0
+    requeued: int = 0
+
+
+def _run_task(controller: AdaptiveConcurrencyController | None, task: Callable[[], object]) -> object:
+    bind_concurrency_controller(controller)
+    return task()
+
+
+def _timed_out_future(timeout: float) -> Future:
+    future: Future = Future()
+    future.set_exception(RequestTimeoutError(f"task did not finish within {timeout} seconds"))
+    return future
+
+
+def run_in_sliding_window(
+    tasks: list[Callable[[], object]],
+    workers: int | AdaptiveConcurrencyController,
+    timeout: float | None = None,
+    timeout_retries: int = 0,
+    stats: TaskRunStats | None = None,
+) -> Iterator[tuple[int, Future]]:
+    """常に同時実行数分のタスクを並行実行し、完了したFutureを入力順に返すジェネレータ
+
+    バッチ単位で全タスクの完了を待つと、最も遅いタスクに他のワーカーが引きずられる。
+    そのため、タスクが1件完了するたびに次のタスクを投入し、同時実行数を保つ。
+    workersにコントローラーを渡した場合は、タスク内のLLMリクエストの結果に応じて同時実行数を調整する。
+
+    timeoutを指定した場合、期限を過ぎたタスクは応答を待たずに見捨て、timeout_retries回まで再投入する。
+    再投入の上限に達したタスクのFutureにはRequestTimeoutErrorを設定する。
+    実行中のスレッドは外から止められないため、見捨てたタスクはスレッドを占有したまま動き続ける。
+    見捨てたタスクは同時実行数に含めず完了も待たないため、応答しないリクエストがあっても他のタスクは止まらない。
+    スレッドプールは同時実行数の上限の2倍の大きさで、半分を見捨てたタスクのために空けておく。
+    見捨てたタスクがそれを超えて溜まった場合だけ、スレッドが空くまで同時実行数を減らす。
+
+    Args:
+        tasks: 引数なしで呼び出せるタスクのリスト
+        workers: 同時実行数、またはAdaptiveConcurrencyController
+        timeout: 1タスクあたりの期限(秒)。Noneの場合は期限なし
+        timeout_retries: 期限切れのタスクを再投入する回数
+        stats: 期限切れ・再投入の件数を記録するオブジェクト
+
+    Yields:
+        (タスクのインデックス, 完了したFuture) のタプル。タスクの例外はFuture.result()で送出される
+    """
+    controller = workers if isinstance(workers, AdaptiveConcurrencyController) else None
+    stats = stats if stats is not None else TaskRunStats()
+    pending: deque[tuple[int, int]] = deque((index, 0) for index in range(len(tasks)))
+    # Future -> (タスクのインデックス, 再投入した回数, 期限)
+    in_flight: dict[Future, tuple[int, int, float]] = {}
+    # 期限切れで見捨てたが、まだスレッドで実行中のタスク
+    abandoned: set[Future] = set()
+    completed: dict[int, Future] = {}
+    next_yield = 0
+    max_limit = controller.max_limit if controller is not None else max(1, workers)
+    # 同時実行数の上限分に加えて、見捨てたタスクが占有するスレッドを同じ数まで確保する
+    max_threads = max_limit * 2
+    executor = ThreadPoolExecutor(max_workers=max_threads)
+
+    try:
+        while next_yield < len(tasks):
+            abandoned = {future for future in abandoned if not future.done()}
+            limit = controller.limit if controller is not None else max(1, workers)
+            # 見捨てたタスクが確保したスレッドを超えて溜まった場合は、プールの空きに合わせて同時実行数を減らす
+            limit = min(limit, max_threads - len(abandoned))
+            while pending and len(in_flight) < limit:
+                index, attempt = pending.popleft()
+                deadline = time.monotonic() + timeout if timeout is not None else float("inf")
+                in_flight[executor.submit(_run_task, controller, tasks[index])] = (index, attempt, deadline)
+
+            wait_seconds = None
+            if timeout is not None and in_flight:
+                wait_seconds = max(0.0, min(deadline for _, _, deadline in in_flight.values()) - time.monotonic())
+            # 見捨てたタスクの完了は、プールのスレッドがすべて埋まり投入できない場合だけ待つ
+            done, _ = wait(in_flight or abandoned, timeout=wait_seconds, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in in_flight:
+                    completed[in_flight.pop(future)[0]] = future
+
+            now = time.monotonic()
+            for future, (index, attempt, deadline) in list(in_flight.items()):
+                if now < deadline:
+                    continue
+                # 実行中のスレッドは止められないため、結果を待たずに見捨てる
+                del in_flight[future]
+                abandoned.add(future)
+                stats.timed_out_attempts += 1
+                if controller is not None:
+                    controller.record_error(RequestTimeoutError())
+                if attempt < timeout_retries:
+                    logging.warning(f"Task {index} timed out after {timeout} seconds, requeueing")
+                    stats.requeued += 1
+                    pending.appendleft((index, attempt + 1))
+                else:
+                    logging.error(f"Task {index} timed out after {timeout} seconds, giving up")
+                    completed[index] = _timed_out_future(timeout)
+
+            while next_yield in completed:
+                yield next_yield, completed.pop(next_yield)
+                next_yield += 1
+    finally:
+        # 見捨てたタスクの完了は待たない。未実行のタスクは取り消す
+        executor.shutdown(wait=False, cancel_futures=True)
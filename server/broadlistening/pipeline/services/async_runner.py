@@ -0,0 +1,119 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from collections.abc import Awaitable, Callable, Iterator
+
+from .adaptive_concurrency import (
+    AdaptiveConcurrencyController,
+    RequestTimeoutError,
+    TaskRunStats,
+    bind_concurrency_controller,
+)
+
+_loop: asyncio.AbstractEventLoop | None = None
+_loop_lock = threading.Lock()
+
+
+def get_pipeline_event_loop() -> asyncio.AbstractEventLoop:
+    """パイプライン全体で共有するイベントループを返す
+
+    非同期クライアントのコネクションはイベントループに紐づくため、ステップごとにループを作り直さず、
+    バックグラウンドのスレッドで1つのループを動かし続ける。
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="pipeline-event-loop", daemon=True).start()
+        return _loop
+
+
+def run_coroutine(coroutine: Awaitable) -> object:
+    """コルーチンをパイプラインのイベントループで実行し、完了まで待って結果を返す"""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_pipeline_event_loop()).result()
+
+
+class _ConcurrencyGate:
+    """同時実行数を制限するセマフォ。AdaptiveConcurrencyControllerを渡した場合は上限が動的に変わる"""
+
+    def __init__(self, workers: int | AdaptiveConcurrencyController):
+        self._workers = workers
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+
+    def _limit(self) -> int:
+        if isinstance(self._workers, AdaptiveConcurrencyController):
+            return self._workers.limit
+        return max(1, self._workers)
+
+    async def __aenter__(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self._limit())
+            self._in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+
+def run_async_in_order(
+    tasks: list[Callable[[], Awaitable]],
+    workers: int | AdaptiveConcurrencyController,
+    timeout: float | None = None,
+    timeout_retries: int = 0,
+    stats: TaskRunStats | None = None,
+) -> Iterator[tuple[int, concurrent.futures.Future]]:
+    """非同期タスクをパイプラインのイベントループで同時実行数を制限しながら実行し、完了したFutureを入力順に返す
+
+    run_in_sliding_window の非同期版で、スレッドを使わないため数千件のリクエストを同時に待てる。
+    全タスクをまとめて投入し、同時実行数はセマフォで制限する。
+    期限を過ぎたタスクはキャンセルして、timeout_retries回まで実行し直す。
+
+    Args:
+        tasks: 引数なしで呼び出すとコルーチンを返す関数のリスト
+        workers: 同時実行数、またはAdaptiveConcurrencyController
+        timeout: 1タスクあたりの期限(秒)。Noneの場合は期限なし
+        timeout_retries: 期限切れのタスクを実行し直す回数
+        stats: 期限切れ・再実行の件数を記録するオブジェクト
+
+    Yields:
+        (タスクのインデックス, 完了したFuture) のタプル。タスクの例外はFuture.result()で送出される
+    """
+    loop = get_pipeline_event_loop()
+    controller = workers if isinstance(workers, AdaptiveConcurrencyController) else None
+    gate = _ConcurrencyGate(workers)
+    stats = stats if stats is not None else TaskRunStats()
+
+    async def run_one(index: int, task: Callable[[], Awaitable]):
+        # タスクごとにコンテキストが分かれるため、ここで設定したコントローラーはこのタスクからのみ参照される
+        bind_concurrency_controller(controller)
+        for attempt in range(timeout_retries + 1):
+            async with gate:
+                deadline = asyncio.timeout(timeout)
+                try:
+                    async with deadline:
+                        return await task()
+                except TimeoutError:
+                    # 期限切れのみを扱い、タスク内部で起きたTimeoutErrorはそのまま送出する
+                    if not deadline.expired():
+                        raise
+            stats.timed_out_attempts += 1
+            if controller is not None:
+                controller.record_error(RequestTimeoutError())
+            if attempt < timeout_retries:
+                logging.warning(f"Task {index} timed out after {timeout} seconds, retrying")
+                stats.requeued += 1
+        logging.error(f"Task {index} timed out after {timeout} seconds, giving up")
+        raise RequestTimeoutError(f"task did not finish within {timeout} seconds")
+
+    futures = [asyncio.run_coroutine_threadsafe(run_one(i, task), loop) for i, task in enumerate(tasks)]
+    try:
+        for index, future in enumerate(futures):
+            concurrent.futures.wait([future])
+            yield index, future
+    finally:
+        # 途中で中断された場合は、残りのタスクを取り消す
+        for future in futures:
+            future.cancel()
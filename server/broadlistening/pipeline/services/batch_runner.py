@@ -0,0 +1,304 @@
+import hashlib
+import json
+import logging
+import os
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+
+from openai import AzureOpenAI, OpenAI
+from pydantic import BaseModel
+
+from .llm_clients import get_llm_client
+
+BATCH_EXECUTION_MODE = "batch"
+DEFAULT_POLL_INTERVAL = 60
+DEFAULT_COMPLETION_WINDOW = "24h"
+# Batch APIの1ファイルあたりのリクエスト数の上限
+MAX_REQUESTS_PER_BATCH = 50000
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# 終了したバッチのうち、結果を取得できないもの。再実行時には作り直す
+UNUSABLE_STATUSES = ("failed", "expired", "cancelled")
+
+
+@dataclass
+class BatchChatRequest:
+    """Batch APIで送信する1件のチャットリクエスト"""
+
+    custom_id: str
+    messages: list[dict]
+    json_schema: dict | type[BaseModel] | None = None
+    is_json: bool = False
+
+
+class BatchRequestError(RuntimeError):
+    """Batch APIのリクエストが失敗した、または結果が返らなかった場合のエラー"""
+
+
+class BatchTransport(ABC):
+    """Batch APIのファイルのアップロード・バッチの作成・状態の取得・結果のダウンロードを行う抽象基底クラス
+
+    OpenAI以外の実装(テスト用のローカルの代替サーバーなど)に差し替えられるよう、送信手段をこのクラスに分離する。
+    """
+
+    # リクエストファイルの各行に指定するエンドポイント
+    endpoint = "/v1/chat/completions"
+
+    def model_name(self, model: str) -> str:
+        """リクエストファイルに書き込むモデル名"""
+        return model
+
+    @abstractmethod
+    def upload(self, path: str) -> str:
+        """リクエストファイルをアップロードし、ファイルIDを返す"""
+
+    @abstractmethod
+    def create_batch(self, input_file_id: str, completion_window: str) -> str:
+        """アップロードしたファイルからバッチを作成し、バッチIDを返す"""
+
+    @abstractmethod
+    def retrieve_batch(self, batch_id: str) -> dict:
+        """バッチの状態を返す。status, output_file_id, error_file_id, request_countsを含む"""
+
+    @abstractmethod
+    def download(self, file_id: str) -> str:
+        """結果ファイルの内容(JSONL)を返す"""
+
+
+class OpenAIBatchTransport(BatchTransport):
+    """OpenAI・Azure OpenAIのBatch APIを使う実装
+
+    base_urlを指定した場合は、その接続先をOpenAI互換のBatch APIとして使う(ローカルの代替サーバーなど)。
+    """
+
+    def __init__(self, provider: str = "openai", base_url: str | None = None):
+        self.provider = provider
+        if provider == "azure":
+            self.endpoint = "/chat/completions"
+            self.client = get_llm_client(
+                AzureOpenAI,
+                api_version=os.getenv("AZURE_CHATCOMPLETION_VERSION"),
+                azure_endpoint=os.getenv("AZURE_CHATCOMPLETION_ENDPOINT"),
+                api_key=os.getenv("AZURE_CHATCOMPLETION_API_KEY"),
+            )
+        elif provider == "openai":
+            kwargs = {"base_url": base_url, "api_key": os.getenv("OPENAI_API_KEY") or "not-needed"} if base_url else {}
+            self.client = get_llm_client(OpenAI, **kwargs)
+        else:
+            raise ValueError(f"Batch API is not supported for provider: {provider}")
+
+    def model_name(self, model: str) -> str:
+        if self.provider == "azure":
+            return os.getenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME")
+        return model
+
+    def upload(self, path: str) -> str:
+        with open(path, "rb") as f:
+            return self.client.files.create(file=f, purpose="batch").id
+
+    def create_batch(self, input_file_id: str, completion_window: str) -> str:
+        batch = self.client.batches.create(
+            input_file_id=input_file_id, endpoint=self.endpoint, completion_window=completion_window
+        )
+        return batch.id
+
+    def retrieve_batch(self, batch_id: str) -> dict:
+        batch = self.client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        return {
+            "status": batch.status,
+            "output_file_id": batch.output_file_id,
+            "error_file_id": batch.error_file_id,
+            "request_counts": {"total": counts.total, "completed": counts.completed, "failed": counts.failed}
+            if counts
+            else {},
+        }
+
+    def download(self, file_id: str) -> str:
+        return self.client.files.content(file_id).text
+
+
+_batch_config: dict = {}
+_batch_transport: BatchTransport | None = None
+
+
+def configure_batch(batch_config: dict | None, transport: BatchTransport | None = None) -> None:
+    """Batch APIの設定を行う
+
+    Args:
+        batch_config: configの"batch"の値
+            - poll_interval: バッチの状態を確認する間隔(秒)
+            - completion_window: バッチの完了期限
+            - base_url: OpenAI互換のBatch APIの接続先。省略時はOpenAI
+        transport: 送信に使うBatchTransport。省略時はproviderに応じたOpenAIBatchTransport
+    """
+    global _batch_config, _batch_transport
+    _batch_config = dict(batch_config or {})
+    _batch_transport = transport
+
+
+def get_batch_transport(provider: str) -> BatchTransport:
+    if _batch_transport is not None:
+        return _batch_transport
+    return OpenAIBatchTransport(provider, _batch_config.get("base_url"))
+
+
+def build_chat_request_body(
+    messages: list[dict],
+    model: str,
+    is_json: bool = False,
+    json_schema: dict | type[BaseModel] | None = None,
+) -> dict:
+    """request_to_openaiと同じパラメータのリクエストボディを作る"""
+    body = {"model": model, "messages": messages, "temperature": 0, "n": 1, "seed": 0}
+    if isinstance(json_schema, type) and issubclass(json_schema, BaseModel):
+        body["response_format"] = _pydantic_response_format(json_schema)
+    elif json_schema:
+        body["response_format"] = json_schema
+    elif is_json:
+        body["response_format"] = {"type": "json_object"}
+    return body
+
+
+def _pydantic_response_format(model: type[BaseModel]) -> dict:
+    """Pydanticモデルから、Structured Outputs(strict)のresponse_formatを作る
+
+    ローカルLLM・非同期版のリクエストと同じ形式。strictではすべてのオブジェクトに
+    additionalProperties: falseが必要なため、スキーマに追加する。
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "strict": True,
+            "schema": _disallow_additional_properties(model.model_json_schema()),
+        },
+    }
+
+
+def _disallow_additional_properties(schema):
+    if isinstance(schema, dict):
+        schema = {key: _disallow_additional_properties(value) for key, value in schema.items()}
+        if schema.get("type") == "object":
+            schema.setdefault("additionalProperties", False)
+    elif isinstance(schema, list):
+        schema = [_disallow_additional_properties(value) for value in schema]
+    return schema
+
+
+def _load_manifest(path: str) -> dict:
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_manifest(path: str, manifest: dict) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def _submit_or_resume(transport: BatchTransport, path: str, manifest: dict, manifest_path: str) -> str:
+    """リクエストファイルのバッチを作成する。同じ内容のバッチを作成済みの場合はそのバッチを使う"""
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    entry = manifest.get(os.path.basename(path))
+    if entry and entry["sha256"] == digest and entry.get("status") not in UNUSABLE_STATUSES:
+        print(f"Resuming batch {entry['batch_id']} for {path}")
+        return entry["batch_id"]
+
+    input_file_id = transport.upload(path)
+    batch_id = transport.create_batch(input_file_id, _batch_config.get("completion_window", DEFAULT_COMPLETION_WINDOW))
+    manifest[os.path.basename(path)] = {"sha256": digest, "batch_id": batch_id, "status": "validating"}
+    _save_manifest(manifest_path, manifest)
+    print(f"Submitted batch {batch_id} for {path}")
+    return batch_id
+
+
+def _parse_result_line(line: dict) -> tuple[str, int, int, int] | BatchRequestError:
+    response = line.get("response") or {}
+    if line.get("error") or response.get("status_code") != 200:
+        return BatchRequestError(f"batch request failed: {line.get('error') or response.get('body')}")
+    body = response["body"]
+    content = body["choices"][0]["message"]["content"]
+    usage = body.get("usage") or {}
+    return (
+        content,
+        usage.get("prompt_tokens") or 0,
+        usage.get("completion_tokens") or 0,
+        usage.get("total_tokens") or 0,
+    )
+
+
+def run_chat_batch(
+    requests: list[BatchChatRequest],
+    model: str,
+    provider: str,
+    work_dir: str,
+    name: str,
+) -> dict[str, tuple[str, int, int, int] | BatchRequestError]:
+    """チャットリクエストをBatch APIでまとめて実行し、custom_idごとの結果を返す
+
+    リクエストをJSONLファイルに書き出して送信し、すべてのバッチが終了するまで状態を確認し続ける。
+    作成したバッチのIDはwork_dirのマニフェストに記録し、途中で中断した場合の再実行では同じバッチの結果を待つ。
+
+    Args:
+        requests: 送信するリクエストのリスト。custom_idは一意であること
+        model: 使用するモデル名
+        provider: LLMプロバイダー("openai"または"azure")
+        work_dir: リクエストファイル・マニフェストを書き出すディレクトリ
+        name: ファイル名の接頭辞(ステップ名など)
+
+    Returns:
+        custom_idをキーとし、request_to_chat_aiと同じ(レスポンス, 入力・出力・合計のトークン数)のタプル、
+        または失敗した場合はBatchRequestErrorを値とする辞書
+    """
+    if not requests:
+        return {}
+    transport = get_batch_transport(provider)
+    poll_interval = _batch_config.get("poll_interval", DEFAULT_POLL_INTERVAL)
+    os.makedirs(work_dir, exist_ok=True)
+    manifest_path = os.path.join(work_dir, f"{name}_batches.json")
+    manifest = _load_manifest(manifest_path)
+
+    batch_files: dict[str, str] = {}
+    for part, start in enumerate(range(0, len(requests), MAX_REQUESTS_PER_BATCH)):
+        path = os.path.join(work_dir, f"{name}_{part}.jsonl")
+        with open(path, "w", encoding="utf-8") as f:
+            for request in requests[start : start + MAX_REQUESTS_PER_BATCH]:
+                body = build_chat_request_body(
+                    request.messages, transport.model_name(model), request.is_json, request.json_schema
+                )
+                line = {"custom_id": request.custom_id, "method": "POST", "url": transport.endpoint, "body": body}
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        batch_files[_submit_or_resume(transport, path, manifest, manifest_path)] = path
+
+    results: dict[str, tuple[str, int, int, int] | BatchRequestError] = {}
+    pending = list(batch_files)
+    while pending:
+        for batch_id in list(pending):
+            batch = transport.retrieve_batch(batch_id)
+            entry = manifest[os.path.basename(batch_files[batch_id])]
+            if entry.get("status") != batch["status"]:
+                entry["status"] = batch["status"]
+                _save_manifest(manifest_path, manifest)
+                print(f"Batch {batch_id}: {batch['status']} {batch.get('request_counts', {})}")
+            if batch["status"] not in TERMINAL_STATUSES:
+                continue
+            pending.remove(batch_id)
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                if not file_id:
+                    continue
+                for raw in transport.download(file_id).splitlines():
+                    if raw.strip():
+                        line = json.loads(raw)
+                        results[line["custom_id"]] = _parse_result_line(line)
+            if batch["status"] != "completed":
+                logging.error(f"Batch {batch_id} ended with status {batch['status']}")
+        if pending:
+            time.sleep(poll_interval)
+
+    for request in requests:
+        if request.custom_id not in results:
+            results[request.custom_id] = BatchRequestError(f"no result for {request.custom_id}")
+    return results
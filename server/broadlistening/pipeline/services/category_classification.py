@@ -1,10 +1,28 @@
-import concurrent.futures
+import hashlib
 import json
+import logging
+from functools import partial
+from typing import Literal
 
+import numpy as np
 import pandas as pd
+from pydantic import BaseModel, ConfigDict, Field, create_model
 from tqdm import tqdm
 
-from services.llm import request_to_openai
+from .adaptive_concurrency import create_concurrency_controller, run_in_sliding_window
+from .batch_runner import BATCH_EXECUTION_MODE, BatchChatRequest, run_chat_batch
+from .checkpoint_journal import CheckpointJournal
+from .llm import (
+    pack_by_token_budget,
+    request_to_chat_ai,
+    request_to_embed_in_batches,
+    supports_embedding_dimensions,
+)
+
+JOURNAL_FILENAME = "classification_journal.jsonl"
+EMBEDDING_MODE = "embedding"
+# 分類時に計算した意見の埋め込みを保存し、embeddingステップで再利用する
+EMBEDDINGS_FILENAME = "classification_embeddings.pkl"
 
 BASE_CLASSIFICATION_PROMPT = """与えられた意見群をカテゴリに分類してください
 
@@ -18,14 +36,10 @@ BASE_CLASSIFICATION_PROMPT = """与えられた意見群をカテゴリに分類
 
 # 出力例
 {{
-    "arg-id-1": {{
-        "カテゴリ1": "カテゴリ1の分類結果",
-        "カテゴリ2": "カテゴリ2の分類結果",
-    }},
-    "arg-id-2": {{
-        "カテゴリ1": "カテゴリ1の分類結果",
-        "カテゴリ2": "カテゴリ2の分類結果",
-    }}
+    "results": [
+        {{"argId": "arg-id-1", "カテゴリ1": "カテゴリ1の分類結果", "カテゴリ2": "カテゴリ2の分類結果"}},
+        {{"argId": "arg-id-2", "カテゴリ1": "カテゴリ1の分類結果", "カテゴリ2": "カテゴリ2の分類結果"}}
+    ]
 }}
 
 
@@ -61,14 +75,10 @@ BASE_CLASSIFICATION_PROMPT = """与えられた意見群をカテゴリに分類
 
 # # 出力例
 # {{
-#     "arg-id-1": {{
-#         "sentiment": "positive",
-#         "genre": "politics",
-#     }},
-#     "arg-id-2": {{
-#         "sentiment": "negative",
-#         "genre": "economy",
-#     }}
+#     "results": [
+#         {{"argId": "arg-id-1", "sentiment": "positive", "genre": "politics"}},
+#         {{"argId": "arg-id-2", "sentiment": "negative", "genre": "economy"}}
+#     ]
 # }}
 
 
@@ -112,46 +122,314 @@ def _parse_arg_result(classification_results: dict, arg_id: str, categories: lis
     return parsed_result
 
 
-def classify_batch_args(batch_args: pd.DataFrame, categories: dict, model: str) -> dict:
+def build_classification_schema(categories: dict[str, dict[str, str]]) -> type[BaseModel]:
+    """カテゴリの定義から、structured outputで使う分類結果のスキーマを作る
+
+    カテゴリ名は日本語や記号を含むことがあるため、フィールド名は連番にしてカテゴリ名はaliasで指定する。
+    各カテゴリの値は、定義された分類先のいずれかに制限する。
+    """
+    item_fields = {"argId": (str, Field(..., description="分類した意見のid"))}
+    for i, (category, values) in enumerate(categories.items()):
+        # 分類先が定義されていないカテゴリは自由記述にする
+        value_type = Literal[tuple(values)] if values else str
+        item_fields[f"category_{i}"] = (value_type, Field(..., alias=category))
+    item_model = create_model("ClassificationItem", __config__=ConfigDict(populate_by_name=True), **item_fields)
+    return create_model(
+        "ClassificationResponse", results=(list[item_model], Field(..., description="意見ごとの分類結果"))
+    )
+
+
+def _parse_classification_response(response: str | dict, categories: list[str]) -> dict:
+    """分類結果をarg-idごとの {カテゴリ名: 分類先} に変換する
+
+    Azureはパース済みのdictをフィールド名で返すため、カテゴリ名とフィールド名のどちらでも読み取る。
+    """
+    try:
+        data = json.loads(response) if isinstance(response, str) else response
+    except json.JSONDecodeError:
+        return {}
+    items = data.get("results") if isinstance(data, dict) else None
+    classification_results = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and "argId" in item:
+            classification_results[str(item["argId"])] = {
+                category: item.get(category, item.get(f"category_{i}")) for i, category in enumerate(categories)
+            }
+    return classification_results
+
+
+def _build_classification_messages(batch_args: pd.DataFrame, categories: dict) -> list[dict]:
     category_string = _build_categories_string(categories)
     batch_args_string = _build_batch_args_string(batch_args)
     prompt = BASE_CLASSIFICATION_PROMPT.format(categories_string=category_string, args_string=batch_args_string)
-    result = request_to_openai(
-        messages=[
-            {"role": "system", "content": prompt},
-        ],
+    return [{"role": "system", "content": prompt}]
+
+
+def classify_batch_args(
+    batch_args: pd.DataFrame,
+    categories: dict,
+    model: str,
+    provider: str = "openai",
+    local_llm_address: str | None = None,
+) -> tuple[dict, int, int, int]:
+    """意見のバッチを1リクエストで分類する
+
+    Returns:
+        arg-idごとの分類結果と、トークン使用量(入力・出力・合計)のタプル
+    """
+    response, token_input, token_output, token_total = request_to_chat_ai(
+        messages=_build_classification_messages(batch_args, categories),
         model=model,
-        is_json=True,
+        json_schema=build_classification_schema(categories),
+        provider=provider,
+        local_llm_address=local_llm_address,
+    )
+    return _parse_classification_response(response, list(categories)), token_input, token_output, token_total
+
+
+def _build_classification_batches(args: pd.DataFrame, config) -> list[list[int]]:
+    """推定トークン数がcategory_token_budget以下、件数がcategory_batch_size以下になるように意見をまとめる"""
+    return pack_by_token_budget(
+        list(args["argument"]),
+        config["extraction"]["category_token_budget"],
+        config["extraction"]["category_batch_size"],
+    )
+
+
+def _argument_hash(argument: str) -> str:
+    return hashlib.sha256(str(argument).encode()).hexdigest()
+
+
+def _open_classification_journal(config, resume: bool) -> tuple[CheckpointJournal, dict]:
+    """分類結果のジャーナルを開き、再開する場合は記録済みの結果を返す"""
+    journal = CheckpointJournal(
+        f"outputs/{config['output_dir']}/{JOURNAL_FILENAME}",
+        header={
+            "provider": config["provider"],
+            "model": config["extraction"]["model"],
+            "categories": config["extraction"]["categories"],
+        },
+    )
+    entries = journal.load() if resume else {}
+    journal.open(resume=resume)
+    return journal, entries
+
+
+def _accumulate_token_usage(config, token_input: int, token_output: int, token_total: int) -> None:
+    config["total_token_usage"] = config.get("total_token_usage", 0) + token_total
+    config["token_usage_input"] = config.get("token_usage_input", 0) + token_input
+    config["token_usage_output"] = config.get("token_usage_output", 0) + token_output
+
+
+def _journal_batch_results(journal: CheckpointJournal, batch_args: pd.DataFrame, results: dict) -> None:
+    for arg_id, argument in zip(batch_args["arg-id"], batch_args["argument"], strict=True):
+        if arg_id in results:
+            journal.append(arg_id, {"argument_sha256": _argument_hash(argument), "categories": results[arg_id]})
+
+
+def _classify_with_batch(args: pd.DataFrame, config, batches: list[list[int]], journal: CheckpointJournal) -> dict:
+    """Batch APIで全バッチの分類をまとめて実行する"""
+    categories = config["extraction"]["categories"]
+    schema = build_classification_schema(categories)
+    requests = [
+        BatchChatRequest(
+            custom_id=f"classification-{batch_index}",
+            messages=_build_classification_messages(args.iloc[batch], categories),
+            json_schema=schema,
+        )
+        for batch_index, batch in enumerate(batches)
+    ]
+    responses = run_chat_batch(
+        requests,
+        config["extraction"]["model"],
+        config["provider"],
+        f"outputs/{config['output_dir']}/batches",
+        "classification",
+    )
+    classification_results = {}
+    for request, batch in zip(requests, batches, strict=True):
+        response = responses[request.custom_id]
+        if isinstance(response, Exception):
+            logging.error(f"Classification batch {request.custom_id} failed with error: {response}")
+            continue
+        _accumulate_token_usage(config, *response[1:])
+        results = _parse_classification_response(response[0], list(categories))
+        _journal_batch_results(journal, args.iloc[batch], results)
+        classification_results.update(results)
+    return classification_results
+
+
+def _embed_texts(texts: list[str], config) -> tuple[np.ndarray, list]:
+    """embeddingステップと同じモデルでテキストを埋め込み、L2正規化した行列と元の埋め込みを返す"""
+    vectors = request_to_embed_in_batches(
+        texts,
+        config["embedding"]["model"],
+        config.get("is_embedded_at_local", False),
+        config["provider"],
+        config.get("local_llm_address"),
+        workers=create_concurrency_controller(config["embedding"]["workers"]) or config["embedding"]["workers"],
+        token_budget=config["embedding"]["batch_token_budget"],
+        batch_size=config["embedding"]["batch_size"],
+        dimensions=_request_dimensions(config),
+    )
+    matrix = np.asarray(vectors, dtype=float).reshape(len(texts), -1)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    return matrix / np.where(norms == 0, 1, norms), vectors
+
+
+def _request_dimensions(config) -> int | None:
+    """embeddingステップと同じく、次元数の指定に対応したモデルの場合だけプロバイダーに次元数を要求する"""
+    if supports_embedding_dimensions(
+        config["embedding"]["model"], config.get("is_embedded_at_local", False), config["provider"]
+    ):
+        return config["embedding"]["dimensions"]
+    return None
+
+
+def _save_argument_embeddings(args: pd.DataFrame, vectors: list, config) -> None:
+    pd.to_pickle(
+        {
+            "model": config["embedding"]["model"],
+            "provider": config["provider"],
+            "is_embedded_at_local": config.get("is_embedded_at_local", False),
+            "dimensions": _request_dimensions(config),
+            "embeddings": pd.DataFrame(
+                {"arg-id": list(args["arg-id"]), "argument": list(args["argument"]), "embedding": vectors}
+            ),
+        },
+        f"outputs/{config['output_dir']}/{EMBEDDINGS_FILENAME}",
     )
+
+
+def load_classification_embeddings(config) -> dict[str, list[float]]:
+    """分類時に保存した意見の埋め込みを {意見の本文: 埋め込み} で返す
+
+    埋め込みのモデル・プロバイダー・次元数が現在の設定と異なる場合は再利用できないため空のdictを返す。
+    """
+    path = f"outputs/{config['output_dir']}/{EMBEDDINGS_FILENAME}"
     try:
-        return json.loads(result)
-    except json.JSONDecodeError:
+        saved = pd.read_pickle(path)
+    except FileNotFoundError:
+        return {}
+    if (saved["model"], saved["provider"], saved["is_embedded_at_local"], saved.get("dimensions")) != (
+        config["embedding"]["model"],
+        config["provider"],
+        config.get("is_embedded_at_local", False),
+        _request_dimensions(config),
+    ):
         return {}
+    embeddings = saved["embeddings"]
+    return dict(zip(embeddings["argument"], embeddings["embedding"], strict=True))
+
+
+def classify_by_embedding(args: pd.DataFrame, config) -> tuple[dict, list[str]]:
+    """分類先の説明文と意見の埋め込みのコサイン類似度で意見を分類する
+
+    カテゴリごとに最も類似度の高い分類先を割り当て、2番目との差がcategory_embedding_margin未満の意見は
+    LLMで分類し直す対象として返す。分類先が定義されていないカテゴリがある場合は、すべての意見をLLMに回す。
+
+    Returns:
+        arg-idごとの分類結果と、LLMで分類し直す意見のarg-idのリスト
+    """
+    categories = config["extraction"]["categories"]
+    margin_threshold = config["extraction"]["category_embedding_margin"]
+    arg_matrix, arg_vectors = _embed_texts([str(argument) for argument in args["argument"]], config)
+    _save_argument_embeddings(args, arg_vectors, config)
+
+    arg_ids = list(args["arg-id"])
+    results: dict[str, dict] = {arg_id: {} for arg_id in arg_ids}
+    escalate = np.zeros(len(arg_ids), dtype=bool)
+    rows = np.arange(len(arg_ids))
+    for category, values in categories.items():
+        if not values:
+            escalate[:] = True
+            continue
+        value_names = list(values)
+        value_matrix, _ = _embed_texts(
+            [f"{category}: {name}: {description}" for name, description in values.items()], config
+        )
+        similarities = arg_matrix @ value_matrix.T
+        order = np.argsort(-similarities, axis=1)
+        best = similarities[rows, order[:, 0]]
+        # 分類先が1つしかない場合は迷う余地がないため、常に割り当てる
+        second = similarities[rows, order[:, 1]] if len(value_names) > 1 else np.full(len(arg_ids), -np.inf)
+        escalate |= best - second < margin_threshold
+        for arg_id, value_index in zip(arg_ids, order[:, 0], strict=True):
+            results[arg_id][category] = value_names[value_index]
+    return results, [arg_id for arg_id, flag in zip(arg_ids, escalate, strict=True) if flag]
 
 
-def classify_args(args: pd.DataFrame, config, workers: int) -> pd.DataFrame:
-    batch_size = config["extraction"]["category_batch_size"]
+def _classify_with_llm(args: pd.DataFrame, config, workers: int, journal: CheckpointJournal) -> dict:
+    """意見をトークン数の予算でバッチにまとめ、LLMで分類する"""
+    batches = _build_classification_batches(args, config)
+    if config["extraction"]["execution_mode"] == BATCH_EXECUTION_MODE:
+        return _classify_with_batch(args, config, batches, journal)
 
+    tasks = [
+        partial(
+            classify_batch_args,
+            args.iloc[batch],
+            config["extraction"]["categories"],
+            config["extraction"]["model"],
+            config["provider"],
+            config.get("local_llm_address"),
+        )
+        for batch in batches
+    ]
     classification_results = {}
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        batch_start_indices = range(0, len(args), batch_size)
-        future_to_batch = {
-            executor.submit(
-                classify_batch_args,
-                args.loc[batch_idx : batch_idx + batch_size],
-                config["extraction"]["categories"],
-                config["extraction"]["model"],
-            ): batch_idx
-            for batch_idx in batch_start_indices
-        }
-        for future in tqdm(
-            concurrent.futures.as_completed(future_to_batch),
-            total=len(batch_start_indices),
-            desc="Classifying arguments",
-        ):
-            result = future.result()
-            classification_results.update(result)
+    for batch_index, future in tqdm(
+        run_in_sliding_window(tasks, workers), total=len(tasks), desc="Classifying arguments"
+    ):
+        try:
+            results, token_input, token_output, token_total = future.result()
+        except Exception as e:
+            logging.error(f"Classification batch {batch_index} failed with error: {e}")
+            continue
+        _accumulate_token_usage(config, token_input, token_output, token_total)
+        _journal_batch_results(journal, args.iloc[batches[batch_index]], results)
+        classification_results.update(results)
+    return classification_results
+
+
+def classify_args(args: pd.DataFrame, config, workers: int, resume: bool = False) -> pd.DataFrame:
+    """意見をconfigのカテゴリに分類し、カテゴリごとの列を追加したDataFrameを返す
+
+    意見はトークン数の予算に収まるように重複なくバッチにまとめ、1バッチ1リクエストで並行して分類する。
+    category_classification_modeが"embedding"の場合は埋め込みの類似度で分類し、
+    判定の際どい意見だけをLLMで分類する。
+    分類結果はバッチが完了するたびにジャーナルに追記し、resume=Trueの場合は記録済みの意見を分類し直さない。
+    """
+    journal, entries = _open_classification_journal(config, resume)
+    classification_results = {}
+    for arg_id, argument in zip(args["arg-id"], args["argument"], strict=True):
+        entry = entries.get(arg_id)
+        if entry is not None and entry["argument_sha256"] == _argument_hash(argument):
+            classification_results[arg_id] = entry["categories"]
+    pending_args = args[~args["arg-id"].isin(list(classification_results))]
+    if resume:
+        print(f"Resuming classification from journal: {len(classification_results)} arguments already classified")
+
+    try:
+        if config["extraction"]["category_classification_mode"] == EMBEDDING_MODE and len(pending_args) > 0:
+            embedding_results, escalated = classify_by_embedding(pending_args, config)
+            confident_args = pending_args[~pending_args["arg-id"].isin(escalated)]
+            _journal_batch_results(journal, confident_args, embedding_results)
+            config["category_classification"] = {
+                "mode": EMBEDDING_MODE,
+                "arguments": len(pending_args),
+                "assigned_by_embedding": len(confident_args),
+                "escalated_to_llm": len(escalated),
+            }
+            # LLMで分類できなかった意見は、類似度による分類結果を使う
+            classification_results.update(embedding_results)
+            pending_args = pending_args[pending_args["arg-id"].isin(escalated)]
+        classification_results.update(_classify_with_llm(pending_args, config, workers, journal))
+    finally:
+        journal.close()
+    return _merge_classification_results(args, classification_results, config)
+
 
+def _merge_classification_results(args: pd.DataFrame, classification_results: dict, config) -> pd.DataFrame:
     # 結果をdataframeに変換し、argsにjoinする
     results = []
     categories = list(config["extraction"]["categories"].keys())
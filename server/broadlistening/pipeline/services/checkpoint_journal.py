@@ -0,0 +1,126 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+EXTRACTION_JOURNAL_FILENAME = "extraction_journal.jsonl"
+
+
+class CheckpointJournal:
+    """処理結果を1件ずつ追記するJSONL形式のジャーナル
+
+    長時間かかるLLM処理の途中でクラッシュしても、完了済みの結果を失わないために使う。
+    1行目はヘッダー(結果に影響する設定値)で、再開時にヘッダーが一致しない場合は
+    別の設定で作られたジャーナルとみなして破棄する。2行目以降は {"key": ..., "value": ...} の形式。
+    """
+
+    def __init__(self, path: str, header: dict):
+        self.path = path
+        self.header = header
+        self._file = None
+        self._lock = threading.Lock()
+
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def is_resumable(self) -> bool:
+        """ジャーナルが存在し、ヘッダーが現在の設定と一致するかどうか"""
+        if not self.exists():
+            return False
+        with open(self.path, encoding="utf-8") as f:
+            return self._header_matches(f.readline())
+
+    def load(self) -> dict[str, object]:
+        """記録済みの結果を読み込む。ヘッダーが一致しない場合は空のdictを返す"""
+        if not self.exists():
+            return {}
+
+        entries = {}
+        with open(self.path, encoding="utf-8") as f:
+            if not self._header_matches(f.readline()):
+                logging.warning(f"Journal header mismatch, ignoring previous journal: {self.path}")
+                return {}
+
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # クラッシュ時に書きかけになった最終行は読み飛ばす
+                    logging.warning(f"Skipping broken journal line in {self.path}")
+                    continue
+                entries[entry["key"]] = entry["value"]
+        return entries
+
+    def open(self, resume: bool) -> None:
+        """追記用にジャーナルを開く。resume=Falseの場合は既存の内容を破棄してヘッダーから書き直す"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if resume and self.exists():
+            with open(self.path, encoding="utf-8") as f:
+                header_line = f.readline()
+            if self._header_matches(header_line):
+                self._truncate_partial_line()
+                self._file = open(self.path, "a", encoding="utf-8")
+                return
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._write_line(self.header)
+
+    def _truncate_partial_line(self) -> None:
+        """クラッシュで書きかけになった最終行を削除する
+
+        書きかけの行に続けて追記すると、次の行と連結されて読み込み時に両方とも読み飛ばされるため、
+        最後の改行までに切り詰めてから追記する。
+        """
+        with open(self.path, "r+b") as f:
+            end = f.seek(0, os.SEEK_END)
+            position = end
+            while position > 0:
+                chunk_start = max(0, position - 4096)
+                f.seek(chunk_start)
+                newline = f.read(position - chunk_start).rfind(b"\n")
+                if newline != -1:
+                    position = chunk_start + newline + 1
+                    break
+                position = chunk_start
+            if position < end:
+                logging.warning(f"Truncating broken last line of journal: {self.path}")
+                f.truncate(position)
+
+    def _header_matches(self, line: str) -> bool:
+        try:
+            return json.loads(line) == self.header
+        except json.JSONDecodeError:
+            return False
+
+    def append(self, key: str, value: object) -> None:
+        self._write_line({"key": key, "value": value})
+
+    def _write_line(self, obj: dict) -> None:
+        if self._file is None:
+            raise RuntimeError("journal is not opened")
+        with self._lock:
+            self._file.write(json.dumps(obj, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def extraction_journal(config) -> CheckpointJournal:
+    """抽出結果のジャーナル。プロバイダー・モデル・プロンプトなどが変わった場合は、記録済みの結果を使わない
+
+    extractionステップのほか、--appendモードの検証でも使うため、抽出処理に依存しないここに置く。
+    """
+    return CheckpointJournal(
+        f"outputs/{config['output_dir']}/{EXTRACTION_JOURNAL_FILENAME}",
+        header={
+            "provider": config.get("provider"),
+            "model": config["extraction"]["model"],
+            "prompt_sha256": hashlib.sha256(config["extraction"]["prompt"].encode()).hexdigest(),
+            "pack_comments": config["extraction"]["pack_comments"],
+        },
+    )
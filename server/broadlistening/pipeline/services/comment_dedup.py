@@ -0,0 +1,125 @@
+import hashlib
+import re
+import unicodedata
+import zlib
+from dataclasses import dataclass
+
+import numpy as np
+
+WHITESPACE = re.compile(r"\s+")
+
+# MinHashの設定。128個のハッシュを16バンド×8行に分割してLSHの候補を絞り込む
+MINHASH_NUM_PERM = 128
+LSH_BANDS = 16
+SHINGLE_SIZE = 3
+# a * x + b が uint64 に収まるよう、31bitのメルセンヌ素数で剰余を取る
+_MERSENNE_PRIME = (1 << 31) - 1
+
+
+def normalize_comment(text: str) -> str:
+    """重複判定用にコメント本文を正規化する
+
+    全角・半角の違い(NFKC)、大文字・小文字、空白、句読点などの記号の違いを無視する。
+
+    >>> normalize_comment("ＡＩの 規制に、反対です！")
+    'aiの規制に反対です'
+    """
+    text = unicodedata.normalize("NFKC", str(text)).lower()
+    text = WHITESPACE.sub("", text)
+    return "".join(ch for ch in text if not unicodedata.category(ch).startswith(("P", "S")))
+
+
+@dataclass
+class DedupResult:
+    """重複コメントの集約結果
+
+    representatives[i] は i番目のコメントの代表コメントのインデックス(自分自身が代表ならi)。
+    代表は常にグループ内で最初に出現したコメントになる。
+    """
+
+    representatives: list[int]
+    exact_duplicates: int
+    near_duplicates: int
+
+    @property
+    def unique_count(self) -> int:
+        return sum(1 for i, rep in enumerate(self.representatives) if i == rep)
+
+
+def _shingles(text: str) -> set[int]:
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode("utf-8"))}
+    return {zlib.crc32(text[i : i + SHINGLE_SIZE].encode("utf-8")) for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+class _MinHasher:
+    def __init__(self, num_perm: int = MINHASH_NUM_PERM, seed: int = 42):
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, _MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+
+    def signature(self, shingles: set[int]) -> np.ndarray:
+        x = np.fromiter(shingles, dtype=np.uint64, count=len(shingles)) % _MERSENNE_PRIME
+        return ((self.a[:, None] * x[None, :] + self.b[:, None]) % _MERSENNE_PRIME).min(axis=1)
+
+
+def find_duplicate_comments(bodies: list[str], similarity_threshold: float = 0.9) -> DedupResult:
+    """完全一致・近似重複のコメントをまとめ、各コメントの代表コメントを決める
+
+    正規化後の本文が完全一致するものはハッシュで集約する。
+    similarity_threshold < 1 の場合は、文字3-gramのJaccard類似度をMinHash/LSHで推定し、
+    代表コメントとの類似度が閾値以上のものも同じグループにまとめる。
+    連鎖的に似ているだけのコメントがまとまらないよう、類似度は代表コメントとの間でのみ判定する。
+
+    Args:
+        bodies: コメント本文のリスト
+        similarity_threshold: 近似重複とみなすJaccard類似度の閾値。1.0以上なら完全一致のみ
+
+    Returns:
+        各コメントの代表コメントのインデックスと、重複の件数
+    """
+    representatives = list(range(len(bodies)))
+    exact_duplicates = 0
+    near_duplicates = 0
+
+    exact_index: dict[str, int] = {}
+    near_dup_enabled = similarity_threshold < 1.0
+    hasher = _MinHasher() if near_dup_enabled else None
+    rows = MINHASH_NUM_PERM // LSH_BANDS
+    buckets: list[dict[bytes, list[int]]] = [{} for _ in range(LSH_BANDS)]
+    signatures: dict[int, np.ndarray] = {}
+
+    for i, body in enumerate(bodies):
+        normalized = normalize_comment(body)
+        digest = hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+        if digest in exact_index:
+            representatives[i] = exact_index[digest]
+            exact_duplicates += 1
+            continue
+        exact_index[digest] = i
+
+        if not near_dup_enabled or not normalized:
+            continue
+
+        signature = hasher.signature(_shingles(normalized))
+        band_keys = [signature[band * rows : (band + 1) * rows].tobytes() for band in range(LSH_BANDS)]
+        candidates = sorted({rep for band, key in enumerate(band_keys) for rep in buckets[band].get(key, [])})
+        match = next(
+            (rep for rep in candidates if np.mean(signatures[rep] == signature) >= similarity_threshold),
+            None,
+        )
+        if match is not None:
+            representatives[i] = match
+            near_duplicates += 1
+            continue
+
+        # 代表コメントだけをバケットに登録する
+        signatures[i] = signature
+        for band, key in enumerate(band_keys):
+            buckets[band].setdefault(key, []).append(i)
+
+    return DedupResult(
+        representatives=representatives,
+        exact_duplicates=exact_duplicates,
+        near_duplicates=near_duplicates,
+    )
@@ -0,0 +1,149 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import numpy as np
+
+DEFAULT_EMBEDDING_CACHE_PATH = "cache/embeddings.sqlite3"
+DEFAULT_EMBEDDING_CACHE_MAX_SIZE_MB = 4096
+
+# SQLiteのIN句に渡す変数の数の上限(SQLITE_MAX_VARIABLE_NUMBER)を超えないように分割して参照する
+LOOKUP_CHUNK_SIZE = 500
+
+
+def normalize_text(text: str) -> str:
+    """キャッシュキー用にテキストを正規化する(Unicode正規化NFCと、空白の連続・前後の空白の除去)"""
+    return " ".join(unicodedata.normalize("NFC", str(text)).split())
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """埋め込みベクトルをSQLiteに保存する、レポートをまたいで共有する永続キャッシュ
+
+    キーは(モデル, 正規化したテキストのSHA-256)で、ベクトルはfloat32のバイト列で保存する。
+    合計サイズが上限を超えた場合は、最後に参照された時刻が古いものから削除する(LRU)。
+    複数スレッドから同時に呼ばれるため、コネクションは1つにしてロックで排他する。
+    """
+
+    def __init__(
+        self, path: str = DEFAULT_EMBEDDING_CACHE_PATH, max_size_mb: float = DEFAULT_EMBEDDING_CACHE_MAX_SIZE_MB
+    ):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_embeddings_last_access ON embeddings (last_access)")
+        self._conn.commit()
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        """テキストごとの埋め込みを返す。キャッシュにないテキストはNoneにする"""
+        hashes = [text_hash(text) for text in texts]
+        found: dict[str, bytes] = {}
+        with self._lock:
+            try:
+                unique_hashes = list(dict.fromkeys(hashes))
+                for i in range(0, len(unique_hashes), LOOKUP_CHUNK_SIZE):
+                    chunk = unique_hashes[i : i + LOOKUP_CHUNK_SIZE]
+                    placeholders = ",".join("?" * len(chunk))
+                    rows = self._conn.execute(
+                        f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                        (model, *chunk),
+                    ).fetchall()
+                    found.update(rows)
+                if found:
+                    now = time.time()
+                    self._conn.executemany(
+                        "UPDATE embeddings SET last_access = ? WHERE model = ? AND text_hash = ?",
+                        [(now, model, h) for h in found],
+                    )
+                    self._conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding cache lookup failed: {e}")
+                found = {}
+            vectors = [np.frombuffer(found[h], dtype=np.float32).tolist() if h in found else None for h in hashes]
+            hits = sum(vector is not None for vector in vectors)
+            self.hits += hits
+            self.misses += len(vectors) - hits
+        return vectors
+
+    def set_many(self, model: str, texts: list[str], vectors: list[list[float]]) -> None:
+        rows = []
+        for text, vector in zip(texts, vectors, strict=True):
+            blob = np.asarray(vector, dtype=np.float32).tobytes()
+            rows.append((model, text_hash(text), blob, len(blob)))
+        with self._lock:
+            try:
+                for model_name, hash_value, blob, size in rows:
+                    previous = self._conn.execute(
+                        "SELECT size FROM embeddings WHERE model = ? AND text_hash = ?", (model_name, hash_value)
+                    ).fetchone()
+                    self._conn.execute(
+                        "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, size, last_access) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        (model_name, hash_value, blob, size, time.time()),
+                    )
+                    self._size_bytes += size - (previous[0] if previous else 0)
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"Embedding cache write failed: {e}")
+
+    def _evict(self) -> None:
+        # 上限ぎりぎりで毎回削除が走らないよう、上限の9割まで減らす
+        target = self.max_size_bytes * 0.9
+        while self._size_bytes > self.max_size_bytes:
+            rows = self._conn.execute(
+                "SELECT model, text_hash, size FROM embeddings ORDER BY last_access ASC LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self._size_bytes = 0
+                return
+            for model, hash_value, size in rows:
+                self._conn.execute("DELETE FROM embeddings WHERE model = ? AND text_hash = ?", (model, hash_value))
+                self._size_bytes -= size
+                self.evictions += 1
+                if self._size_bytes <= target:
+                    return
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": self._size_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,46 @@
+import os
+from collections.abc import Iterable
+
+import numpy as np
+import pandas as pd
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+EMBEDDING_IDS_FILENAME = "embedding_ids.csv"
+# embeddingステップが以前に出力していた、1行1リストのDataFrameのpickle
+LEGACY_EMBEDDINGS_FILENAME = "embeddings.pkl"
+
+
+def save_embeddings(output_dir: str, arg_ids: list[str], vectors: Iterable, dimension: int) -> None:
+    """埋め込みを連続したfloat32の行列(.npy)と、行ごとのarg-idのCSVに保存する
+
+    行列はメモリマップしたファイルに1行ずつ書き込むため、全件分のリストやfloat64の配列を作らない。
+
+    Args:
+        output_dir: 出力ディレクトリ(outputs/{dataset})
+        arg_ids: 行ごとのarg-id
+        vectors: arg_idsと同じ順序の埋め込みベクトル
+        dimension: 埋め込みの次元数
+    """
+    matrix = np.lib.format.open_memmap(
+        os.path.join(output_dir, EMBEDDINGS_FILENAME), mode="w+", dtype=np.float32, shape=(len(arg_ids), dimension)
+    )
+    for i, vector in enumerate(vectors):
+        matrix[i] = vector
+    matrix.flush()
+    del matrix
+    pd.DataFrame({"arg-id": arg_ids}).to_csv(os.path.join(output_dir, EMBEDDING_IDS_FILENAME), index=False)
+
+
+def load_embeddings(output_dir: str, mmap: bool = True) -> tuple[list[str], np.ndarray]:
+    """保存した埋め込みを(arg-idのリスト, float32の行列)で返す
+
+    mmap=Trueの場合は行列を読み取り専用でメモリマップし、必要な部分だけをメモリに読み込む。
+    以前の形式(embeddings.pkl)しかない出力ディレクトリからも読み込める。
+    """
+    path = os.path.join(output_dir, EMBEDDINGS_FILENAME)
+    if not os.path.exists(path) and os.path.exists(os.path.join(output_dir, LEGACY_EMBEDDINGS_FILENAME)):
+        df = pd.read_pickle(os.path.join(output_dir, LEGACY_EMBEDDINGS_FILENAME))
+        return df["arg-id"].tolist(), np.asarray(df["embedding"].tolist(), dtype=np.float32)
+    matrix = np.load(path, mmap_mode="r" if mmap else None)
+    arg_ids = pd.read_csv(os.path.join(output_dir, EMBEDDING_IDS_FILENAME), dtype=str)["arg-id"].tolist()
+    return arg_ids, matrix
@@ -0,0 +1,160 @@
+import logging
+import queue
+import threading
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .adaptive_concurrency import AUTO_WORKERS, DEFAULT_MAX_CONCURRENCY
+from .llm import estimate_tokens, request_embedding_batch, supports_embedding_dimensions
+
+# 抽出の結果がこの秒数届かなかった場合は、予算に満たないバッチでも埋め込みを始める
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+
+class EmbeddingStream:
+    """抽出ステップが出力した意見を受け取り、抽出と並行してバックグラウンドで埋め込む
+
+    受け取った意見は推定トークン数token_budget・最大batch_size件ずつのバッチにまとめ、workers件まで並行して
+    埋め込む。埋め込みに失敗したバッチは記録だけして捨て、embeddingステップで改めて埋め込む。
+    """
+
+    def __init__(
+        self,
+        embed_batch: Callable[[list[str]], list],
+        workers: int,
+        token_budget: int,
+        batch_size: int,
+        flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+    ):
+        self._embed_batch = embed_batch
+        self.token_budget = token_budget
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.failed_batches = 0
+        self._queue: queue.Queue[list[str] | None] = queue.Queue()
+        self._seen: set[str] = set()
+        self._embeddings: dict[str, list[float]] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embedding-stream")
+        self._consumer = threading.Thread(target=self._consume, name="embedding-stream-consumer", daemon=True)
+        self._consumer.start()
+
+    def submit(self, texts: list[str]) -> None:
+        """埋め込む意見を追加する。呼び出し元(抽出)は埋め込みの完了を待たない"""
+        self._queue.put([str(text) for text in texts])
+
+    def close(self) -> dict[str, list[float]]:
+        """追加済みの意見をすべて埋め込むまで待ち、{意見の本文: 埋め込み} を返す"""
+        self._queue.put(None)
+        self._consumer.join()
+        self._executor.shutdown(wait=True)
+        return self._embeddings
+
+    def cancel(self) -> None:
+        """未送信のバッチを破棄して停止する"""
+        self._queue.put(None)
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _consume(self) -> None:
+        pending: list[str] = []
+        pending_tokens = 0
+        closed = False
+        while not closed:
+            try:
+                texts = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                texts = []
+            if texts is None:
+                closed, texts = True, []
+            for text in texts:
+                if text in self._seen:
+                    continue
+                self._seen.add(text)
+                tokens = estimate_tokens(text)
+                if pending and (pending_tokens + tokens > self.token_budget or len(pending) >= self.batch_size):
+                    self._dispatch(pending)
+                    pending, pending_tokens = [], 0
+                pending.append(text)
+                pending_tokens += tokens
+            # 抽出の結果が途切れたときや終了時は、予算に満たないバッチも送る
+            if pending and (closed or not texts):
+                self._dispatch(pending)
+                pending, pending_tokens = [], 0
+
+    def _dispatch(self, texts: list[str]) -> None:
+        try:
+            self._executor.submit(self._run_batch, texts)
+        except RuntimeError:
+            # cancel後のshutdown済みのexecutorには投入できない
+            pass
+
+    def _run_batch(self, texts: list[str]) -> None:
+        try:
+            embeddings = self._embed_batch(texts)
+        except Exception as e:
+            logging.warning(f"Streaming embedding of {len(texts)} arguments failed: {e}")
+            with self._lock:
+                self.failed_batches += 1
+            return
+        with self._lock:
+            self._embeddings.update(zip(texts, embeddings, strict=True))
+
+
+_embedding_stream: EmbeddingStream | None = None
+
+
+def start_embedding_stream(config: dict) -> EmbeddingStream | None:
+    """embedding.streamingが有効で、このあとembeddingステップを実行する場合に、抽出と並行した埋め込みを始める"""
+    global _embedding_stream
+    stop_embedding_stream()
+    options = config["embedding"]
+    embedding_plan = [step for step in config.get("plan", []) if step["step"] == "embedding"]
+    if not options["streaming"] or not (embedding_plan and embedding_plan[0]["run"]):
+        return None
+    model = options["model"]
+    is_embedded_at_local = config["is_embedded_at_local"]
+    dimensions = (
+        options["dimensions"]
+        if supports_embedding_dimensions(model, is_embedded_at_local, config["provider"])
+        else None
+    )
+    workers = DEFAULT_MAX_CONCURRENCY if options["workers"] == AUTO_WORKERS else options["workers"]
+    _embedding_stream = EmbeddingStream(
+        partial(
+            request_embedding_batch,
+            model=model,
+            is_embedded_at_local=is_embedded_at_local,
+            provider=config["provider"],
+            local_llm_address=config.get("local_llm_address"),
+            dimensions=dimensions,
+        ),
+        workers=workers,
+        token_budget=options["batch_token_budget"],
+        batch_size=options["batch_size"],
+    )
+    return _embedding_stream
+
+
+def get_embedding_stream() -> EmbeddingStream | None:
+    return _embedding_stream
+
+
+def stop_embedding_stream() -> None:
+    """実行中のストリームを破棄する(抽出が失敗した場合など)"""
+    global _embedding_stream
+    if _embedding_stream is not None:
+        _embedding_stream.cancel()
+        _embedding_stream = None
+
+
+def take_streamed_embeddings(config: dict) -> dict[str, list[float]]:
+    """抽出と並行して埋め込んだ結果を、完了を待ってから {意見の本文: 埋め込み} で返す。ストリームがない場合は空"""
+    global _embedding_stream
+    stream, _embedding_stream = _embedding_stream, None
+    if stream is None:
+        return {}
+    embeddings = stream.close()
+    config["embedding_stream"] = {"streamed": len(embeddings), "failed_batches": stream.failed_batches}
+    print(f"Streamed embeddings: {len(embeddings)} arguments embedded during extraction")
+    return embeddings
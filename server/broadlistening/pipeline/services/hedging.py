@@ -0,0 +1,459 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from collections.abc import Awaitable, Callable
+from concurrent.futures import FIRST_COMPLETED, Future, wait
+from dataclasses import dataclass
+
+import openai
+
+DEFAULT_HEDGE_PERCENTILE = 95
+# パーセンタイルを計算するのに必要な成功リクエスト数。これより少ない間はヘッジしない
+DEFAULT_MIN_SAMPLES = 20
+# 極端に短い待ち時間で重複リクエストを送りすぎないための下限(秒)
+DEFAULT_MIN_HEDGE_DELAY = 1.0
+DEFAULT_MAX_HEDGES = 1
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 60.0
+LATENCY_WINDOW_SIZE = 500
+
+
+@dataclass(frozen=True)
+class ChatTarget:
+    """リクエストの送信先となるプロバイダー・モデルの組"""
+
+    provider: str
+    model: str
+    local_llm_address: str | None = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider}/{self.model}"
+
+
+class ProviderUnavailableError(RuntimeError):
+    """すべての送信先のサーキットブレーカーが開いていて、リクエストを送れない場合に送出する"""
+
+
+def is_provider_failure(error: BaseException) -> bool:
+    """サーキットブレーカーで数えるべきエラーかどうか
+
+    リクエストの内容に起因する400エラーはプロバイダーの障害ではないため数えない。
+    """
+    return not isinstance(error, openai.BadRequestError)
+
+
+class CircuitBreaker:
+    """失敗が続くプロバイダーへの送信を一時的に止める
+
+    連続でfailure_threshold回失敗すると開き、reset_timeout秒の間はリクエストを送らない。
+    その後は1件だけ試しに送り(半開)、成功すれば閉じ、失敗すれば再び開く。
+    """
+
+    def __init__(
+        self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD, reset_timeout: float = DEFAULT_RESET_TIMEOUT
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._consecutive_failures = 0
+        self._opened_at: float | None = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.rejected = 0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now: float) -> str:
+        if self._opened_at is None:
+            return "closed"
+        if now - self._opened_at < self.reset_timeout:
+            return "open"
+        return "half_open"
+
+    def allow_request(self) -> bool:
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release(self) -> None:
+        """結果が送信先の状態を判断する材料にならなかった(キャンセル・400エラー)場合に、半開状態の試行枠を返す"""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._consecutive_failures += 1
+            now = time.monotonic()
+            if self._state(now) == "half_open" or self._consecutive_failures >= self.failure_threshold:
+                if self._state(now) != "open":
+                    self.opened += 1
+                self._opened_at = now
+            self._trial_in_flight = False
+
+
+class _LatencyWindow:
+    """直近の成功リクエストのレイテンシを保持し、パーセンタイルを返す"""
+
+    def __init__(self, size: int = LATENCY_WINDOW_SIZE):
+        self._latencies: deque[float] = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float) -> None:
+        with self._lock:
+            self._latencies.append(latency)
+
+    def percentile(self, percentile: float, min_samples: int) -> float | None:
+        with self._lock:
+            if len(self._latencies) < max(1, min_samples):
+                return None
+            latencies = sorted(self._latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * percentile / 100))
+        return latencies[index]
+
+
+class HedgingPolicy:
+    """遅いリクエストに重複リクエスト(ヘッジ)を送り、最初に返った応答を使う
+
+    送信先のレイテンシが直近の成功リクエストのpercentileパーセンタイルを超えた時点で、
+    フォールバック先(なければ同じ送信先)に重複リクエストを送る。
+    送信先がエラーになった場合は、次のフォールバック先に切り替えて送り直す。
+    """
+
+    def __init__(
+        self,
+        percentile: float = DEFAULT_HEDGE_PERCENTILE,
+        min_samples: int = DEFAULT_MIN_SAMPLES,
+        min_delay: float = DEFAULT_MIN_HEDGE_DELAY,
+        max_hedges: int = DEFAULT_MAX_HEDGES,
+        fallbacks: list[ChatTarget] | None = None,
+        failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout: float = DEFAULT_RESET_TIMEOUT,
+    ):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.min_delay = min_delay
+        self.max_hedges = max_hedges
+        self.fallbacks = list(fallbacks or [])
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._latencies: dict[ChatTarget, _LatencyWindow] = {}
+        self._breakers: dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.hedged_requests = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.cancelled_requests = 0
+        self.hedged_tokens = 0
+        self.wasted_tokens = 0
+
+    def _latency_window(self, target: ChatTarget) -> _LatencyWindow:
+        with self._lock:
+            return self._latencies.setdefault(target, _LatencyWindow())
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        with self._lock:
+            if provider not in self._breakers:
+                self._breakers[provider] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[provider]
+
+    def hedge_delay(self, target: ChatTarget) -> float | None:
+        """重複リクエストを送るまでの待ち時間。レイテンシの記録が足りない場合はNone"""
+        latency = self._latency_window(target).percentile(self.percentile, self.min_samples)
+        if latency is None:
+            return None
+        return max(self.min_delay, latency)
+
+    def targets(self, primary: ChatTarget) -> list[ChatTarget]:
+        """送信先の候補を優先順に返す"""
+        targets = [primary]
+        for fallback in self.fallbacks:
+            if fallback not in targets:
+                targets.append(fallback)
+        return targets
+
+    def _next_available(self, targets: list[ChatTarget], start: int) -> int | None:
+        for index in range(start, len(targets)):
+            if self.breaker(targets[index].provider).allow_request():
+                return index
+        return None
+
+    def _record_outcome(self, target: ChatTarget, latency: float, error: BaseException | None) -> None:
+        breaker = self.breaker(target.provider)
+        if error is None:
+            self._latency_window(target).add(latency)
+            breaker.record_success()
+        elif is_provider_failure(error):
+            breaker.record_failure()
+        else:
+            breaker.release()
+
+    def _remaining_delay(self, target: ChatTarget, launched_at: float, hedges: int) -> float | None:
+        """最後にリクエストを送ってから、次の重複リクエストを送るまでの残り時間。ヘッジしない場合はNone"""
+        if hedges >= self.max_hedges:
+            return None
+        delay = self.hedge_delay(target)
+        if delay is None:
+            return None
+        return max(0.0, launched_at + delay - time.monotonic())
+
+    def _record_tokens(self, result: tuple, is_hedge: bool, wasted: bool) -> None:
+        with self._lock:
+            if is_hedge:
+                self.hedged_tokens += result[3]
+            if wasted:
+                self.wasted_tokens += result[3]
+
+    def call(self, send: Callable[[ChatTarget], tuple], primary: ChatTarget) -> tuple[ChatTarget, tuple]:
+        """sendを送信先ごとにスレッドで実行し、最初に成功した (送信先, 結果) を返す
+
+        フォールバック先の応答はプライマリとは別のモデルの出力のため、呼び出し側で区別できるよう送信先も返す。
+        負けたリクエストのスレッドは止められないため完了まで動き続け、そのトークン使用量はwasted_tokensに数える。
+        """
+        with self._lock:
+            self.requests += 1
+        targets = self.targets(primary)
+        next_index = self._next_available(targets, 0)
+        if next_index is None:
+            raise ProviderUnavailableError(f"all providers are unavailable: {[t.name for t in targets]}")
+
+        # Future -> (送信先, ヘッジかどうか)
+        in_flight: dict[Future, tuple[ChatTarget, bool]] = {}
+        hedges = 0
+        launched_at = time.monotonic()
+        last_error: BaseException | None = None
+
+        def launch(index: int, is_hedge: bool) -> None:
+            nonlocal launched_at
+            launched_at = time.monotonic()
+            target = targets[index]
+            future: Future = Future()
+
+            def run():
+                started_at = time.monotonic()
+                try:
+                    result = send(target)
+                except BaseException as e:
+                    self._record_outcome(target, time.monotonic() - started_at, e)
+                    future.set_exception(e)
+                else:
+                    self._record_outcome(target, time.monotonic() - started_at, None)
+                    future.set_result(result)
+
+            threading.Thread(target=run, daemon=True).start()
+            in_flight[future] = (target, is_hedge)
+
+        first_target = targets[next_index]
+        launch(next_index, is_hedge=False)
+        next_index += 1
+        while in_flight:
+            delay = self._remaining_delay(first_target, launched_at, hedges)
+            done, _ = wait(in_flight, timeout=delay, return_when=FIRST_COMPLETED)
+
+            if not done:
+                # 待ち時間を過ぎたため、次のフォールバック先(なければ最初の送信先)に重複リクエストを送る
+                hedge_index = self._next_available(targets, next_index)
+                if hedge_index is not None:
+                    next_index = hedge_index + 1
+                elif self.breaker(targets[0].provider).allow_request():
+                    hedge_index = 0
+                hedges += 1
+                if hedge_index is not None:
+                    with self._lock:
+                        self.hedged_requests += 1
+                    launch(hedge_index, is_hedge=True)
+                continue
+
+            for future in done:
+                target, is_hedge = in_flight.pop(future)
+                if future.exception() is None:
+                    result = future.result()
+                    self._record_tokens(result, is_hedge, wasted=False)
+                    if is_hedge:
+                        with self._lock:
+                            self.hedge_wins += 1
+                    for loser, (_, loser_is_hedge) in in_flight.items():
+                        loser.add_done_callback(
+                            lambda f, h=loser_is_hedge: (
+                                self._record_tokens(f.result(), h, wasted=True) if f.exception() is None else None
+                            )
+                        )
+                    return target, result
+                last_error = future.exception()
+                logging.warning(f"Chat request to {target.name} failed: {last_error}")
+
+            if not in_flight:
+                # 実行中のリクエストがすべて失敗した場合は、次のフォールバック先に切り替える
+                failover_index = self._next_available(targets, next_index)
+                if failover_index is not None:
+                    logging.warning(f"Failing over to {targets[failover_index].name}")
+                    with self._lock:
+                        self.failovers += 1
+                    next_index = failover_index + 1
+                    launch(failover_index, is_hedge=False)
+
+        raise last_error
+
+    async def call_async(
+        self, send: Callable[[ChatTarget], Awaitable[tuple]], primary: ChatTarget
+    ) -> tuple[ChatTarget, tuple]:
+        """callの非同期版。負けたリクエストはキャンセルする"""
+        with self._lock:
+            self.requests += 1
+        targets = self.targets(primary)
+        next_index = self._next_available(targets, 0)
+        if next_index is None:
+            raise ProviderUnavailableError(f"all providers are unavailable: {[t.name for t in targets]}")
+
+        in_flight: dict[asyncio.Task, tuple[ChatTarget, bool]] = {}
+        hedges = 0
+        launched_at = time.monotonic()
+        last_error: BaseException | None = None
+
+        async def run(target: ChatTarget) -> tuple:
+            started_at = time.monotonic()
+            try:
+                result = await send(target)
+            except asyncio.CancelledError:
+                self.breaker(target.provider).release()
+                raise
+            except BaseException as e:
+                self._record_outcome(target, time.monotonic() - started_at, e)
+                raise
+            self._record_outcome(target, time.monotonic() - started_at, None)
+            return result
+
+        def launch(index: int, is_hedge: bool) -> None:
+            nonlocal launched_at
+            launched_at = time.monotonic()
+            in_flight[asyncio.ensure_future(run(targets[index]))] = (targets[index], is_hedge)
+
+        first_target = targets[next_index]
+        launch(next_index, is_hedge=False)
+        next_index += 1
+        try:
+            while in_flight:
+                delay = self._remaining_delay(first_target, launched_at, hedges)
+                done, _ = await asyncio.wait(in_flight, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    hedge_index = self._next_available(targets, next_index)
+                    if hedge_index is not None:
+                        next_index = hedge_index + 1
+                    elif self.breaker(targets[0].provider).allow_request():
+                        hedge_index = 0
+                    hedges += 1
+                    if hedge_index is not None:
+                        with self._lock:
+                            self.hedged_requests += 1
+                        launch(hedge_index, is_hedge=True)
+                    continue
+
+                for task in done:
+                    target, is_hedge = in_flight.pop(task)
+                    if task.exception() is None:
+                        result = task.result()
+                        self._record_tokens(result, is_hedge, wasted=False)
+                        if is_hedge:
+                            with self._lock:
+                                self.hedge_wins += 1
+                        return target, result
+                    last_error = task.exception()
+                    logging.warning(f"Chat request to {target.name} failed: {last_error}")
+
+                if not in_flight:
+                    failover_index = self._next_available(targets, next_index)
+                    if failover_index is not None:
+                        logging.warning(f"Failing over to {targets[failover_index].name}")
+                        with self._lock:
+                            self.failovers += 1
+                        next_index = failover_index + 1
+                        launch(failover_index, is_hedge=False)
+            raise last_error
+        finally:
+            # 負けたリクエストは応答を待たずにキャンセルする
+            for task in in_flight:
+                task.cancel()
+            with self._lock:
+                self.cancelled_requests += len(in_flight)
+
+    def stats(self) -> dict:
+        with self._lock:
+            breakers = dict(self._breakers)
+            stats = {
+                "requests": self.requests,
+                "hedged_requests": self.hedged_requests,
+                "hedge_wins": self.hedge_wins,
+                "failovers": self.failovers,
+                "cancelled_requests": self.cancelled_requests,
+                "hedged_tokens": self.hedged_tokens,
+                "wasted_tokens": self.wasted_tokens,
+            }
+        stats["circuit_breakers"] = {
+            provider: {"state": breaker.state, "opened": breaker.opened, "rejected": breaker.rejected}
+            for provider, breaker in breakers.items()
+        }
+        return stats
+
+
+_hedging_policy: HedgingPolicy | None = None
+
+
+def configure_hedging(hedging_config: dict | None) -> None:
+    """request_to_chat_aiのヘッジ・フォールバックの設定を行う
+
+    Args:
+        hedging_config: configの"hedging"の値。Noneまたはenabled=Falseの場合は無効化する
+            - percentile: 重複リクエストを送るまでの待ち時間とする、直近のレイテンシのパーセンタイル
+            - min_samples: ヘッジを始めるまでに必要な成功リクエスト数
+            - min_delay: 重複リクエストを送るまでの最短の待ち時間(秒)
+            - max_hedges: 1リクエストあたりの重複リクエストの最大数
+            - fallbacks: 重複リクエスト・切り替え先の {"provider", "model", "local_llm_address"} のリスト
+            - circuit_breaker: {"failure_threshold": 連続失敗の回数, "reset_timeout": 送信を止める秒数}
+    """
+    global _hedging_policy
+    if not hedging_config or not hedging_config.get("enabled", True):
+        _hedging_policy = None
+        return
+    breaker_config = hedging_config.get("circuit_breaker", {})
+    _hedging_policy = HedgingPolicy(
+        percentile=hedging_config.get("percentile", DEFAULT_HEDGE_PERCENTILE),
+        min_samples=hedging_config.get("min_samples", DEFAULT_MIN_SAMPLES),
+        min_delay=hedging_config.get("min_delay", DEFAULT_MIN_HEDGE_DELAY),
+        max_hedges=hedging_config.get("max_hedges", DEFAULT_MAX_HEDGES),
+        fallbacks=[
+            ChatTarget(fallback["provider"], fallback["model"], fallback.get("local_llm_address"))
+            for fallback in hedging_config.get("fallbacks", [])
+        ],
+        failure_threshold=breaker_config.get("failure_threshold", DEFAULT_FAILURE_THRESHOLD),
+        reset_timeout=breaker_config.get("reset_timeout", DEFAULT_RESET_TIMEOUT),
+    )
+
+
+def get_hedging_policy() -> HedgingPolicy | None:
+    return _hedging_policy
+
+
+def get_hedging_stats() -> dict | None:
+    """ヘッジ・フォールバックの回数とトークン使用量を返す。無効な場合はNone"""
+    if _hedging_policy is None:
+        return None
+    return _hedging_policy.stats()
@@ -0,0 +1,118 @@
+"""KMeansの重心に対するWard法の樹形図(linkage)を保存し、任意のクラスタ数で切り直す
+
+樹形図は重心の数(最下層のクラスタ数)の大きさしかないため、一度計算して保存しておけば、
+上位の階層をいくつ・何クラスタで作るかは、UMAPやKMeansをやり直さずに即座に変えられる。
+
+    cd server/broadlistening/pipeline
+    python -m services.hierarchy_tree outputs/{dataset} --cluster-nums 2 4 8 16 --output cuts.csv
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.cluster.hierarchy as sch
+
+HIERARCHY_TREE_FILENAME = "hierarchical_linkage.npz"
+
+
+def build_hierarchy_tree(cluster_centers: np.ndarray) -> np.ndarray:
+    """KMeansの重心からWard法の樹形図(scipyのlinkage行列)を作る"""
+    return sch.linkage(cluster_centers, method="ward")
+
+
+def cut_hierarchy(linkage: np.ndarray, kmeans_labels: np.ndarray, n_cluster_cut: int) -> np.ndarray:
+    """樹形図をn_cluster_cut個のクラスタに切り、各意見の所属クラスタ(1始まり)を返す
+
+    重心ごとの所属クラスタを、意見ごとのKMeansのラベルでまとめて引く。
+    """
+    merged = sch.fcluster(linkage, t=n_cluster_cut, criterion="maxclust")
+    return merged[kmeans_labels]
+
+
+def hierarchy_levels(linkage: np.ndarray, kmeans_labels: np.ndarray, cluster_nums: list[int]) -> dict[int, np.ndarray]:
+    """cluster_numsの各クラスタ数で切った所属クラスタを、クラスタ数の少ない順に返す
+
+    最も多いクラスタ数(最下層)はKMeansのラベルそのものとする。
+    """
+    n_clusters = len(linkage) + 1
+    cluster_nums = sorted(cluster_nums)
+    if cluster_nums[-1] != n_clusters:
+        raise ValueError(f"The largest cluster number {cluster_nums[-1]} must be the KMeans cluster count {n_clusters}")
+    levels = {
+        n_cluster_cut: cut_hierarchy(linkage, kmeans_labels, n_cluster_cut) for n_cluster_cut in cluster_nums[:-1]
+    }
+    levels[n_clusters] = np.asarray(kmeans_labels)
+    return levels
+
+
+def save_hierarchy_tree(
+    path: str, linkage: np.ndarray, kmeans_labels: np.ndarray, fingerprint: str, params: dict
+) -> None:
+    """樹形図と意見ごとのKMeansのラベルを、UMAPの座標のフィンガープリントとKMeansのパラメータと一緒に保存する"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            linkage=linkage,
+            kmeans_labels=np.asarray(kmeans_labels),
+            fingerprint=np.array(fingerprint),
+            params=np.array(json.dumps(params, sort_keys=True)),
+        )
+    os.replace(tmp_path, path)
+
+
+def load_hierarchy_tree(
+    path: str, fingerprint: str | None = None, params: dict | None = None
+) -> tuple[np.ndarray, np.ndarray] | None:
+    """保存した(樹形図, 意見ごとのKMeansのラベル)を返す
+
+    fingerprint・paramsを指定した場合は、保存時と異なればNoneを返す。
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if fingerprint is not None and str(data["fingerprint"]) != fingerprint:
+            return None
+        if params is not None and str(data["params"]) != json.dumps(params, sort_keys=True):
+            return None
+        return data["linkage"], data["kmeans_labels"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Cut the saved hierarchy tree of a report into additional levels without re-clustering."
+    )
+    parser.add_argument("output_dir", help="e.g. outputs/{dataset}")
+    parser.add_argument("--cluster-nums", type=int, nargs="+", required=True, help="cluster counts of the levels")
+    parser.add_argument("--output", default=None, help="CSV to write arg-id and cluster-level-n-id columns to")
+    args = parser.parse_args()
+
+    tree = load_hierarchy_tree(os.path.join(args.output_dir, HIERARCHY_TREE_FILENAME))
+    if tree is None:
+        raise SystemExit(
+            f"{HIERARCHY_TREE_FILENAME} not found in {args.output_dir}. Run hierarchical_clustering first."
+        )
+    linkage = tree[0]
+    # --appendで追加した意見も含めるため、KMeansのラベルはhierarchical_clusters.csvの最下層のクラスタIDから引く
+    clusters = pd.read_csv(os.path.join(args.output_dir, "hierarchical_clusters.csv"))
+    bottom_column = [col for col in clusters.columns if col.startswith("cluster-level-")][-1]
+    kmeans_labels = clusters[bottom_column].str.split("_").str[1].astype(int).to_numpy()
+    cluster_nums = sorted(set(args.cluster_nums) | {len(linkage) + 1})
+    levels = hierarchy_levels(linkage, kmeans_labels, cluster_nums)
+    for level, (n_clusters, labels) in enumerate(levels.items(), start=1):
+        sizes = np.bincount(labels)
+        print(f"level {level}: {n_clusters} clusters, sizes {sorted(sizes[sizes > 0].tolist(), reverse=True)}")
+
+    if args.output:
+        result = clusters[["arg-id"]].copy()
+        for level, labels in enumerate(levels.values(), start=1):
+            result[f"cluster-level-{level}-id"] = [f"{level}_{label}" for label in labels]
+        result.to_csv(args.output, index=False)
+        print(f"Wrote {len(levels)} levels to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
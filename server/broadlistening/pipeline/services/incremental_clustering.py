@@ -0,0 +1,97 @@
+"""公開済みのレポートに新しい意見を追加する--appendモードのクラスタリング処理
+
+既存の意見の座標・クラスタはそのままにして、新しい意見だけを既存のUMAPの空間に射影し、
+既存のクラスタに割り当てる。所属する意見が大きく変わったクラスタだけをラベリングし直す。
+"""
+
+import numpy as np
+import pandas as pd
+
+APPEND_STATUS_KEY = "hierarchical_append"
+
+
+def is_append_mode(config: dict) -> bool:
+    return bool(config.get("append", False))
+
+
+def cluster_id_columns(df: pd.DataFrame) -> list[str]:
+    """cluster-level-n-idのカラムを上位の階層から順に返す"""
+    columns = [col for col in df.columns if col.startswith("cluster-level-") and col.endswith("-id")]
+    return sorted(columns, key=lambda col: int(col.replace("cluster-level-", "").replace("-id", "")))
+
+
+def cluster_centroids(previous_df: pd.DataFrame, bottom_column: str) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """最下層のクラスタごとの重心と件数を返す
+
+    KMeansの重心は所属する意見の座標の平均なので、hierarchical_clusters.csvの座標から求め直せる。
+
+    Returns:
+        (クラスタIDのリスト, (クラスタ数, 2)の重心, クラスタごとの件数)
+    """
+    grouped = previous_df.groupby(bottom_column)[["x", "y"]]
+    centroids = grouped.mean()
+    sizes = grouped.size().loc[centroids.index]
+    return centroids.index.tolist(), centroids.to_numpy(dtype=np.float64), sizes.to_numpy(dtype=np.float64)
+
+
+def assign_to_centroids(
+    coordinates: np.ndarray, centroids: np.ndarray, sizes: np.ndarray, refine: bool = False
+) -> tuple[np.ndarray, np.ndarray]:
+    """新しい意見を最も近い重心のクラスタに割り当てる
+
+    refine=Trueの場合は、既存の意見を重心に件数分の重みを付けた点として含めたMiniBatchKMeansを1ステップ実行し、
+    新しい意見を取り込んで動いた重心で割り当て直す。既存の意見の所属は変えない。
+
+    Returns:
+        (新しい意見ごとのクラスタのインデックス, 割り当てに使った重心)
+    """
+    if len(coordinates) == 0:
+        return np.zeros(0, dtype=int), centroids
+    if refine:
+        from sklearn.cluster import MiniBatchKMeans
+
+        model = MiniBatchKMeans(
+            n_clusters=len(centroids), init=centroids, n_init=1, reassignment_ratio=0.0, random_state=42
+        )
+        model.partial_fit(
+            np.vstack([centroids, coordinates]),
+            sample_weight=np.concatenate([sizes, np.ones(len(coordinates))]),
+        )
+        centroids = model.cluster_centers_
+    distances = ((coordinates[:, None, :] - centroids[None, :, :]) ** 2).sum(axis=2)
+    return distances.argmin(axis=1), centroids
+
+
+def upper_level_mapping(previous_df: pd.DataFrame, columns: list[str]) -> pd.DataFrame:
+    """最下層のクラスタIDから上位の階層のクラスタIDへの対応表(最下層のIDがインデックス)を返す"""
+    return previous_df[columns].drop_duplicates(subset=columns[-1]).set_index(columns[-1])
+
+
+def find_relabel_clusters(
+    previous_df: pd.DataFrame, current_df: pd.DataFrame, columns: list[str], threshold: float
+) -> dict[str, list[str]]:
+    """追加・削除された意見の数が、以前の件数のthresholdの割合を超えたクラスタを階層ごとに返す
+
+    以前は存在しなかったクラスタも対象にする。arg-idが同じでも本文が変わった意見は、削除と追加として数える。
+    """
+    relabel = {}
+    previous_keys = pd.MultiIndex.from_frame(previous_df[["arg-id", "argument"]])
+    current_keys = pd.MultiIndex.from_frame(current_df[["arg-id", "argument"]])
+    added = current_df[~current_keys.isin(previous_keys)]
+    removed = previous_df[~previous_keys.isin(current_keys)]
+    for column in columns:
+        previous_sizes = previous_df[column].value_counts()
+        changes = added[column].value_counts().add(removed[column].value_counts(), fill_value=0)
+        relabel[column] = sorted(
+            str(cluster_id)
+            for cluster_id, change in changes.items()
+            if cluster_id in current_df[column].values and change > threshold * previous_sizes.get(cluster_id, 0)
+        )
+    return relabel
+
+
+def relabel_targets(config: dict, column: str) -> set[str] | None:
+    """--appendモードでラベリングし直すクラスタIDを返す。--appendモードでない場合はNone"""
+    if not is_append_mode(config):
+        return None
+    return set(config[APPEND_STATUS_KEY]["relabel"].get(column, []))
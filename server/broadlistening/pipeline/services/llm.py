@@ -1,12 +1,26 @@
+import asyncio
+import atexit
+import contextvars
 import logging
 import os
 import threading
+import time
+from collections.abc import Callable
+from functools import partial
 
 import openai
 from dotenv import load_dotenv
-from openai import AzureOpenAI, OpenAI
+from openai import AsyncAzureOpenAI, AsyncOpenAI, AzureOpenAI, OpenAI
 from pydantic import BaseModel
 from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+from tqdm import tqdm
+
+from .adaptive_concurrency import AdaptiveConcurrencyController, report_request_outcome, run_in_sliding_window
+from .embedding_cache import DEFAULT_EMBEDDING_CACHE_MAX_SIZE_MB, DEFAULT_EMBEDDING_CACHE_PATH, EmbeddingCache
+from .hedging import ChatTarget, get_hedging_policy
+from .llm_cache import DEFAULT_LLM_CACHE_MAX_SIZE_MB, DEFAULT_LLM_CACHE_PATH, LLMResponseCache, build_cache_key
+from .llm_clients import get_llm_client
+from .rate_limiter import DEFAULT_EXPECTED_OUTPUT_TOKENS, RateLimiter, get_rate_limiter
 
 DOTENV_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../../.env"))
 load_dotenv(DOTENV_PATH)
@@ -33,10 +47,55 @@ if use_azure == "true":
         raise RuntimeError("AZURE_EMBEDDING_DEPLOYMENT_NAME environment variable is not set")
 
 
+class _RateLimitReservation:
+    """1件のチャットリクエストが予約したRPM/TPMの予算
+
+    各プロバイダーの関数はレート制限エラーをtenacityでリトライするため、リトライの試行ごとに予算を予約し直す。
+    失敗した試行は出力を生成していないため、入力の見積もり分だけを使ったものとして精算する。
+    """
+
+    def __init__(self, limiter: RateLimiter, messages: list[dict]):
+        self.limiter = limiter
+        self.input_tokens = estimate_messages_tokens(messages)
+        self.reserved_tokens = self.input_tokens + DEFAULT_EXPECTED_OUTPUT_TOKENS
+
+    def acquire(self) -> None:
+        self.limiter.acquire(self.reserved_tokens)
+
+    async def acquire_async(self) -> None:
+        await self.limiter.acquire_async(self.reserved_tokens)
+
+    def settle(self, actual_tokens: int | None = None) -> None:
+        """予約を精算する。actual_tokensがNoneの場合は、失敗した試行として入力の見積もり分で精算する"""
+        self.limiter.settle(self.reserved_tokens, self.input_tokens if actual_tokens is None else actual_tokens)
+
+
+# request_to_chat_aiが送信中のリクエストの予約。プロバイダーの関数のリトライから参照する
+_current_reservation: contextvars.ContextVar[_RateLimitReservation | None] = contextvars.ContextVar(
+    "current_rate_limit_reservation", default=None
+)
+
+
+def _reserve_retry_attempt(retry_state) -> None:
+    """tenacityのbefore: リトライする試行の前に、失敗した試行の予約を精算して予算を予約し直す"""
+    reservation = _current_reservation.get()
+    if reservation is not None and retry_state.attempt_number > 1:
+        reservation.settle()
+        reservation.acquire()
+
+
+async def _reserve_retry_attempt_async(retry_state) -> None:
+    reservation = _current_reservation.get()
+    if reservation is not None and retry_state.attempt_number > 1:
+        reservation.settle()
+        await reservation.acquire_async()
+
+
 @retry(
     retry=retry_if_exception_type(openai.RateLimitError),
     wait=wait_exponential(multiplier=3, min=3, max=20),
     stop=stop_after_attempt(3),
+    before=_reserve_retry_attempt,
     reraise=True,
 )
 def request_to_openai(
@@ -109,6 +168,7 @@ def request_to_openai(
     retry=retry_if_exception_type(openai.RateLimitError),
     wait=wait_exponential(multiplier=1, min=2, max=20),
     stop=stop_after_attempt(3),
+    before=_reserve_retry_attempt,
     reraise=True,
 )
 def request_to_azure_chatcompletion(
@@ -124,7 +184,8 @@ def request_to_azure_chatcompletion(
     token_usage_output = 0  # 出力トークン使用量を追跡する変数
     token_usage_total = 0  # 合計トークン使用量を追跡する変数
 
-    client = AzureOpenAI(
+    client = get_llm_client(
+        AzureOpenAI,
         api_version=api_version,
         azure_endpoint=azure_endpoint,
         api_key=api_key,
@@ -190,6 +251,21 @@ def request_to_azure_chatcompletion(
         raise
 
 
+def _local_llm_base_url(address: str) -> str:
+    try:
+        if ":" in address:
+            host, port_str = address.split(":")
+            port = int(port_str)
+        else:
+            host = address
+            port = 11434  # デフォルトポート
+    except ValueError:
+        logging.warning(f"Invalid address format: {address}, using default")
+        host = "localhost"
+        port = 11434
+    return f"http://{host}:{port}/v1"
+
+
 def request_to_local_llm(
     messages: list[dict],
     model: str,
@@ -214,22 +290,11 @@ def request_to_local_llm(
     token_usage_input = 0  # 入力トークン使用量を追跡する変数
     token_usage_output = 0  # 出力トークン使用量を追跡する変数
     token_usage_total = 0  # 合計トークン使用量を追跡する変数
-    try:
-        if ":" in address:
-            host, port_str = address.split(":")
-            port = int(port_str)
-        else:
-            host = address
-            port = 11434  # デフォルトポート
-    except ValueError:
-        logging.warning(f"Invalid address format: {address}, using default")
-        host = "localhost"
-        port = 11434
-
-    base_url = f"http://{host}:{port}/v1"
+    base_url = _local_llm_base_url(address)
 
     try:
-        client = OpenAI(
+        client = get_llm_client(
+            OpenAI,
             base_url=base_url,
             api_key="not-needed",  # OllamaとLM Studioは認証不要
         )
@@ -276,6 +341,77 @@ def request_to_local_llm(
         raise
 
 
+def estimate_tokens(text: str) -> int:
+    """トークン数を簡易的に見積もる
+
+    トークナイザーを使わずに、ASCII文字は4文字で1トークン、それ以外(日本語など)は1文字1トークンとして数える。
+    リクエストの分割やレート制限の見積もりに使う目安であり、実際のトークン数とは一致しない。
+    """
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+
+def estimate_messages_tokens(messages: list[dict]) -> int:
+    return sum(estimate_tokens(str(message.get("content", ""))) for message in messages)
+
+
+def pack_by_token_budget(texts: list[str], token_budget: int, max_items: int) -> list[list[int]]:
+    """連続するテキストを、推定トークン数の合計がtoken_budget以下・max_items件以下になるようにまとめる
+
+    1件でtoken_budgetを超えるテキストは単独にする。並び順は入力順のまま保つ。
+
+    Returns:
+        まとめたテキストのインデックスのリスト
+    """
+    packs: list[list[int]] = []
+    current: list[int] = []
+    current_tokens = 0
+    for i, text in enumerate(texts):
+        tokens = estimate_tokens(str(text))
+        if current and (current_tokens + tokens > token_budget or len(current) >= max_items):
+            packs.append(current)
+            current, current_tokens = [], 0
+        current.append(i)
+        current_tokens += tokens
+    if current:
+        packs.append(current)
+    return packs
+
+
+_llm_cache: LLMResponseCache | None = None
+
+
+def configure_llm_cache(cache_config: dict | None) -> None:
+    """request_to_chat_aiのレスポンスキャッシュを設定する
+
+    全ステップが temperature=0, seed=0 でリクエストしているため、同一リクエストのレスポンスを再利用しても
+    結果は変わらない。再実行時(-fやクラッシュ後の再開など)のAPI呼び出しを省略するために使う。
+
+    Args:
+        cache_config: configの"llm_cache"の値。Noneまたはenabled=Falseの場合はキャッシュを無効化する
+            - enabled: キャッシュを有効にするかどうか
+            - path: SQLiteファイルのパス
+            - max_size_mb: キャッシュの最大サイズ(MB)。超えた場合は参照が古いものから削除する
+    """
+    global _llm_cache
+    if _llm_cache is not None:
+        _llm_cache.close()
+        _llm_cache = None
+    if not cache_config or not cache_config.get("enabled", True):
+        return
+    _llm_cache = LLMResponseCache(
+        path=cache_config.get("path", DEFAULT_LLM_CACHE_PATH),
+        max_size_mb=cache_config.get("max_size_mb", DEFAULT_LLM_CACHE_MAX_SIZE_MB),
+    )
+
+
+def get_llm_cache_stats() -> dict | None:
+    """キャッシュのヒット数・ミス数などを返す。キャッシュが無効な場合はNone"""
+    if _llm_cache is None:
+        return None
+    return _llm_cache.stats()
+
+
 def request_to_chat_ai(
     messages: list[dict],
     model: str = "gpt-4o",
@@ -283,6 +419,7 @@ def request_to_chat_ai(
     json_schema: dict | type[BaseModel] | None = None,
     provider: str = "openai",
     local_llm_address: str | None = None,
+    validate: Callable[[str | dict], object] | None = None,
 ) -> tuple[str, int, int, int]:  # 戻り値を文字列とトークン使用量(入力・出力・合計)のタプルに変更
     """AIプロバイダーにチャットリクエストを送信する関数
 
@@ -293,6 +430,8 @@ def request_to_chat_ai(
         json_schema: JSONスキーマ（Pydanticモデルまたは辞書）
         provider: 使用するプロバイダー（"openai", "azure", "local", "openrouter"）
         local_llm_address: ローカルLLMのアドレス（provider="local"の場合のみ使用）
+        validate: レスポンスを検証する関数。使えないレスポンスの場合はValueErrorを送出する。
+            検証を通ったレスポンスだけをキャッシュし、検証を通らないキャッシュは使わずにリクエストし直す
 
     Returns:
         AIからのレスポンスとトークン使用量(入力・出力・合計)のタプル
@@ -302,7 +441,96 @@ def request_to_chat_ai(
         - provider="azure": Azure OpenAI APIを使用
         - provider="local": ローカルLLM（OllamaやLM Studio）を使用
         - provider="openrouter": OpenRouter APIを使用（OpenAIやGeminiのモデルにアクセス可能）
+        - configure_llm_cacheでキャッシュが有効化されている場合、同一リクエストはキャッシュから返す
+        - configure_rate_limitsでレート制限が設定されている場合、RPM/TPMの予算が空くまで待ってから送信する
+        - configure_hedgingでヘッジが有効化されている場合、遅いリクエストには重複リクエストを送り、
+          失敗したリクエストはフォールバック先に送り直す
+        - run_in_sliding_windowのタスク内で呼ばれた場合、レイテンシとエラーを同時実行数の調整に通知する
     """
+    cache_key = None
+    if _llm_cache is not None:
+        cache_key = build_cache_key(provider, model, messages, is_json, json_schema, local_llm_address)
+        cached = _llm_cache.get(cache_key)
+        if cached is not None and _is_valid_response(cached[0], validate):
+            # キャッシュヒット時はAPIを呼んでいないため、トークン使用量は0として返す
+            return cached[0], 0, 0, 0
+
+    def send(target: ChatTarget) -> tuple[str, int, int, int]:
+        # プロセス全体で共有するRPM/TPMの予算を予約してから送信し、完了後に実際のトークン使用量で精算する
+        limiter = get_rate_limiter(target.provider, target.model)
+        if limiter is None:
+            return _dispatch_chat_request(
+                messages, target.model, is_json, json_schema, target.provider, target.local_llm_address
+            )
+        reservation = _RateLimitReservation(limiter, messages)
+        reservation.acquire()
+        context_token = _current_reservation.set(reservation)
+        actual_tokens = None
+        try:
+            result = _dispatch_chat_request(
+                messages, target.model, is_json, json_schema, target.provider, target.local_llm_address
+            )
+            actual_tokens = result[3]
+        finally:
+            _current_reservation.reset(context_token)
+            reservation.settle(actual_tokens)
+        return result
+
+    # workers="auto"で実行中の場合、レイテンシとエラーを同時実行数の調整に使う
+    hedging_policy = get_hedging_policy()
+    primary = ChatTarget(provider, model, local_llm_address)
+    started_at = time.monotonic()
+    try:
+        target, result = (primary, send(primary)) if hedging_policy is None else hedging_policy.call(send, primary)
+    except Exception as e:
+        report_request_outcome(time.monotonic() - started_at, e)
+        raise
+    report_request_outcome(time.monotonic() - started_at)
+
+    if validate is not None:
+        # 検証を通らないレスポンスをキャッシュすると、再試行しても同じレスポンスが返り続けるため保存しない
+        validate(result[0])
+    if cache_key is not None and result[0]:
+        _llm_cache.set(_response_cache_key(cache_key, primary, target, messages, is_json, json_schema), result)
+    return result
+
+
+def _is_valid_response(response: str | dict, validate: Callable[[str | dict], object] | None) -> bool:
+    if validate is None:
+        return True
+    try:
+        validate(response)
+    except ValueError as e:
+        logging.warning(f"Ignoring cached response that failed validation: {e}")
+        return False
+    return True
+
+
+def _response_cache_key(
+    cache_key: str,
+    primary: ChatTarget,
+    target: ChatTarget,
+    messages: list[dict],
+    is_json: bool,
+    json_schema: dict | type[BaseModel] | None,
+) -> str:
+    """応答を保存するキャッシュキー
+
+    フォールバック先が応答した場合は、プライマリのキーに別のモデルの出力を保存しないよう、応答した送信先のキーにする。
+    """
+    if target == primary:
+        return cache_key
+    return build_cache_key(target.provider, target.model, messages, is_json, json_schema, target.local_llm_address)
+
+
+def _dispatch_chat_request(
+    messages: list[dict],
+    model: str,
+    is_json: bool,
+    json_schema: dict | type[BaseModel] | None,
+    provider: str,
+    local_llm_address: str | None,
+) -> tuple[str, int, int, int]:
     if provider == "azure":
         return request_to_azure_chatcompletion(messages, is_json, json_schema)
     elif provider == "openai":
@@ -317,6 +545,173 @@ def request_to_chat_ai(
         raise ValueError(f"Unknown provider: {provider}")
 
 
+def _get_async_client(provider: str, local_llm_address: str | None = None, embedding: bool = False) -> AsyncOpenAI:
+    """プロバイダーに対応する非同期クライアントを返す。クライアントはget_llm_clientで使い回す"""
+    if provider == "openai":
+        return get_llm_client(AsyncOpenAI, is_async=True)
+    elif provider == "azure":
+        prefix = "AZURE_EMBEDDING" if embedding else "AZURE_CHATCOMPLETION"
+        return get_llm_client(
+            AsyncAzureOpenAI,
+            is_async=True,
+            api_version=os.getenv(f"{prefix}_VERSION"),
+            azure_endpoint=os.getenv(f"{prefix}_ENDPOINT"),
+            api_key=os.getenv(f"{prefix}_API_KEY"),
+        )
+    elif provider == "openrouter":
+        api_key = os.getenv("OPENROUTER_API_KEY")
+        if not api_key:
+            raise RuntimeError("OPENROUTER_API_KEY environment variable is not set")
+        return get_llm_client(AsyncOpenAI, is_async=True, base_url="https://openrouter.ai/api/v1", api_key=api_key)
+    elif provider == "local":
+        return get_llm_client(
+            AsyncOpenAI,
+            is_async=True,
+            base_url=_local_llm_base_url(local_llm_address or "localhost:11434"),
+            api_key="not-needed",  # OllamaとLM Studioは認証不要
+        )
+    else:
+        raise ValueError(f"Unknown provider: {provider}")
+
+
+@retry(
+    retry=retry_if_exception_type(openai.RateLimitError),
+    wait=wait_exponential(multiplier=3, min=3, max=20),
+    stop=stop_after_attempt(3),
+    before=_reserve_retry_attempt_async,
+    reraise=True,
+)
+async def _request_chat_completion_async(
+    messages: list[dict],
+    model: str,
+    is_json: bool,
+    json_schema: dict | type[BaseModel] | None,
+    provider: str,
+    local_llm_address: str | None,
+) -> tuple[str | dict, int, int, int]:
+    """各プロバイダーの同期版のリクエスト関数と同じパラメータ・戻り値で、非同期クライアントからリクエストする"""
+    client = _get_async_client(provider, local_llm_address)
+    if provider == "azure":
+        model = os.getenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME")
+    is_pydantic = isinstance(json_schema, type) and issubclass(json_schema, BaseModel)
+
+    try:
+        if is_pydantic and provider != "local":
+            response = await client.beta.chat.completions.parse(
+                model=model,
+                messages=messages,
+                temperature=0,
+                n=1,
+                seed=0,
+                response_format=json_schema,
+                timeout=30,
+            )
+            message = response.choices[0].message
+            # Azureの同期版はパース済みのdictを返しているため、それに合わせる
+            content = message.parsed.model_dump() if provider == "azure" else message.content
+        else:
+            response_format = None
+            if is_json:
+                response_format = {"type": "json_object"}
+            if is_pydantic:
+                response_format = {
+                    "type": "json_schema",
+                    "json_schema": {"name": json_schema.__name__, "strict": True, "schema": json_schema.schema()},
+                }
+            elif json_schema:  # 両方有効化されていたら、json_schemaを優先
+                response_format = json_schema
+
+            payload = {
+                "model": model,
+                "messages": messages,
+                "temperature": 0,
+                "n": 1,
+                "seed": 0,
+                "timeout": 30,
+            }
+            if response_format:
+                payload["response_format"] = response_format
+            response = await client.chat.completions.create(**payload)
+            content = response.choices[0].message.content
+    except openai.RateLimitError as e:
+        logging.warning(f"{provider} API rate limit hit: {e}")
+        raise
+    except openai.AuthenticationError as e:
+        logging.error(f"{provider} API authentication error: {str(e)}")
+        raise
+    except openai.BadRequestError as e:
+        logging.error(f"{provider} API bad request error: {str(e)}")
+        raise
+
+    if hasattr(response, "usage") and response.usage:
+        usage = response.usage
+        return content, usage.prompt_tokens or 0, usage.completion_tokens or 0, usage.total_tokens or 0
+    return content, 0, 0, 0
+
+
+async def request_to_chat_ai_async(
+    messages: list[dict],
+    model: str = "gpt-4o",
+    is_json: bool = False,
+    json_schema: dict | type[BaseModel] | None = None,
+    provider: str = "openai",
+    local_llm_address: str | None = None,
+    validate: Callable[[str | dict], object] | None = None,
+) -> tuple[str, int, int, int]:
+    """request_to_chat_aiの非同期版
+
+    引数・戻り値・キャッシュ・レート制限・ヘッジの扱いはrequest_to_chat_aiと同じ。
+    スレッドを使わずに多数のリクエストを同時に待てるよう、非同期クライアント(AsyncOpenAI)を使う。
+    非同期クライアントはイベントループに紐づくため、services.async_runnerのイベントループ上で呼び出すこと。
+    """
+    cache_key = None
+    if _llm_cache is not None:
+        cache_key = build_cache_key(provider, model, messages, is_json, json_schema, local_llm_address)
+        cached = _llm_cache.get(cache_key)
+        if cached is not None and _is_valid_response(cached[0], validate):
+            return cached[0], 0, 0, 0
+
+    async def send(target: ChatTarget) -> tuple[str, int, int, int]:
+        limiter = get_rate_limiter(target.provider, target.model)
+        if limiter is None:
+            return await _request_chat_completion_async(
+                messages, target.model, is_json, json_schema, target.provider, target.local_llm_address
+            )
+        reservation = _RateLimitReservation(limiter, messages)
+        await reservation.acquire_async()
+        context_token = _current_reservation.set(reservation)
+        actual_tokens = None
+        try:
+            result = await _request_chat_completion_async(
+                messages, target.model, is_json, json_schema, target.provider, target.local_llm_address
+            )
+            actual_tokens = result[3]
+        finally:
+            _current_reservation.reset(context_token)
+            reservation.settle(actual_tokens)
+        return result
+
+    hedging_policy = get_hedging_policy()
+    primary = ChatTarget(provider, model, local_llm_address)
+    started_at = time.monotonic()
+    try:
+        if hedging_policy is None:
+            target, result = primary, await send(primary)
+        else:
+            target, result = await hedging_policy.call_async(send, primary)
+    except Exception as e:
+        report_request_outcome(time.monotonic() - started_at, e)
+        raise
+    report_request_outcome(time.monotonic() - started_at)
+
+    if validate is not None:
+        # 検証を通らないレスポンスをキャッシュすると、再試行しても同じレスポンスが返り続けるため保存しない
+        validate(result[0])
+    if cache_key is not None and result[0]:
+        _llm_cache.set(_response_cache_key(cache_key, primary, target, messages, is_json, json_schema), result)
+    return result
+
+
 EMBDDING_MODELS = [
     "text-embedding-3-large",
     "text-embedding-3-small",
@@ -341,22 +736,11 @@ def request_to_local_llm_embed(args, model, address="localhost:11434"):
     Returns:
         埋め込みベクトルのリスト
     """
-    try:
-        if ":" in address:
-            host, port_str = address.split(":")
-            port = int(port_str)
-        else:
-            host = address
-            port = 11434  # デフォルトポート
-    except ValueError:
-        logging.warning(f"Invalid address format: {address}, using default")
-        host = "localhost"
-        port = 11434
-
-    base_url = f"http://{host}:{port}/v1"
+    base_url = _local_llm_base_url(address)
 
     try:
-        client = OpenAI(
+        client = get_llm_client(
+            OpenAI,
             base_url=base_url,
             api_key="not-needed",  # OllamaとLM Studioは認証不要
         )
@@ -370,60 +754,436 @@ def request_to_local_llm_embed(args, model, address="localhost:11434"):
         return request_to_local_embed(args)
 
 
-def request_to_embed(args, model, is_embedded_at_local=False, provider="openai", local_llm_address: str | None = None):
+_embedding_cache: EmbeddingCache | None = None
+
+
+def configure_embedding_cache(cache_config: dict | None) -> None:
+    """request_to_embedの埋め込みキャッシュを設定する
+
+    キャッシュはレポートをまたいで共有されるため、同じ意見を含む別のレポートや、
+    クラスタリングのパラメータだけを変えた再実行では埋め込みのAPI呼び出しが発生しない。
+
+    Args:
+        cache_config: configの"embedding_cache"の値。Noneまたはenabled=Falseの場合はキャッシュを無効化する
+            - enabled: キャッシュを有効にするかどうか
+            - path: SQLiteファイルのパス
+            - max_size_mb: キャッシュの最大サイズ(MB)。超えた場合は参照が古いものから削除する
+    """
+    global _embedding_cache
+    if _embedding_cache is not None:
+        _embedding_cache.close()
+        _embedding_cache = None
+    if not cache_config or not cache_config.get("enabled", True):
+        return
+    _embedding_cache = EmbeddingCache(
+        path=cache_config.get("path", DEFAULT_EMBEDDING_CACHE_PATH),
+        max_size_mb=cache_config.get("max_size_mb", DEFAULT_EMBEDDING_CACHE_MAX_SIZE_MB),
+    )
+
+
+def get_embedding_cache_stats() -> dict | None:
+    """埋め込みキャッシュのヒット数・ミス数などを返す。キャッシュが無効な場合はNone"""
+    if _embedding_cache is None:
+        return None
+    return _embedding_cache.stats()
+
+
+def _embedding_model_key(model, is_embedded_at_local, provider, local_llm_address, dimensions=None) -> str:
+    """埋め込みキャッシュのモデル部分のキー。同じモデル名でも提供元や次元数が異なればベクトルが異なるため区別する"""
+    if is_embedded_at_local:
+        return local_embedding_model_key()
+    if provider == "azure":
+        key = f"azure/{os.getenv('AZURE_EMBEDDING_DEPLOYMENT_NAME')}"
+    elif provider == "local":
+        key = f"local/{local_llm_address or 'localhost:11434'}/{model}"
+    else:
+        key = f"{provider}/{model}"
+    return f"{key}@{dimensions}" if dimensions else key
+
+
+def supports_embedding_dimensions(model, is_embedded_at_local=False, provider="openai") -> bool:
+    """プロバイダーが埋め込みの次元数の指定(dimensions)に対応しているかどうか
+
+    OpenAI・Azureのtext-embedding-3系のモデルだけが、短くした埋め込みを返せる。
+    """
+    return not is_embedded_at_local and provider in ("openai", "azure") and str(model).startswith("text-embedding-3")
+
+
+def _dimensions_kwargs(dimensions: int | None) -> dict:
+    return {"dimensions": dimensions} if dimensions else {}
+
+
+def _split_cached_embeddings(args, model_key: str) -> tuple[list, list, list[int]]:
+    """キャッシュを参照し、(全テキスト, キャッシュ済みのベクトル(ミスはNone), ミスしたテキストの位置)を返す"""
+    texts = [args] if isinstance(args, str) else list(args)
+    vectors = _embedding_cache.get_many(model_key, texts)
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    return texts, vectors, missing
+
+
+def _fill_cached_embeddings(texts: list, vectors: list, missing: list[int], embeds: list, model_key: str) -> list:
+    _embedding_cache.set_many(model_key, [texts[i] for i in missing], embeds)
+    for i, embed in zip(missing, embeds, strict=True):
+        vectors[i] = embed
+    return vectors
+
+
+def request_to_embed(
+    args,
+    model,
+    is_embedded_at_local=False,
+    provider="openai",
+    local_llm_address: str | None = None,
+    dimensions: int | None = None,
+):
+    """テキストの埋め込みを取得する。埋め込みキャッシュが有効な場合は、キャッシュにないテキストだけをリクエストする
+
+    dimensionsを指定した場合は、その次元数に短くした埋め込みをプロバイダーに要求する(supports_embedding_dimensionsを参照)。
+    """
+    if _embedding_cache is None:
+        return _request_to_embed(args, model, is_embedded_at_local, provider, local_llm_address, dimensions)
+    model_key = _embedding_model_key(model, is_embedded_at_local, provider, local_llm_address, dimensions)
+    texts, vectors, missing = _split_cached_embeddings(args, model_key)
+    if not missing:
+        return vectors
+    embeds = _request_to_embed(
+        [texts[i] for i in missing], model, is_embedded_at_local, provider, local_llm_address, dimensions
+    )
+    return _fill_cached_embeddings(texts, vectors, missing, embeds, model_key)
+
+
+# 一時的なエラーとみなして、埋め込みのバッチを再送するエラー
+RETRYABLE_EMBEDDING_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.InternalServerError,
+)
+DEFAULT_EMBEDDING_BATCH_SIZE = 1000
+DEFAULT_EMBEDDING_BATCH_TOKEN_BUDGET = 50000
+
+
+@retry(
+    retry=retry_if_exception_type(RETRYABLE_EMBEDDING_ERRORS),
+    wait=wait_exponential(multiplier=3, min=3, max=20),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+def request_embedding_batch(texts, model, is_embedded_at_local, provider, local_llm_address, dimensions):
+    """1リクエスト分のテキストを埋め込む。一時的なエラーは再送し、結果を同時実行数の調整に通知する"""
+    started_at = time.monotonic()
+    try:
+        embeds = request_to_embed(
+            texts, model, is_embedded_at_local, provider, local_llm_address, dimensions=dimensions
+        )
+    except Exception as e:
+        report_request_outcome(time.monotonic() - started_at, e)
+        raise
+    report_request_outcome(time.monotonic() - started_at)
+    return embeds
+
+
+def request_to_embed_in_batches(
+    texts: list[str],
+    model: str,
+    is_embedded_at_local: bool = False,
+    provider: str = "openai",
+    local_llm_address: str | None = None,
+    workers: int | AdaptiveConcurrencyController = 1,
+    token_budget: int = DEFAULT_EMBEDDING_BATCH_TOKEN_BUDGET,
+    batch_size: int = DEFAULT_EMBEDDING_BATCH_SIZE,
+    dimensions: int | None = None,
+) -> list:
+    """大量のテキストを、推定トークン数の予算で区切ったバッチに分けて並行して埋め込み、入力順に返す
+
+    各バッチのリクエストはレートリミッターの予算を待ってから送信し、一時的なエラーは指数バックオフで再送する。
+
+    Args:
+        texts: 埋め込むテキストのリスト
+        workers: 同時に送信するリクエスト数、またはAdaptiveConcurrencyController
+        token_budget: 1リクエストあたりの推定トークン数の上限
+        batch_size: 1リクエストあたりのテキスト数の上限
+        dimensions: プロバイダーに要求する埋め込みの次元数。Noneの場合はモデルの既定の次元数
+    """
+    # ローカルモデルはバッチ内の最長のテキストに合わせてパディングするため、長さ順に並べて無駄な計算を減らす
+    order = sorted(range(len(texts)), key=lambda i: len(str(texts[i]))) if is_embedded_at_local else None
+    request_texts = [texts[i] for i in order] if order is not None else texts
+    batches = pack_by_token_budget(request_texts, token_budget, batch_size)
+    tasks = [
+        partial(
+            request_embedding_batch,
+            [request_texts[i] for i in batch],
+            model,
+            is_embedded_at_local,
+            provider,
+            local_llm_address,
+            dimensions,
+        )
+        for batch in batches
+    ]
+    embeddings = []
+    for _, future in tqdm(run_in_sliding_window(tasks, workers), total=len(tasks), desc="Embedding"):
+        embeddings.extend(future.result())
+    if order is None:
+        return embeddings
+    restored = [None] * len(texts)
+    for position, embedding in zip(order, embeddings, strict=True):
+        restored[position] = embedding
+    return restored
+
+
+def _request_to_embed(
+    args,
+    model,
+    is_embedded_at_local=False,
+    provider="openai",
+    local_llm_address: str | None = None,
+    dimensions: int | None = None,
+):
     if is_embedded_at_local:
         return request_to_local_embed(args)
 
+    limiter = get_rate_limiter(provider, model)
+    if limiter is None:
+        return _dispatch_embedding_request(args, model, provider, local_llm_address, dimensions)[0]
+    reserved_tokens = _estimate_embedding_tokens(args)
+    limiter.acquire(reserved_tokens)
+    used_tokens = None
+    try:
+        embeds, used_tokens = _dispatch_embedding_request(args, model, provider, local_llm_address, dimensions)
+    finally:
+        # 失敗した場合や使用量が返らない場合は、見積もりのトークン数を使ったものとして精算する
+        limiter.settle(reserved_tokens, used_tokens or reserved_tokens)
+    return embeds
+
+
+def _estimate_embedding_tokens(args) -> int:
+    texts = [args] if isinstance(args, str) else args
+    return sum(estimate_tokens(str(text)) for text in texts)
+
+
+def _embedding_usage(response) -> int | None:
+    """埋め込みのレスポンスのトークン使用量。返らない場合はNone"""
+    if hasattr(response, "usage") and response.usage:
+        return response.usage.total_tokens or None
+    return None
+
+
+def _dispatch_embedding_request(
+    args, model, provider: str, local_llm_address: str | None, dimensions: int | None
+) -> tuple[list, int | None]:
+    """プロバイダーに埋め込みをリクエストし、(埋め込みのリスト, トークン使用量)を返す"""
     if provider == "azure":
-        return request_to_azure_embed(args, model)
+        response = _request_azure_embedding(args, dimensions)
     elif provider == "openai":
         _validate_model(model)
-        client = OpenAI()
-        response = client.embeddings.create(input=args, model=model)
-        embeds = [item.embedding for item in response.data]
-        return embeds
+        client = get_llm_client(OpenAI)
+        response = client.embeddings.create(input=args, model=model, **_dimensions_kwargs(dimensions))
     elif provider == "openrouter":
         raise NotImplementedError("OpenRouter embedding support is not implemented yet")
     elif provider == "local":
         address = local_llm_address or "localhost:11434"
-        return request_to_local_llm_embed(args, model, address)
+        return request_to_local_llm_embed(args, model, address), None
     else:
         raise ValueError(f"Unknown provider: {provider}")
+    return [item.embedding for item in response.data], _embedding_usage(response)
+
 
+async def request_to_embed_async(
+    args,
+    model,
+    is_embedded_at_local=False,
+    provider="openai",
+    local_llm_address: str | None = None,
+    dimensions: int | None = None,
+):
+    """request_to_embedの非同期版。services.async_runnerのイベントループ上で呼び出すこと"""
+    if _embedding_cache is None:
+        return await _request_to_embed_async(args, model, is_embedded_at_local, provider, local_llm_address, dimensions)
+    model_key = _embedding_model_key(model, is_embedded_at_local, provider, local_llm_address, dimensions)
+    texts, vectors, missing = _split_cached_embeddings(args, model_key)
+    if not missing:
+        return vectors
+    embeds = await _request_to_embed_async(
+        [texts[i] for i in missing], model, is_embedded_at_local, provider, local_llm_address, dimensions
+    )
+    return _fill_cached_embeddings(texts, vectors, missing, embeds, model_key)
 
-def request_to_azure_embed(args, model):
+
+async def _request_to_embed_async(
+    args,
+    model,
+    is_embedded_at_local=False,
+    provider="openai",
+    local_llm_address: str | None = None,
+    dimensions: int | None = None,
+):
+    if is_embedded_at_local:
+        # ローカルの埋め込みモデルはCPU/GPUで計算するため、イベントループを止めないよう別スレッドで実行する
+        return await asyncio.to_thread(request_to_local_embed, args)
+
+    limiter = get_rate_limiter(provider, model)
+    if limiter is None:
+        return (await _dispatch_embedding_request_async(args, model, provider, local_llm_address, dimensions))[0]
+    reserved_tokens = _estimate_embedding_tokens(args)
+    await limiter.acquire_async(reserved_tokens)
+    used_tokens = None
+    try:
+        embeds, used_tokens = await _dispatch_embedding_request_async(
+            args, model, provider, local_llm_address, dimensions
+        )
+    finally:
+        limiter.settle(reserved_tokens, used_tokens or reserved_tokens)
+    return embeds
+
+
+async def _dispatch_embedding_request_async(
+    args, model, provider: str, local_llm_address: str | None, dimensions: int | None
+) -> tuple[list, int | None]:
+    if provider == "openai":
+        _validate_model(model)
+    elif provider == "azure":
+        model = os.getenv("AZURE_EMBEDDING_DEPLOYMENT_NAME")
+    elif provider == "openrouter":
+        raise NotImplementedError("OpenRouter embedding support is not implemented yet")
+    elif provider != "local":
+        raise ValueError(f"Unknown provider: {provider}")
+
+    client = _get_async_client(provider, local_llm_address, embedding=True)
+    try:
+        response = await client.embeddings.create(input=args, model=model, **_dimensions_kwargs(dimensions))
+    except Exception as e:
+        if provider != "local":
+            raise
+        logging.error(f"LocalLLM embedding API error: {e}")
+        logging.warning("Falling back to local embedding")
+        return await asyncio.to_thread(request_to_local_embed, args), None
+    return [item.embedding for item in response.data], _embedding_usage(response)
+
+
+def request_to_azure_embed(args, model, dimensions: int | None = None):
+    response = _request_azure_embedding(args, dimensions)
+    return [item.embedding for item in response.data]
+
+
+def _request_azure_embedding(args, dimensions: int | None = None):
     azure_endpoint = os.getenv("AZURE_EMBEDDING_ENDPOINT")
     api_key = os.getenv("AZURE_EMBEDDING_API_KEY")
     api_version = os.getenv("AZURE_EMBEDDING_VERSION")
     deployment = os.getenv("AZURE_EMBEDDING_DEPLOYMENT_NAME")
 
-    client = AzureOpenAI(
+    client = get_llm_client(
+        AzureOpenAI,
         api_version=api_version,
         azure_endpoint=azure_endpoint,
         api_key=api_key,
     )
 
-    response = client.embeddings.create(input=args, model=deployment)
-    return [item.embedding for item in response.data]
+    return client.embeddings.create(input=args, model=deployment, **_dimensions_kwargs(dimensions))
 
 
+LOCAL_EMBEDDING_MODEL = "paraphrase-multilingual-mpnet-base-v2"
+DEFAULT_LOCAL_EMBEDDING_OPTIONS = {
+    "batch_size": 64,
+    "processes": 1,
+    "backend": "torch",
+    "model_file": None,
+    "server_address": None,
+}
+_local_embedding_options = dict(DEFAULT_LOCAL_EMBEDDING_OPTIONS)
 __local_emb_model = None
+__local_emb_pool = None
 __local_emb_model_loading_lock = threading.Lock()
+# マルチプロセスのプールは入力・出力のキューを共有するため、同時に1つのencodeしか流さない
+__local_emb_pool_lock = threading.Lock()
 
 
-def request_to_local_embed(args):
+def configure_local_embedding(options: dict | None) -> None:
+    """is_embedded_at_localの埋め込みモデルの実行方法を設定する
+
+    Args:
+        options: configの"local_embedding"の値。Noneの場合は既定値(PyTorch・1プロセス)に戻す
+            - batch_size: encodeのバッチサイズ
+            - processes: encodeに使うプロセス数。"auto"の場合はCPUのコア数
+            - backend: "torch"・"onnx"・"openvino"のいずれか(onnx・openvinoはsentence-transformers 3.2以降)
+            - model_file: backendのモデルファイル(例: int8量子化の"onnx/model_qint8_avx512_vnni.onnx")
+            - server_address: local_embedding_serverのアドレス。指定した場合はモデルを読み込まずにサーバーで埋め込む
+    """
+    global __local_emb_model, _local_embedding_options
+    new_options = {**DEFAULT_LOCAL_EMBEDDING_OPTIONS, **(options or {})}
+    with __local_emb_model_loading_lock:
+        if (new_options["backend"], new_options["model_file"], new_options["processes"]) != (
+            _local_embedding_options["backend"],
+            _local_embedding_options["model_file"],
+            _local_embedding_options["processes"],
+        ):
+            _stop_local_embedding_pool()
+            __local_emb_model = None
+        _local_embedding_options = new_options
+
+
+def local_embedding_model_key() -> str:
+    """埋め込みキャッシュのキーに使う、ローカルの埋め込みモデルの識別子。量子化したモデルはベクトルが変わるため区別する"""
+    options = _local_embedding_options
+    if options["server_address"]:
+        return f"local-embedding-server/{options['server_address']}"
+    key = f"sentence-transformers/{LOCAL_EMBEDDING_MODEL}"
+    if options["backend"] != "torch":
+        key += f"/{options['backend']}/{options['model_file'] or 'default'}"
+    return key
+
+
+def _load_local_embedding_model():
     global __local_emb_model
     # memo: モデルを遅延ロード＆キャッシュするために、グローバル変数を使用
-
     with __local_emb_model_loading_lock:
         # memo: スレッドセーフにするためにロックを使用
         if __local_emb_model is None:
             from sentence_transformers import SentenceTransformer
 
-            model_name = "sentence-transformers/paraphrase-multilingual-mpnet-base-v2"
-            __local_emb_model = SentenceTransformer(model_name)
+            options = _local_embedding_options
+            kwargs = {}
+            if options["backend"] != "torch":
+                kwargs["backend"] = options["backend"]
+                if options["model_file"]:
+                    kwargs["model_kwargs"] = {"file_name": options["model_file"]}
+            __local_emb_model = SentenceTransformer(f"sentence-transformers/{LOCAL_EMBEDDING_MODEL}", **kwargs)
+        return __local_emb_model
+
+
+def _local_embedding_processes() -> int:
+    processes = _local_embedding_options["processes"]
+    if processes == "auto":
+        return os.cpu_count() or 1
+    return int(processes)
+
 
-    result = __local_emb_model.encode(args)
+def _stop_local_embedding_pool() -> None:
+    global __local_emb_pool
+    if __local_emb_pool is not None:
+        from sentence_transformers import SentenceTransformer
+
+        SentenceTransformer.stop_multi_process_pool(__local_emb_pool)
+        __local_emb_pool = None
+
+
+def request_to_local_embed(args):
+    options = _local_embedding_options
+    if options["server_address"]:
+        client = get_llm_client(OpenAI, base_url=_local_llm_base_url(options["server_address"]), api_key="not-needed")
+        response = client.embeddings.create(input=args, model=LOCAL_EMBEDDING_MODEL)
+        return [item.embedding for item in response.data]
+
+    global __local_emb_pool
+    model = _load_local_embedding_model()
+    processes = _local_embedding_processes()
+    if processes <= 1 or isinstance(args, str):
+        return model.encode(args, batch_size=options["batch_size"]).tolist()
+    with __local_emb_pool_lock:
+        if __local_emb_pool is None:
+            __local_emb_pool = model.start_multi_process_pool(target_devices=["cpu"] * processes)
+            atexit.register(_stop_local_embedding_pool)
+        result = model.encode_multi_process(list(args), __local_emb_pool, batch_size=options["batch_size"])
     return result.tolist()
 
 
@@ -532,6 +1292,7 @@ def _local_llm_test():
     retry=retry_if_exception_type(openai.RateLimitError),
     wait=wait_exponential(multiplier=3, min=3, max=20),
     stop=stop_after_attempt(3),
+    before=_reserve_retry_attempt,
     reraise=True,
 )
 def request_to_openrouter_chatcompletion(
@@ -548,7 +1309,8 @@ def request_to_openrouter_chatcompletion(
     token_usage_output = 0  # 出力トークン使用量を追跡する変数
     token_usage_total = 0  # 合計トークン使用量を追跡する変数
 
-    client = OpenAI(
+    client = get_llm_client(
+        OpenAI,
         base_url="https://openrouter.ai/api/v1",
         api_key=api_key,
     )
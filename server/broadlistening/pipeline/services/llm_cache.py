@@ -0,0 +1,167 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pydantic import BaseModel
+
+DEFAULT_LLM_CACHE_PATH = "cache/llm_responses.sqlite3"
+DEFAULT_LLM_CACHE_MAX_SIZE_MB = 1024
+
+# 各リクエスト関数は temperature=0, seed=0 で固定して呼び出している。
+# 将来この値を変えた場合に古いキャッシュを使わないよう、キーの一部に含める
+REQUEST_TEMPERATURE = 0
+REQUEST_SEED = 0
+
+
+def _serialize_json_schema(json_schema: dict | type[BaseModel] | None) -> dict | None:
+    if json_schema is None:
+        return None
+    if isinstance(json_schema, type) and issubclass(json_schema, BaseModel):
+        return {"name": json_schema.__name__, "schema": json_schema.model_json_schema()}
+    return json_schema
+
+
+def build_cache_key(
+    provider: str,
+    model: str,
+    messages: list[dict],
+    is_json: bool = False,
+    json_schema: dict | type[BaseModel] | None = None,
+    local_llm_address: str | None = None,
+) -> str:
+    """リクエスト内容からキャッシュキー(SHA-256)を生成する
+
+    レスポンスに影響しうる値(プロバイダー・モデル・メッセージ・出力形式・temperature/seed)をすべて含める。
+    ローカルLLMはアドレスごとに別のモデルが動いている可能性があるため、アドレスもキーに含める。
+    Azureはmodelではなくデプロイメントのモデルで応答するため、環境変数のエンドポイント・デプロイメント名もキーに含める。
+    """
+    payload = {
+        "provider": provider,
+        "model": model,
+        "messages": messages,
+        "is_json": is_json,
+        "json_schema": _serialize_json_schema(json_schema),
+        "local_llm_address": local_llm_address if provider == "local" else None,
+        "azure_endpoint": os.getenv("AZURE_CHATCOMPLETION_ENDPOINT") if provider == "azure" else None,
+        "azure_deployment": os.getenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME") if provider == "azure" else None,
+        "temperature": REQUEST_TEMPERATURE,
+        "seed": REQUEST_SEED,
+    }
+    serialized = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """LLMのレスポンスをSQLiteに保存する永続キャッシュ
+
+    キーはリクエスト内容のハッシュ(content-addressed)で、合計サイズが上限を超えた場合は
+    最後に参照された時刻が古いものから削除する(LRU)。
+    複数スレッドから同時に呼ばれるため、コネクションは1つにしてロックで排他する。
+    """
+
+    def __init__(self, path: str = DEFAULT_LLM_CACHE_PATH, max_size_mb: float = DEFAULT_LLM_CACHE_MAX_SIZE_MB):
+        self.path = path
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                response TEXT NOT NULL,
+                token_input INTEGER NOT NULL,
+                token_output INTEGER NOT NULL,
+                token_total INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_responses_last_access ON responses (last_access)")
+        self._conn.commit()
+        self._size_bytes = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> tuple[str | dict, int, int, int] | None:
+        """キャッシュを参照する。見つからなければNoneを返す
+
+        Returns:
+            保存時のレスポンスと、保存時のトークン使用量(入力・出力・合計)のタプル
+        """
+        with self._lock:
+            try:
+                row = self._conn.execute(
+                    "SELECT response, token_input, token_output, token_total FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self.misses += 1
+                    return None
+                self._conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache lookup failed: {e}")
+                self.misses += 1
+                return None
+            self.hits += 1
+        response, token_input, token_output, token_total = row
+        return json.loads(response), token_input, token_output, token_total
+
+    def set(self, key: str, value: tuple[str | dict, int, int, int]) -> None:
+        response, token_input, token_output, token_total = value
+        serialized = json.dumps(response, ensure_ascii=False)
+        size = len(serialized.encode("utf-8"))
+        with self._lock:
+            try:
+                previous = self._conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO responses "
+                    "(key, response, token_input, token_output, token_total, size, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (key, serialized, token_input, token_output, token_total, size, time.time()),
+                )
+                self._size_bytes += size - (previous[0] if previous else 0)
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                logging.warning(f"LLM cache write failed: {e}")
+
+    def _evict(self) -> None:
+        # 上限ぎりぎりで毎回削除が走らないよう、上限の9割まで減らす
+        target = self.max_size_bytes * 0.9
+        while self._size_bytes > self.max_size_bytes:
+            rows = self._conn.execute("SELECT key, size FROM responses ORDER BY last_access ASC LIMIT 100").fetchall()
+            if not rows:
+                self._size_bytes = 0
+                return
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size_bytes -= size
+                self.evictions += 1
+                if self._size_bytes <= target:
+                    return
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": entries,
+                "size_bytes": self._size_bytes,
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
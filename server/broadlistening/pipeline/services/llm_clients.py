@@ -0,0 +1,122 @@
+import hashlib
+import threading
+
+import httpx
+import openai
+
+# 同時実行数が設定されていない場合のコネクションプールの大きさ
+DEFAULT_MAX_CONNECTIONS = 32
+
+
+class _ConnectionStats:
+    """HTTPリクエスト数と、そのうち新しくTCP接続を張った回数を数える"""
+
+    def __init__(self):
+        self.requests = 0
+        self.new_connections = 0
+        self._lock = threading.Lock()
+
+    def record_request(self) -> None:
+        with self._lock:
+            self.requests += 1
+
+    def record_new_connection(self) -> None:
+        with self._lock:
+            self.new_connections += 1
+
+
+_connection_stats = _ConnectionStats()
+_max_connections = DEFAULT_MAX_CONNECTIONS
+_clients: dict[tuple, object] = {}
+_client_reuses = 0
+_registry_lock = threading.Lock()
+
+
+def _trace(event_name: str, info: dict) -> None:
+    # httpcoreはコネクションプールに使える接続がない場合にのみTCP接続を張る
+    if event_name == "connection.connect_tcp.complete":
+        _connection_stats.record_new_connection()
+
+
+async def _trace_async(event_name: str, info: dict) -> None:
+    _trace(event_name, info)
+
+
+def _on_request(request) -> None:
+    _connection_stats.record_request()
+    request.extensions["trace"] = _trace
+
+
+async def _on_request_async(request) -> None:
+    _connection_stats.record_request()
+    request.extensions["trace"] = _trace_async
+
+
+def _create_http_client(is_async: bool):
+    # keep-aliveで保持する接続数を同時実行数に合わせ、並行リクエストのたびに接続を張り直さないようにする
+    limits = httpx.Limits(max_connections=_max_connections, max_keepalive_connections=_max_connections)
+    if is_async:
+        return openai.DefaultAsyncHttpxClient(limits=limits, event_hooks={"request": [_on_request_async]})
+    return openai.DefaultHttpxClient(limits=limits, event_hooks={"request": [_on_request]})
+
+
+def _credential_fingerprint(value: object) -> object:
+    # APIキーをそのままメモリ上のキーに残さないよう、ハッシュにしてから使う
+    if isinstance(value, str):
+        return hashlib.sha256(value.encode()).hexdigest()
+    return value
+
+
+def get_llm_client(client_class: type, is_async: bool = False, **kwargs):
+    """クライアントのクラス・接続先・認証情報ごとに1つだけクライアントを作成し、使い回す
+
+    クライアントごとにコネクションプールを持つため、リクエストのたびに作成するとTLSハンドシェイクが毎回発生する。
+    非同期クライアントは作成したイベントループに紐づくため、services.async_runnerのイベントループ上でのみ使うこと。
+
+    Args:
+        client_class: OpenAI, AzureOpenAI, AsyncOpenAI, AsyncAzureOpenAIなどのクライアントのクラス
+        is_async: 非同期クライアントかどうか
+        kwargs: クライアントのコンストラクタに渡す引数(base_url, api_key, azure_endpointなど)
+    """
+    global _client_reuses
+    key = (client_class, is_async, tuple(sorted((k, _credential_fingerprint(v)) for k, v in kwargs.items())))
+    with _registry_lock:
+        client = _clients.get(key)
+        if client is not None:
+            _client_reuses += 1
+            return client
+        client = client_class(**kwargs, http_client=_create_http_client(is_async))
+        _clients[key] = client
+        return client
+
+
+def configure_llm_clients(max_connections: int | None) -> None:
+    """コネクションプールの大きさを設定し、作成済みのクライアントを破棄する
+
+    openaiモジュールのデフォルトクライアント(openai.chat.completions.createなど)にも同じ設定を適用する。
+
+    Args:
+        max_connections: 1クライアントあたりの最大接続数。Noneの場合はデフォルト値
+    """
+    global _max_connections, _client_reuses, _connection_stats
+    with _registry_lock:
+        _max_connections = max_connections or DEFAULT_MAX_CONNECTIONS
+        _clients.clear()
+        _client_reuses = 0
+        _connection_stats = _ConnectionStats()
+    openai.http_client = _create_http_client(is_async=False)
+
+
+def get_llm_client_stats() -> dict:
+    """作成したクライアント数と、HTTP接続の再利用状況を返す"""
+    with _registry_lock:
+        requests = _connection_stats.requests
+        new_connections = _connection_stats.new_connections
+        return {
+            "max_connections": _max_connections,
+            "clients": len(_clients),
+            "client_reuses": _client_reuses,
+            "requests": requests,
+            "new_connections": new_connections,
+            "reused_connections": max(0, requests - new_connections),
+        }
@@ -0,0 +1,89 @@
+"""is_embedded_at_localの埋め込みモデルを常駐させる、OpenAI互換の埋め込みサーバー
+
+パイプラインはレポートごとに別プロセスで実行されるため、プロセス内でモデルを読み込むと毎回ロードし直しになる。
+このサーバーを1つ起動しておき、configの"local_embedding"の"server_address"に指定すると、
+各パイプラインはモデルを読み込まずにこのサーバーへ埋め込みをリクエストする。
+
+    cd server/broadlistening/pipeline
+    python -m services.local_embedding_server --port 8765 --processes auto --backend onnx
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .llm import LOCAL_EMBEDDING_MODEL, configure_local_embedding, request_to_local_embed
+
+
+class EmbeddingRequestHandler(BaseHTTPRequestHandler):
+    """POST /v1/embeddings だけを受け付けるハンドラー"""
+
+    protocol_version = "HTTP/1.1"
+    # PyTorchのencodeはコアをすべて使うため、リクエストは1件ずつ処理する
+    encode_lock = threading.Lock()
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/v1/embeddings":
+            self._send_json(404, {"error": {"message": f"Unknown path: {self.path}"}})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            texts = [body["input"]] if isinstance(body["input"], str) else list(body["input"])
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": {"message": f"Invalid request: {e}"}})
+            return
+        with self.encode_lock:
+            embeddings = request_to_local_embed(texts) if texts else []
+        self._send_json(
+            200,
+            {
+                "object": "list",
+                "model": LOCAL_EMBEDDING_MODEL,
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": embedding}
+                    for i, embedding in enumerate(embeddings)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            },
+        )
+
+    def _send_json(self, status: int, payload: dict) -> None:
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the local embedding model over an OpenAI compatible API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--processes", default="1", help='number of encoding processes, or "auto" for all cores')
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx", "openvino"])
+    parser.add_argument("--model-file", default=None, help='e.g. "onnx/model_qint8_avx512_vnni.onnx" for int8')
+    args = parser.parse_args()
+
+    configure_local_embedding(
+        {
+            "batch_size": args.batch_size,
+            "processes": args.processes if args.processes == "auto" else int(args.processes),
+            "backend": args.backend,
+            "model_file": args.model_file,
+        }
+    )
+    # 最初のリクエストを待たせないよう、起動時にモデルを読み込んでおく
+    request_to_local_embed(["warm up"])
+    server = ThreadingHTTPServer((args.host, args.port), EmbeddingRequestHandler)
+    print(f"Serving {LOCAL_EMBEDDING_MODEL} on http://{args.host}:{args.port}/v1/embeddings")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -74,34 +74,69 @@ def parse_response(response):
         return items
 
 
-def parse_extraction_response(response: str | dict) -> list[str]:
+def parse_extraction_response(response: str | dict, strict: bool = False) -> list[str]:
     """
     structured outputで出力したextraction responseをパースする。
     responseは以下のような形式の文字列。
     {"arguments": ["arg1", "arg2", "arg3"]}
+    strict=Trueの場合、解釈できないレスポンスを空のリストとして扱わずValueErrorを送出する
+    (JSONとして解釈できない場合はjson.JSONDecodeError)。
     """
 
     try:
         if isinstance(response, dict):
-            return response["extractedOpinionList"]
-
-        response_dict = json.loads(response)
-        extracted_opinions = response_dict["extractedOpinionList"]
+            extracted_opinions = response["extractedOpinionList"]
+        else:
+            response_dict = json.loads(response)
+            extracted_opinions = response_dict["extractedOpinionList"]
         # argumentsがリストでない場合は空のリストを返す
         if not isinstance(extracted_opinions, list):
+            if strict:
+                raise ValueError(f"extractedOpinionList is not a list: {extracted_opinions!r}")
             return []
         return extracted_opinions
     except json.JSONDecodeError:
         print("Failed to parse extraction response, json.JSONDecodeError", response)
+        if strict:
+            raise
         return []
     except KeyError:
         print("Failed to parse extraction response, no 'arguments' key", response)
+        if strict:
+            raise ValueError("extraction response has no 'extractedOpinionList' key") from None
         return []
     except Exception as e:
+        if strict:
+            raise
         print("Failed to parse extraction response, unknown error", response, e)
         return []
 
 
+def parse_packed_extraction_response(response: str | dict) -> dict[str, list[str]]:
+    """
+    複数コメントをまとめて抽出したstructured outputのresponseをパースし、commentIdごとの意見のリストを返す。
+    responseは以下のような形式の文字列。
+    {"results": [{"commentId": "1", "extractedOpinionList": ["arg1", "arg2"]}, ...]}
+    意見のリストが不正な形式のコメントは結果に含めない（呼び出し側で1件ずつ抽出し直す）。
+    """
+
+    try:
+        response_dict = response if isinstance(response, dict) else json.loads(response)
+        results = response_dict["results"]
+    except (json.JSONDecodeError, KeyError, TypeError) as e:
+        print("Failed to parse packed extraction response", response, e)
+        return {}
+
+    parsed = {}
+    for item in results if isinstance(results, list) else []:
+        if not isinstance(item, dict):
+            continue
+        opinions = item.get("extractedOpinionList")
+        if isinstance(opinions, list) and all(isinstance(opinion, str) for opinion in opinions):
+            parsed[str(item.get("commentId"))] = opinions
+    return parsed
+
+
 if __name__ == "__main__":
     import doctest
 
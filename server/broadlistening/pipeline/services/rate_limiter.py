@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+# レスポンスのトークン数はリクエスト前にはわからないため、この値で見積もって予約し、完了後に実績で精算する
+DEFAULT_EXPECTED_OUTPUT_TOKENS = 500
+
+
+class RateLimiter:
+    """1分あたりのリクエスト数(RPM)とトークン数(TPM)を制限するトークンバケット
+
+    どちらのバケットも容量は1分間の上限値で、上限値/60 の速度で連続的に補充される。
+    リクエスト前に見積もりのトークン数を予約し、完了後に実際の使用量との差分を精算する。
+    差分の精算でトークンのバケットが負になった場合は、その分だけ次のリクエストが待たされる。
+    """
+
+    def __init__(self, rpm: float | None = None, tpm: float | None = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm) if rpm else 0.0
+        self._tokens = float(tpm) if tpm else 0.0
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+        self.throttled_requests = 0
+        self.total_wait_seconds = 0.0
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        if self.rpm:
+            self._requests = min(float(self.rpm), self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(float(self.tpm), self._tokens + elapsed * self.tpm / 60)
+
+    def _try_acquire(self, tokens: int) -> float:
+        """予約できた場合は0を、できなかった場合は待つべき秒数を返す"""
+        with self._lock:
+            self._refill(time.monotonic())
+            # 1リクエストでTPMの上限を超える場合でも永久に待たないよう、上限で頭打ちにする
+            tokens = min(tokens, self.tpm) if self.tpm else tokens
+            wait = 0.0
+            if self.rpm and self._requests < 1:
+                wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+            if self.tpm and self._tokens < tokens:
+                wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+            if wait > 0:
+                return wait
+            if self.rpm:
+                self._requests -= 1
+            if self.tpm:
+                self._tokens -= tokens
+            return 0.0
+
+    def _record_wait(self, waited: float) -> None:
+        if waited > 0:
+            with self._lock:
+                self.throttled_requests += 1
+                self.total_wait_seconds += waited
+
+    def acquire(self, tokens: int) -> None:
+        """リクエスト1件と見積もりトークン数を予約する。予算が足りない場合は補充されるまで待つ"""
+        waited = 0.0
+        while (wait := self._try_acquire(tokens)) > 0:
+            time.sleep(wait)
+            waited += wait
+        self._record_wait(waited)
+
+    async def acquire_async(self, tokens: int) -> None:
+        """acquireの非同期版。待機中もイベントループをブロックしない"""
+        waited = 0.0
+        while (wait := self._try_acquire(tokens)) > 0:
+            await asyncio.sleep(wait)
+            waited += wait
+        self._record_wait(waited)
+
+    def settle(self, reserved_tokens: int, actual_tokens: int) -> None:
+        """予約したトークン数と実際の使用量の差分を精算する"""
+        if not self.tpm or not actual_tokens:
+            return
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens += min(reserved_tokens, self.tpm) - actual_tokens
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "rpm": self.rpm,
+                "tpm": self.tpm,
+                "throttled_requests": self.throttled_requests,
+                "total_wait_seconds": round(self.total_wait_seconds, 3),
+            }
+
+
+_rate_limit_config: dict = {}
+_rate_limiters: dict[tuple[str, str], RateLimiter] = {}
+_registry_lock = threading.Lock()
+
+
+def configure_rate_limits(rate_limits: dict | None) -> None:
+    """プロセス全体で共有するレート制限を設定する
+
+    Args:
+        rate_limits: configの"rate_limits"の値。キーは "プロバイダー/モデル"、"プロバイダー"、"default" のいずれかで、
+            値は {"rpm": 1分あたりのリクエスト数, "tpm": 1分あたりのトークン数}。
+            より具体的なキーの設定が優先され、制限はプロバイダー・モデルの組ごとに独立して管理する。
+            Noneの場合はレート制限を無効化する
+    """
+    global _rate_limit_config
+    with _registry_lock:
+        _rate_limit_config = dict(rate_limits or {})
+        _rate_limiters.clear()
+
+
+def get_rate_limiter(provider: str, model: str) -> RateLimiter | None:
+    """プロバイダー・モデルに対応するレート制限を返す。設定がない場合はNone"""
+    with _registry_lock:
+        key = (provider, model)
+        if key in _rate_limiters:
+            return _rate_limiters[key]
+        limits = next(
+            (
+                _rate_limit_config[name]
+                for name in (f"{provider}/{model}", provider, "default")
+                if name in _rate_limit_config
+            ),
+            None,
+        )
+        if not limits or not (limits.get("rpm") or limits.get("tpm")):
+            return None
+        limiter = RateLimiter(rpm=limits.get("rpm"), tpm=limits.get("tpm"))
+        _rate_limiters[key] = limiter
+        return limiter
+
+
+def get_rate_limiter_stats() -> dict | None:
+    """プロバイダー・モデルごとの待機回数・待機時間を返す。レート制限が無効な場合はNone"""
+    with _registry_lock:
+        if not _rate_limiters:
+            return None
+        return {f"{provider}/{model}": limiter.stats() for (provider, model), limiter in _rate_limiters.items()}
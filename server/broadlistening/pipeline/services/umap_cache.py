@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+
+import joblib
+import numpy as np
+
+PROJECTION_CACHE_FILENAME = "umap_projection_cache.npz"
+# --appendモードで新しい意見を射影する(transformする)ために保存する、学習済みのUMAP
+UMAP_MODEL_FILENAME = "umap_model.joblib"
+FINGERPRINT_CHUNK_ROWS = 65536
+
+
+def embeddings_fingerprint(matrix: np.ndarray) -> str:
+    """埋め込みの行列の内容・形状・型から計算したSHA-256
+
+    メモリマップした行列全体をメモリに読み込まないよう、行のまとまりごとにハッシュに追加する。
+    """
+    digest = hashlib.sha256(f"{matrix.shape}:{matrix.dtype}".encode())
+    for start in range(0, matrix.shape[0], FINGERPRINT_CHUNK_ROWS):
+        digest.update(np.ascontiguousarray(matrix[start : start + FINGERPRINT_CHUNK_ROWS]).tobytes())
+    return digest.hexdigest()
+
+
+def _params_key(params: dict) -> str:
+    return json.dumps(params, sort_keys=True)
+
+
+def load_projection_cache(
+    path: str, fingerprint: str, params: dict
+) -> tuple[np.ndarray | None, tuple[np.ndarray, np.ndarray] | None]:
+    """保存したUMAPの射影結果を読み込む
+
+    埋め込みが同じでUMAPのパラメータも同じ場合は2次元の座標を、パラメータだけが異なる場合でも
+    近傍数と距離が同じならk近傍グラフを返す。再利用できないものはNoneにする。
+
+    Returns:
+        (2次元の座標, (k近傍のインデックス, k近傍の距離)) のタプル
+    """
+    if not os.path.exists(path):
+        return None, None
+    with np.load(path, allow_pickle=False) as data:
+        if str(data["fingerprint"]) != fingerprint:
+            return None, None
+        coordinates = data["coordinates"] if str(data["params"]) == _params_key(params) else None
+        knn = None
+        if (
+            "knn_indices" in data
+            and str(data["knn_metric"]) == params["metric"]
+            and data["knn_indices"].shape[1] >= params["n_neighbors"]
+        ):
+            n_neighbors = params["n_neighbors"]
+            knn = (data["knn_indices"][:, :n_neighbors], data["knn_dists"][:, :n_neighbors])
+    return coordinates, knn
+
+
+def save_projection_cache(
+    path: str,
+    fingerprint: str,
+    params: dict,
+    coordinates: np.ndarray,
+    knn_indices: np.ndarray | None = None,
+    knn_dists: np.ndarray | None = None,
+) -> None:
+    """UMAPの射影結果とk近傍グラフを、埋め込みのフィンガープリントとパラメータと一緒に保存する"""
+    arrays = {
+        "fingerprint": np.array(fingerprint),
+        "params": np.array(_params_key(params)),
+        "coordinates": np.asarray(coordinates),
+    }
+    if knn_indices is not None and knn_dists is not None:
+        arrays["knn_indices"] = np.asarray(knn_indices)
+        arrays["knn_dists"] = np.asarray(knn_dists)
+        arrays["knn_metric"] = np.array(params["metric"])
+    # 書き込み中に中断されても壊れたキャッシュが残らないよう、一時ファイルに書いてから置き換える
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def save_umap_model(path: str, model) -> None:
+    """学習済みのUMAPを保存する。transformに使う学習データと近傍探索のインデックスも含まれる"""
+    tmp_path = f"{path}.tmp"
+    joblib.dump(model, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_umap_model(path: str):
+    return joblib.load(path)
@@ -1,7 +1,12 @@
+import numpy as np
 import pandas as pd
-from tqdm import tqdm
 
-from services.llm import request_to_embed
+from services.adaptive_concurrency import create_concurrency_controller, record_adaptive_concurrency
+from services.category_classification import load_classification_embeddings
+from services.embedding_store import load_embeddings, save_embeddings
+from services.embedding_stream import take_streamed_embeddings
+from services.incremental_clustering import is_append_mode
+from services.llm import request_to_embed_in_batches, supports_embedding_dimensions
 
 
 def embedding(config):
@@ -11,13 +16,68 @@ def embedding(config):
     # print(f"embedding model: {model}, is_embedded_at_local: {is_embedded_at_local}")
 
     dataset = config["output_dir"]
-    path = f"outputs/{dataset}/embeddings.pkl"
     arguments = pd.read_csv(f"outputs/{dataset}/args.csv", usecols=["arg-id", "argument"])
-    embeddings = []
-    batch_size = 1000
-    for i in tqdm(range(0, len(arguments), batch_size)):
-        args = arguments["argument"].tolist()[i : i + batch_size]
-        embeds = request_to_embed(args, model, is_embedded_at_local, config["provider"])
-        embeddings.extend(embeds)
-    df = pd.DataFrame([{"arg-id": arguments.iloc[i]["arg-id"], "embedding": e} for i, e in enumerate(embeddings)])
-    df.to_pickle(path)
+    # カテゴリ分類で同じモデルの埋め込みを計算済みの意見は、埋め込み直さない
+    reusable = load_classification_embeddings(config)
+    # embedding.streamingが有効な場合は、抽出と並行して埋め込んだ意見も埋め込み直さない
+    reusable.update(take_streamed_embeddings(config))
+    # --appendモードでは、以前の実行で埋め込んだ意見は埋め込み直さない
+    if is_append_mode(config):
+        reusable.update(_load_previous_embeddings(dataset))
+    texts = arguments["argument"].tolist()
+    missing = [text for text in dict.fromkeys(texts) if text not in reusable]
+    if reusable:
+        print(f"Reusing {sum(text in reusable for text in texts)} previously computed embeddings")
+
+    # 次元数の指定に対応したモデルではプロバイダーに短い埋め込みを要求し、それ以外は全件の埋め込み後にPCAで射影する
+    dimensions = config["embedding"]["dimensions"]
+    request_dimensions = (
+        dimensions if supports_embedding_dimensions(model, is_embedded_at_local, config["provider"]) else None
+    )
+    workers = config["embedding"]["workers"]
+    controller = create_concurrency_controller(workers)
+    embeds = request_to_embed_in_batches(
+        missing,
+        model,
+        is_embedded_at_local,
+        config["provider"],
+        config.get("local_llm_address"),
+        workers=controller or workers,
+        token_budget=config["embedding"]["batch_token_budget"],
+        batch_size=config["embedding"]["batch_size"],
+        dimensions=request_dimensions,
+    )
+    if controller is not None:
+        record_adaptive_concurrency(config, "embedding", controller)
+    embedded = dict(reusable)
+    embedded.update(zip(missing, embeds, strict=True))
+    vectors = (embedded[text] for text in texts)
+    dimension = len(embedded[texts[0]]) if texts else 0
+    if dimensions and request_dimensions is None:
+        vectors = _project_with_pca(list(vectors), dimensions)
+        dimension = vectors.shape[1]
+    save_embeddings(f"outputs/{dataset}", arguments["arg-id"].tolist(), vectors, dimension)
+
+
+def _load_previous_embeddings(dataset: str) -> dict:
+    """以前の実行で埋め込んだ意見のテキストとベクトルの対応を返す
+
+    埋め込みのファイルはこのステップで上書きするため、メモリマップせずに読み込む。
+    意見のテキストは、以前の実行のクラスタリング結果から引く。
+    """
+    clusters = pd.read_csv(f"outputs/{dataset}/hierarchical_clusters.csv", usecols=["arg-id", "argument"])
+    texts = dict(zip(clusters["arg-id"], clusters["argument"], strict=True))
+    arg_ids, matrix = load_embeddings(f"outputs/{dataset}", mmap=False)
+    return {texts[arg_id]: matrix[i] for i, arg_id in enumerate(arg_ids) if arg_id in texts}
+
+
+def _project_with_pca(vectors: list, dimensions: int) -> np.ndarray:
+    """埋め込みをPCAでdimensions次元に射影する。件数が次元数より少ない場合は件数までに抑える"""
+    from sklearn.decomposition import PCA
+
+    matrix = np.asarray(vectors, dtype=np.float32)
+    n_components = min(dimensions, *matrix.shape)
+    if n_components >= matrix.shape[1]:
+        return matrix
+    print(f"Projecting embeddings from {matrix.shape[1]} to {n_components} dimensions with PCA")
+    return PCA(n_components=n_components, random_state=42).fit_transform(matrix).astype(np.float32)
@@ -1,41 +1,126 @@
+import asyncio
 import concurrent.futures
+import hashlib
 import json
 import logging
+import os
 import re
+import time
+from collections.abc import Iterator
+from functools import partial
 
 import pandas as pd
 from pydantic import BaseModel, Field
 from tqdm import tqdm
 
+from services.adaptive_concurrency import (
+    AdaptiveConcurrencyController,
+    RequestTimeoutError,
+    TaskRunStats,
+    create_concurrency_controller,
+    record_adaptive_concurrency,
+    run_in_sliding_window,
+)
+from services.async_runner import run_async_in_order
+from services.batch_runner import BATCH_EXECUTION_MODE, BatchChatRequest, run_chat_batch
 from services.category_classification import classify_args
-from services.llm import request_to_chat_ai
-from services.parse_json_list import parse_extraction_response
+from services.checkpoint_journal import CheckpointJournal, extraction_journal
+from services.comment_dedup import find_duplicate_comments
+from services.embedding_stream import get_embedding_stream, start_embedding_stream, stop_embedding_stream
+from services.llm import pack_by_token_budget, request_to_chat_ai, request_to_chat_ai_async
+from services.parse_json_list import parse_extraction_response, parse_packed_extraction_response
 from utils import update_progress
 
 COMMA_AND_SPACE_AND_RIGHT_BRACKET = re.compile(r",\s*(\])")
+FAILURES_FILENAME = "extraction_failures.jsonl"
+
+
+PACKED_EXTRACTION_INSTRUCTION = """
+
+# 複数コメントの一括処理
+入力はcommentIdとcommentを持つJSON配列で、複数のコメントが含まれます。
+各コメントは互いに独立したものとして扱い、コメントごとに上記の指示に従って意見を抽出してください。
+出力のresultsには、入力のすべてのcommentIdについて、commentIdと抽出した意見のリストを1件ずつ含めてください。
+"""
 
 
 class ExtractionResponse(BaseModel):
     extractedOpinionList: list[str] = Field(..., description="抽出した意見のリスト")
 
 
+class PackedExtractionItem(BaseModel):
+    commentId: str = Field(..., description="入力のcommentId")
+    extractedOpinionList: list[str] = Field(..., description="このコメントから抽出した意見のリスト")
+
+
+class PackedExtractionResponse(BaseModel):
+    results: list[PackedExtractionItem] = Field(..., description="コメントごとの抽出結果")
+
+
 def _validate_property_columns(property_columns: list[str], comments: pd.DataFrame) -> None:
     if not all(property in comments.columns for property in property_columns):
         raise ValueError(f"Properties {property_columns} not found in comments. Columns are {comments.columns}")
 
 
+def _is_resume_planned(config) -> bool:
+    plan = [x for x in config.get("plan", []) if x["step"] == "extraction"]
+    return bool(plan and plan[0].get("resume", False))
+
+
+def _body_hash(body: str) -> str:
+    return hashlib.sha256(str(body).encode()).hexdigest()
+
+
+def _load_journaled_arguments(journal: CheckpointJournal, comments: pd.DataFrame, comment_ids) -> dict[str, list[str]]:
+    """ジャーナルから抽出済みの意見を読み込む。本文が変わったコメントは再抽出の対象とする"""
+    entries = journal.load()
+    extracted = {}
+    for comment_id in comment_ids:
+        entry = entries.get(str(comment_id))
+        if entry is not None and entry["body_sha256"] == _body_hash(comments.loc[comment_id]["comment-body"]):
+            extracted[str(comment_id)] = entry["arguments"]
+    return extracted
+
+
+def _find_representative_comments(config, comments: pd.DataFrame, comment_ids) -> dict:
+    """各comment-idに対して、抽出を代表して行うコメントのcomment-idを返す"""
+    if not config["extraction"]["dedup_comments"]:
+        return {comment_id: comment_id for comment_id in comment_ids}
+
+    bodies = [comments.loc[comment_id]["comment-body"] for comment_id in comment_ids]
+    dedup = find_duplicate_comments(bodies, config["extraction"]["dedup_similarity_threshold"])
+    config["extraction_dedup"] = {
+        "comments": len(comment_ids),
+        "unique_comments": dedup.unique_count,
+        "exact_duplicates": dedup.exact_duplicates,
+        "near_duplicates": dedup.near_duplicates,
+    }
+    print(
+        f"Dedup: {len(comment_ids)} comments -> {dedup.unique_count} unique "
+        f"(exact={dedup.exact_duplicates}, near={dedup.near_duplicates})"
+    )
+    return {comment_id: comment_ids[rep] for comment_id, rep in zip(comment_ids, dedup.representatives, strict=True)}
+
+
 def extraction(config):
+    try:
+        _run_extraction(config)
+    except BaseException:
+        # 抽出と並行した埋め込みは、抽出が失敗した場合は使われないため止める
+        stop_embedding_stream()
+        raise
+
+
+def _run_extraction(config):
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/args.csv"
-    model = config["extraction"]["model"]
-    prompt = config["extraction"]["prompt"]
     workers = config["extraction"]["workers"]
+    controller = create_concurrency_controller(workers)
     limit = config["extraction"]["limit"]
     property_columns = config["extraction"]["properties"]
 
     if "provider" not in config:
         raise RuntimeError("provider is not set")
-    provider = config["provider"]
 
     # カラム名だけを読み込み、必要なカラムが含まれているか確認する
     comments = pd.read_csv(f"inputs/{config['input']}.csv", nrows=0)
@@ -49,36 +134,129 @@ def extraction(config):
     results = pd.DataFrame()
     update_progress(config, total=len(comment_ids))
 
-    argument_map = {}
-    relation_rows = []
+    # 同一・ほぼ同一の本文のコメントはグループ内で最初に出現したコメント(代表)だけを抽出し、結果を全員に割り当てる
+    representative_ids = _find_representative_comments(config, comments, comment_ids)
 
-    for i in tqdm(range(0, len(comment_ids), workers)):
-        batch = comment_ids[i : i + workers]
-        batch_inputs = [comments.loc[id]["comment-body"] for id in batch]
-        batch_results = extract_batch(
-            batch_inputs, prompt, model, workers, provider, config.get("local_llm_address"), config
+    # 抽出結果は1件ずつジャーナルに追記し、クラッシュ後の再実行では記録済みのコメントをスキップする
+    journal = extraction_journal(config)
+    resume = _is_resume_planned(config)
+    extracted = _load_journaled_arguments(journal, comments, comment_ids) if resume else {}
+    journal.open(resume=resume)
+    # embedding.streamingが有効な場合は、抽出できた意見から順にバックグラウンドで埋め込む
+    embedding_stream = start_embedding_stream(config)
+    if embedding_stream is not None:
+        for extracted_args in extracted.values():
+            embedding_stream.submit(extracted_args)
+    pending_ids = [
+        comment_id
+        for comment_id in comment_ids
+        if representative_ids[comment_id] == comment_id and str(comment_id) not in extracted
+    ]
+    if resume:
+        print(f"Resuming extraction from journal: {len(extracted)} comments already extracted")
+    update_progress(config, incr=len(comment_ids) - len(pending_ids))
+
+    comment_inputs = [comments.loc[id]["comment-body"] for id in pending_ids]
+    packs = None
+    if config["extraction"]["pack_comments"]:
+        packs = pack_by_token_budget(
+            comment_inputs, config["extraction"]["pack_token_budget"], config["extraction"]["pack_max_comments"]
+        )
+        print(f"Packing {len(comment_inputs)} comments into {len(packs)} requests")
+    run_stats = TaskRunStats()
+    config["extraction_request_errors"] = {"failed": 0, "timed_out": 0}
+    execution_mode = config["extraction"]["execution_mode"]
+    try:
+        failures = _run_extraction_pass(
+            config,
+            journal,
+            pending_ids,
+            comment_inputs,
+            controller or workers,
+            packs,
+            run_stats,
+            extracted,
+            execution_mode,
         )
+        # 本実行で失敗したコメントは、同時実行数を下げて間隔をあけてから抽出し直す
+        attempts = dict.fromkeys(failures, 1)
+        first_pass_failures = len(failures)
+        retry_workers = controller.limit if controller else workers
+        for retry_round in range(1, config["extraction"]["failure_retries"] + 1):
+            if not failures:
+                break
+            retry_workers = max(1, retry_workers // 2)
+            backoff = config["extraction"]["failure_retry_backoff"] * 2 ** (retry_round - 1)
+            print(
+                f"Retrying {len(failures)} failed comments in {backoff}s (round {retry_round}, workers={retry_workers})"
+            )
+            time.sleep(backoff)
+            retry_ids = list(failures)
+            for comment_id in retry_ids:
+                attempts[comment_id] += 1
+            # Batch APIは完了まで時間がかかるため、少数の失敗したコメントは通常のリクエストで抽出し直す
+            failures = _run_extraction_pass(
+                config,
+                journal,
+                retry_ids,
+                [comments.loc[id]["comment-body"] for id in retry_ids],
+                retry_workers,
+                None,
+                run_stats,
+                extracted,
+                "thread" if execution_mode == BATCH_EXECUTION_MODE else execution_mode,
+                report_progress=False,
+            )
+    finally:
+        journal.close()
+        if controller is not None:
+            record_adaptive_concurrency(config, "extraction", controller)
 
-        for comment_id, extracted_args in zip(batch, batch_results, strict=False):
-            for j, arg in enumerate(extracted_args):
-                if arg not in argument_map:
-                    # argumentテーブルに追加
-                    arg_id = f"A{comment_id}_{j}"
-                    argument_map[arg] = {
-                        "arg-id": arg_id,
-                        "argument": arg,
-                    }
-                else:
-                    arg_id = argument_map[arg]["arg-id"]
-
-                # relationテーブルにcommentとargの関係を追加
-                relation_row = {
+    # 再試行しても失敗したコメントはレポートから抜け落ちるため、原因を調べられるようファイルに書き出す
+    _write_extraction_failures(f"outputs/{dataset}/{FAILURES_FILENAME}", failures, attempts, comments)
+    config["extraction_failures"] = {
+        "first_pass": first_pass_failures,
+        "recovered": first_pass_failures - len(failures),
+        "failed": len(failures),
+    }
+    request_errors = config["extraction_request_errors"]
+    request_errors["timed_out_attempts"] = run_stats.timed_out_attempts
+    request_errors["requeued"] = run_stats.requeued
+    print(
+        f"Extraction failures: first pass={first_pass_failures}, "
+        f"recovered={first_pass_failures - len(failures)}, failed={len(failures)}"
+    )
+    print(
+        f"Extraction requests: failed={request_errors['failed']}, timed_out={request_errors['timed_out']} "
+        f"(timed out attempts={run_stats.timed_out_attempts}, requeued={run_stats.requeued})"
+    )
+    print(
+        f"Extraction: input={config.get('token_usage_input', 0)}, output={config.get('token_usage_output', 0)}, "
+        f"total={config.get('total_token_usage', 0)} tokens"
+    )
+
+    # arg-idの採番が実行順に依存しないよう、コメントの並び順で組み立てる
+    argument_map = {}
+    relation_rows = []
+    for comment_id in comment_ids:
+        # 代表は常にグループ内で最初に出現するため、arg-idは代表のcomment-idで採番される
+        for j, arg in enumerate(extracted.get(str(representative_ids[comment_id]), [])):
+            if arg not in argument_map:
+                # argumentテーブルに追加
+                arg_id = f"A{comment_id}_{j}"
+                argument_map[arg] = {
                     "arg-id": arg_id,
-                    "comment-id": comment_id,
+                    "argument": arg,
                 }
-                relation_rows.append(relation_row)
+            else:
+                arg_id = argument_map[arg]["arg-id"]
 
-        update_progress(config, incr=len(batch))
+            # relationテーブルにcommentとargの関係を追加
+            relation_row = {
+                "arg-id": arg_id,
+                "comment-id": comment_id,
+            }
+            relation_rows.append(relation_row)
 
     # DataFrame化
     results = pd.DataFrame(argument_map.values())
@@ -89,58 +267,328 @@ def extraction(config):
 
     classification_categories = config["extraction"]["categories"]
     if classification_categories:
-        results = classify_args(results, config, workers)
+        results = classify_args(results, config, controller.limit if controller else workers, resume)
 
     results.to_csv(path, index=False)
     # comment-idとarg-idの関係を保存
     relation_df.to_csv(f"outputs/{dataset}/relations.csv", index=False)
 
 
+def _run_extraction_pass(
+    config,
+    journal: CheckpointJournal,
+    comment_ids: list,
+    comment_inputs: list[str],
+    workers,
+    packs,
+    run_stats: TaskRunStats,
+    extracted: dict[str, list[str]],
+    execution_mode: str,
+    report_progress: bool = True,
+) -> dict:
+    """comment_idsのコメントから意見を抽出してextractedとジャーナルに記録し、失敗したコメントとエラー内容を返す"""
+    failures = {}
+    processed_since_update = 0
+    embedding_stream = get_embedding_stream()
+    for index, extracted_args, error in tqdm(
+        extract_in_sliding_window(
+            comment_inputs,
+            config["extraction"]["prompt"],
+            config["extraction"]["model"],
+            workers,
+            config["provider"],
+            config.get("local_llm_address"),
+            config,
+            packs,
+            execution_mode,
+            config["extraction"]["request_timeout"],
+            config["extraction"]["timeout_retries"],
+            run_stats,
+        ),
+        total=len(comment_ids),
+    ):
+        comment_id = comment_ids[index]
+        if extracted_args is None:
+            # 失敗したコメントはジャーナルに記録せず、再試行や再実行時に再度抽出する
+            failures[comment_id] = error or "no valid response for this comment"
+        else:
+            journal.append(
+                str(comment_id),
+                {"body_sha256": _body_hash(comment_inputs[index]), "arguments": extracted_args},
+            )
+            extracted[str(comment_id)] = extracted_args
+            if embedding_stream is not None:
+                embedding_stream.submit(extracted_args)
+
+        # ステータスファイルの書き込みが律速にならないよう、進捗はworkers件ごとにまとめて反映する
+        processed_since_update += 1
+        if report_progress and processed_since_update >= _current_workers(workers):
+            update_progress(config, incr=processed_since_update)
+            processed_since_update = 0
+    if report_progress and processed_since_update > 0:
+        update_progress(config, incr=processed_since_update)
+    return failures
+
+
+def _current_workers(workers) -> int:
+    return workers.limit if isinstance(workers, AdaptiveConcurrencyController) else workers
+
+
+def _write_extraction_failures(path: str, failures: dict, attempts: dict, comments: pd.DataFrame) -> None:
+    if not failures:
+        # 前回の実行で書き出したファイルが残っていると紛らわしいため削除する
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with open(path, "w", encoding="utf-8") as f:
+        for comment_id, error in failures.items():
+            record = {
+                "comment-id": comment_id,
+                "comment-body": comments.loc[comment_id]["comment-body"],
+                "error": error,
+                "attempts": attempts[comment_id],
+            }
+            f.write(json.dumps(record, ensure_ascii=False, default=_json_default) + "\n")
+    print(f"Wrote {len(failures)} failed comments to {path}")
+
+
+def _json_default(value):
+    # pandasから読み込んだcomment-idなど、numpyの数値型をPythonの型に変換する
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
 logging.basicConfig(level=logging.ERROR)
 
 
-def extract_batch(batch, prompt, model, workers, provider="openai", local_llm_address=None, config=None):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-        futures_with_index = [
-            (i, executor.submit(extract_arguments, input, prompt, model, provider, local_llm_address))
-            for i, input in enumerate(batch)
-        ]
+def extract_in_sliding_window(
+    inputs,
+    prompt,
+    model,
+    workers,
+    provider="openai",
+    local_llm_address=None,
+    config=None,
+    packs=None,
+    execution_mode="thread",
+    timeout=None,
+    timeout_retries=0,
+    stats=None,
+) -> Iterator[tuple[int, list[str] | None, str | None]]:
+    """常にworkers件のリクエストを並行実行し、抽出結果を入力順に返すジェネレータ
+
+    リクエストが1件完了するたびに次のリクエストを投入し、同時実行数をworkers件に保つ。
+    完了順は不定だが、arg-idの採番を決定的にするため、結果は入力のインデックス順に返す。
+
+    Args:
+        inputs: 抽出対象のコメント本文のリスト
+        prompt: 抽出用のシステムプロンプト
+        model: 使用するLLMモデル名
+        workers: 同時実行するリクエスト数、またはAdaptiveConcurrencyController
+        provider: LLMプロバイダー
+        local_llm_address: ローカルLLMのアドレス
+        config: 設定情報を含む辞書（トークン使用量の累積に使用）
+        packs: 1リクエストにまとめる入力のインデックスのリスト(pack_by_token_budgetの戻り値)。
+            Noneの場合は1コメント1リクエスト
+        execution_mode: "thread"ならスレッド、"async"ならパイプラインのイベントループで並行実行する。
+            "batch"ならBatch APIでまとめて実行し、workers・timeoutは使わない
+        timeout: 1リクエストあたりの期限(秒)。期限を過ぎたリクエストは応答を待たずに見捨てて再投入する
+        timeout_retries: 期限切れのリクエストを再投入する回数
+        stats: 期限切れ・再投入の件数を記録するTaskRunStats
+
+    Yields:
+        (入力のインデックス, 抽出された意見のリスト, エラー内容) のタプル。
+        抽出に失敗した場合、意見のリストはNoneで、リクエスト自体が失敗していればエラー内容が入る
+    """
+    if packs is None:
+        packs = [[i] for i in range(len(inputs))]
+    if execution_mode == BATCH_EXECUTION_MODE:
+        yield from _extract_with_batch(inputs, prompt, model, provider, config, packs)
+        return
+    if execution_mode == "async":
+        task_func, runner = _run_extraction_task_async, run_async_in_order
+    elif execution_mode == "thread":
+        task_func, runner = _run_extraction_task, run_in_sliding_window
+    else:
+        raise ValueError(f"Unknown execution_mode: {execution_mode}")
+    tasks = [
+        partial(task_func, [inputs[i] for i in pack], prompt, model, provider, local_llm_address) for pack in packs
+    ]
+    for pack_index, future in runner(tasks, workers, timeout, timeout_retries, stats):
+        pack = packs[pack_index]
+        results, error = _collect_extraction_result(future, len(pack), config)
+        # パックは連続するインデックスで構成されるため、パック単位で入力順に返せば全体も入力順になる
+        for index, items in zip(pack, results, strict=True):
+            yield index, items, error if items is None else None
+
 
-        done, not_done = concurrent.futures.wait([f for _, f in futures_with_index], timeout=30)
-        results = [[] for _ in range(len(batch))]
-        total_token_input = 0
-        total_token_output = 0
-        total_token_usage = 0
+def _run_extraction_task(
+    pack_inputs: list[str], prompt, model, provider="openai", local_llm_address=None
+) -> tuple[list[list[str] | None], int, int, int]:
+    if len(pack_inputs) > 1:
+        return extract_packed_arguments(pack_inputs, prompt, model, provider, local_llm_address)
 
-        for _, future in futures_with_index:
-            if future in not_done and not future.cancelled():
-                future.cancel()
+    result = extract_arguments(pack_inputs[0], prompt, model, provider, local_llm_address)
+    if isinstance(result, tuple) and len(result) == 4:
+        items, token_input, token_output, token_total = result
+        return [items], token_input, token_output, token_total
+    return [result], 0, 0, 0
 
-        for i, future in futures_with_index:
-            if future in done:
+
+def _collect_extraction_result(
+    future: concurrent.futures.Future, pack_size: int, config: dict | None
+) -> tuple[list[list[str] | None], str | None]:
+    try:
+        results, token_input, token_output, token_total = future.result()
+    except Exception as e:
+        # 期限切れで見捨てたリクエストは、APIのエラーで失敗したリクエストと分けて数える
+        kind = "timed_out" if isinstance(e, RequestTimeoutError) else "failed"
+        logging.error(f"Task {future} {kind.replace('_', ' ')} with error: {e}")
+        if config is not None and "extraction_request_errors" in config:
+            config["extraction_request_errors"][kind] += 1
+        return [None] * pack_size, f"{type(e).__name__}: {e}"
+
+    _accumulate_token_usage(config, token_input, token_output, token_total)
+    return results, None
+
+
+def _accumulate_token_usage(config: dict | None, token_input: int, token_output: int, token_total: int) -> None:
+    if config is not None:
+        config["total_token_usage"] = config.get("total_token_usage", 0) + token_total
+        config["token_usage_input"] = config.get("token_usage_input", 0) + token_input
+        config["token_usage_output"] = config.get("token_usage_output", 0) + token_output
+
+
+def _extract_with_batch(
+    inputs, prompt, model, provider, config: dict, packs: list[list[int]]
+) -> Iterator[tuple[int, list[str] | None, str | None]]:
+    """Batch APIでパックごとに1リクエストを送り、抽出結果を入力順に返す
+
+    パックのレスポンスに結果が欠けていたコメントは失敗として返し、全件の処理後の再試行で抽出し直す。
+    """
+    requests = []
+    packed_ids_by_pack = []
+    for pack_index, pack in enumerate(packs):
+        pack_inputs = [inputs[i] for i in pack]
+        if len(pack) > 1:
+            packed_ids, messages = _packed_extraction_messages(pack_inputs, prompt)
+            json_schema = PackedExtractionResponse
+        else:
+            packed_ids = None
+            messages = [{"role": "system", "content": prompt}, {"role": "user", "content": pack_inputs[0]}]
+            json_schema = ExtractionResponse
+        packed_ids_by_pack.append(packed_ids)
+        requests.append(BatchChatRequest(custom_id=f"pack-{pack_index}", messages=messages, json_schema=json_schema))
+
+    responses = run_chat_batch(requests, model, provider, f"outputs/{config['output_dir']}/batches", "extraction")
+    for pack_index, pack in enumerate(packs):
+        response = responses[f"pack-{pack_index}"]
+        results: list[list[str] | None] = [None] * len(pack)
+        error = None
+        if isinstance(response, Exception):
+            if "extraction_request_errors" in config:
+                config["extraction_request_errors"]["failed"] += 1
+            error = f"{type(response).__name__}: {response}"
+        else:
+            content, token_input, token_output, token_total = response
+            _accumulate_token_usage(config, token_input, token_output, token_total)
+            packed_ids = packed_ids_by_pack[pack_index]
+            if packed_ids is not None:
+                _apply_packed_response(content, packed_ids, results)
+            else:
                 try:
-                    result = future.result()
-                    if isinstance(result, tuple) and len(result) == 4:
-                        items, token_input, token_output, token_total = result
-                        results[i] = items
-                        total_token_input += token_input
-                        total_token_output += token_output
-                        total_token_usage += token_total
-                    else:
-                        results[i] = result
-                except Exception as e:
-                    logging.error(f"Task {future} failed with error: {e}")
-                    results[i] = []
-
-        if config is not None:
-            config["total_token_usage"] = config.get("total_token_usage", 0) + total_token_usage
-            config["token_usage_input"] = config.get("token_usage_input", 0) + total_token_input
-            config["token_usage_output"] = config.get("token_usage_output", 0) + total_token_output
-            print(
-                f"Extraction batch: input={total_token_input}, output={total_token_output}, total={total_token_usage} tokens"
+                    results[0] = list(filter(None, parse_extraction_response(content, strict=True)))
+                except ValueError as e:
+                    error = f"{type(e).__name__}: {e}"
+        for index, items in zip(pack, results, strict=True):
+            yield index, items, error if items is None else None
+
+
+def _packed_extraction_messages(inputs: list[str], prompt: str) -> tuple[list[str], list[dict]]:
+    packed_ids = [str(i + 1) for i in range(len(inputs))]
+    messages = [
+        {"role": "system", "content": prompt + PACKED_EXTRACTION_INSTRUCTION},
+        {
+            "role": "user",
+            "content": json.dumps(
+                [{"commentId": id, "comment": str(text)} for id, text in zip(packed_ids, inputs, strict=True)],
+                ensure_ascii=False,
+            ),
+        },
+    ]
+    return packed_ids, messages
+
+
+def _apply_packed_response(response, packed_ids: list[str], results: list[list[str] | None]) -> list[int]:
+    """パックのレスポンスを各コメントの結果に割り当て、結果が欠けていたコメントの位置を返す"""
+    parsed = parse_packed_extraction_response(response)
+    for k, id in enumerate(packed_ids):
+        if id in parsed:
+            results[k] = list(filter(None, parsed[id]))
+    return [k for k, items in enumerate(results) if items is None]
+
+
+def extract_packed_arguments(
+    inputs: list[str], prompt, model, provider="openai", local_llm_address=None
+) -> tuple[list[list[str] | None], int, int, int]:
+    """複数のコメントを1リクエストにまとめて意見を抽出する
+
+    システムプロンプトを複数コメントで共有することで、短いコメントが多い場合の入力トークン数とリクエスト数を減らす。
+    レスポンスをパースできなかった場合や、一部のコメントの結果が欠けていた場合は、
+    該当するコメントだけ1コメント1リクエストで抽出し直す。
+
+    Returns:
+        各コメントの抽出結果(失敗した場合はNone)のリストと、トークン使用量(入力・出力・合計)のタプル
+    """
+    packed_ids, messages = _packed_extraction_messages(inputs, prompt)
+    results: list[list[str] | None] = [None] * len(inputs)
+    missing = list(range(len(inputs)))
+    token_usage = [0, 0, 0]
+    try:
+        response, token_input, token_output, token_total = request_to_chat_ai(
+            messages=messages,
+            model=model,
+            is_json=False,
+            json_schema=PackedExtractionResponse,
+            provider=provider,
+            local_llm_address=local_llm_address,
+        )
+        token_usage = [token_input, token_output, token_total]
+        missing = _apply_packed_response(response, packed_ids, results)
+    except Exception as e:
+        logging.warning(f"Packed extraction failed, falling back to single-comment requests: {e}")
+
+    if missing and len(missing) < len(inputs):
+        logging.warning(f"Packed extraction response lacks {len(missing)} comments, retrying them one by one")
+    for k in missing:
+        try:
+            items, token_input, token_output, token_total = _run_extraction_task(
+                [inputs[k]], prompt, model, provider, local_llm_address
             )
+        except Exception as e:
+            logging.error(f"Single-comment fallback failed with error: {e}")
+            continue
+        results[k] = items[0]
+        token_usage = [token_usage[0] + token_input, token_usage[1] + token_output, token_usage[2] + token_total]
+    return results, *token_usage
+
+
+def _extraction_response_validator(input):
+    """request_to_chat_aiに渡す、抽出のレスポンスの検証関数を返す
 
-        return results
+    空の結果として扱うとコメントがレポートから抜け落ちるため、解釈できないレスポンスは失敗として再試行の対象にする。
+    検証を通らないレスポンスはキャッシュされないため、再試行ではAPIにリクエストし直す。
+    """
+
+    def validate(response):
+        try:
+            parse_extraction_response(response, strict=True)
+        except ValueError as e:
+            logging.error(f"Invalid extraction response: {e}, input was: {input}, response was: {response}")
+            raise
+
+    return validate
 
 
 def extract_arguments(input, prompt, model, provider="openai", local_llm_address=None):
@@ -148,21 +596,87 @@ def extract_arguments(input, prompt, model, provider="openai", local_llm_address
         {"role": "system", "content": prompt},
         {"role": "user", "content": input},
     ]
+    response, token_input, token_output, token_total = request_to_chat_ai(
+        messages=messages,
+        model=model,
+        is_json=False,
+        json_schema=ExtractionResponse,
+        provider=provider,
+        local_llm_address=local_llm_address,
+        validate=_extraction_response_validator(input),
+    )
+    items = parse_extraction_response(response, strict=True)
+    items = list(filter(None, items))  # omit empty strings
+    return items, token_input, token_output, token_total
+
+
+async def _run_extraction_task_async(
+    pack_inputs: list[str], prompt, model, provider="openai", local_llm_address=None
+) -> tuple[list[list[str] | None], int, int, int]:
+    """_run_extraction_taskの非同期版"""
+    if len(pack_inputs) > 1:
+        return await extract_packed_arguments_async(pack_inputs, prompt, model, provider, local_llm_address)
+
+    result = await extract_arguments_async(pack_inputs[0], prompt, model, provider, local_llm_address)
+    if isinstance(result, tuple) and len(result) == 4:
+        items, token_input, token_output, token_total = result
+        return [items], token_input, token_output, token_total
+    return [result], 0, 0, 0
+
+
+async def extract_packed_arguments_async(
+    inputs: list[str], prompt, model, provider="openai", local_llm_address=None
+) -> tuple[list[list[str] | None], int, int, int]:
+    """extract_packed_argumentsの非同期版。結果が欠けていたコメントは並行して抽出し直す"""
+    packed_ids, messages = _packed_extraction_messages(inputs, prompt)
+    results: list[list[str] | None] = [None] * len(inputs)
+    missing = list(range(len(inputs)))
+    token_usage = [0, 0, 0]
     try:
-        response, token_input, token_output, token_total = request_to_chat_ai(
+        response, token_input, token_output, token_total = await request_to_chat_ai_async(
             messages=messages,
             model=model,
             is_json=False,
-            json_schema=ExtractionResponse,
+            json_schema=PackedExtractionResponse,
             provider=provider,
             local_llm_address=local_llm_address,
         )
-        items = parse_extraction_response(response)
-        items = list(filter(None, items))  # omit empty strings
-        return items, token_input, token_output, token_total
-    except json.decoder.JSONDecodeError as e:
-        print("JSON error:", e)
-        print("Input was:", input)
-        print("Response was:", response)
-        print("Silently giving up on trying to generate valid list.")
-        return []
+        token_usage = [token_input, token_output, token_total]
+        missing = _apply_packed_response(response, packed_ids, results)
+    except Exception as e:
+        logging.warning(f"Packed extraction failed, falling back to single-comment requests: {e}")
+
+    if missing and len(missing) < len(inputs):
+        logging.warning(f"Packed extraction response lacks {len(missing)} comments, retrying them one by one")
+    fallbacks = await asyncio.gather(
+        *[_run_extraction_task_async([inputs[k]], prompt, model, provider, local_llm_address) for k in missing],
+        return_exceptions=True,
+    )
+    for k, fallback in zip(missing, fallbacks, strict=True):
+        if isinstance(fallback, BaseException):
+            logging.error(f"Single-comment fallback failed with error: {fallback}")
+            continue
+        items, token_input, token_output, token_total = fallback
+        results[k] = items[0]
+        token_usage = [token_usage[0] + token_input, token_usage[1] + token_output, token_usage[2] + token_total]
+    return results, *token_usage
+
+
+async def extract_arguments_async(input, prompt, model, provider="openai", local_llm_address=None):
+    """extract_argumentsの非同期版"""
+    messages = [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": input},
+    ]
+    response, token_input, token_output, token_total = await request_to_chat_ai_async(
+        messages=messages,
+        model=model,
+        is_json=False,
+        json_schema=ExtractionResponse,
+        provider=provider,
+        local_llm_address=local_llm_address,
+        validate=_extraction_response_validator(input),
+    )
+    items = parse_extraction_response(response, strict=True)
+    items = list(filter(None, items))  # omit empty strings
+    return items, token_input, token_output, token_total
@@ -1,22 +1,58 @@
 """Cluster the arguments using UMAP + HDBSCAN and GPT-4."""
 
+import os
+import sys
+import time
 from importlib import import_module
 
 import numpy as np
 import pandas as pd
-import scipy.cluster.hierarchy as sch
-from sklearn.cluster import KMeans
+from services.embedding_store import load_embeddings
+from services.hierarchy_tree import (
+    HIERARCHY_TREE_FILENAME,
+    build_hierarchy_tree,
+    hierarchy_levels,
+    load_hierarchy_tree,
+    save_hierarchy_tree,
+)
+from services.incremental_clustering import (
+    APPEND_STATUS_KEY,
+    assign_to_centroids,
+    cluster_centroids,
+    cluster_id_columns,
+    find_relabel_clusters,
+    is_append_mode,
+    upper_level_mapping,
+)
+from services.umap_cache import (
+    PROJECTION_CACHE_FILENAME,
+    UMAP_MODEL_FILENAME,
+    embeddings_fingerprint,
+    load_projection_cache,
+    load_umap_model,
+    save_projection_cache,
+    save_umap_model,
+)
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+# サンプルで学習したUMAPで残りの意見を射影するときに、一度にtransformする件数
+UMAP_TRANSFORM_CHUNK_SIZE = 50000
 
 
 def hierarchical_clustering(config):
+    if is_append_mode(config):
+        append_to_clusters(config)
+        return
+
     UMAP = import_module("umap").UMAP
 
     dataset = config["output_dir"]
+    options = config["hierarchical_clustering"]
     path = f"outputs/{dataset}/hierarchical_clusters.csv"
     arguments_df = pd.read_csv(f"outputs/{dataset}/args.csv", usecols=["arg-id", "argument"])
-    embeddings_df = pd.read_pickle(f"outputs/{dataset}/embeddings.pkl")
-    embeddings_array = np.asarray(embeddings_df["embedding"].values.tolist())
-    cluster_nums = config["hierarchical_clustering"]["cluster_nums"]
+    # float32の行列をメモリマップで読み込み、リストからの変換やfloat64へのコピーを避ける
+    _, embeddings_array = load_embeddings(f"outputs/{dataset}")
+    cluster_nums = options["cluster_nums"]
 
     n_samples = embeddings_array.shape[0]
     # デフォルト設定は15
@@ -28,16 +64,85 @@ def hierarchical_clustering(config):
     else:
         n_neighbors = default_n_neighbors
 
-    umap_model = UMAP(random_state=42, n_components=2, n_neighbors=n_neighbors)
-    # TODO 詳細エラーメッセージを加える
-    # 以下のエラーの場合、おそらく元の意見件数が少なすぎることが原因
-    # TypeError: Cannot use scipy.linalg.eigh for sparse A with k >= N. Use scipy.linalg.eigh(A.toarray()) or reduce k.
-    umap_embeds = umap_model.fit_transform(embeddings_array)
+    # 件数が多いレポートでは、UMAPを省メモリの設定でサンプルだけから学習し、KMeansをMiniBatchKMeansに切り替える
+    large_scale = n_samples >= options["large_scale_threshold"]
+    fit_sample_size = options["umap_fit_sample_size"] if large_scale else None
+    if fit_sample_size is not None and fit_sample_size >= n_samples:
+        fit_sample_size = None
 
-    cluster_results = hierarchical_clustering_embeddings(
-        umap_embeds=umap_embeds,
-        cluster_nums=cluster_nums,
-    )
+    # UMAPの射影は埋め込みとパラメータだけで決まるため、cluster_numsだけを変えた再実行では保存した座標を使う
+    umap_params = {"n_neighbors": n_neighbors, "n_components": 2, "random_state": 42, "metric": "euclidean"}
+    if large_scale:
+        umap_params["low_memory"] = True
+    cache_params = {**umap_params, "fit_sample_size": fit_sample_size}
+    fingerprint = embeddings_fingerprint(embeddings_array)
+    cache_path = f"outputs/{dataset}/{PROJECTION_CACHE_FILENAME}"
+    umap_started = time.perf_counter()
+    umap_embeds, knn = load_projection_cache(cache_path, fingerprint, cache_params)
+    # --appendモード用のUMAP(学習データ・k近傍グラフを含み大きい)は、enable_appendの場合だけ保存する
+    enable_append = options["enable_append"]
+    model_path = f"outputs/{dataset}/{UMAP_MODEL_FILENAME}"
+    if umap_embeds is not None and enable_append and not os.path.exists(model_path):
+        print("Fitting UMAP again to save it for --append")
+        umap_embeds = None
+    if umap_embeds is not None:
+        print("Reusing cached UMAP projection")
+        config["umap_cache"] = {"projection": "reused", "knn": "reused"}
+    else:
+        # サンプルだけで学習する場合は、全件のk近傍グラフを使わない。
+        # 保存したk近傍グラフで学習したUMAPは近傍探索のインデックスを持たず新しい意見をtransformできないため、
+        # --appendモード用に保存する場合もグラフを再利用しない
+        if fit_sample_size is not None or enable_append:
+            knn = None
+        # TODO 詳細エラーメッセージを加える
+        # 以下のエラーの場合、おそらく元の意見件数が少なすぎることが原因
+        # TypeError: Cannot use scipy.linalg.eigh for sparse A with k >= N. Use scipy.linalg.eigh(A.toarray()) or reduce k.
+        umap_model, umap_embeds = fit_umap(UMAP, embeddings_array, umap_params, knn, fit_sample_size)
+        # 件数が少ない場合のUMAPは全点間の距離を直接使い、k近傍グラフを持たない
+        has_full_knn = fit_sample_size is None
+        save_projection_cache(
+            cache_path,
+            fingerprint,
+            cache_params,
+            umap_embeds,
+            getattr(umap_model, "_knn_indices", None) if has_full_knn else None,
+            getattr(umap_model, "_knn_dists", None) if has_full_knn else None,
+        )
+        if enable_append:
+            save_umap_model(model_path, umap_model)
+        elif os.path.exists(model_path):
+            # 以前の射影のUMAPが残っていると、--appendで別の空間に射影してしまうため削除する
+            os.remove(model_path)
+        config["umap_cache"] = {"projection": "computed", "knn": "reused" if knn is not None else "computed"}
+    umap_seconds = time.perf_counter() - umap_started
+
+    # KMeansの結果と重心のWard法の樹形図は座標とクラスタ数だけで決まるため、上位の階層のクラスタ数だけを変えた
+    # 再実行では保存した樹形図を切り直す
+    clustering_started = time.perf_counter()
+    minibatch_size = options["kmeans_batch_size"] if large_scale else None
+    tree_path = f"outputs/{dataset}/{HIERARCHY_TREE_FILENAME}"
+    tree_params = {"n_clusters": max(cluster_nums), "minibatch_size": minibatch_size, "random_state": 42}
+    coordinates_fingerprint = embeddings_fingerprint(np.asarray(umap_embeds))
+    tree = load_hierarchy_tree(tree_path, coordinates_fingerprint, tree_params)
+    if tree is not None:
+        print("Reusing the saved hierarchy tree")
+        linkage, kmeans_labels = tree
+    else:
+        kmeans_labels, cluster_centers = fit_initial_clusters(umap_embeds, max(cluster_nums), minibatch_size)
+        linkage = build_hierarchy_tree(cluster_centers)
+        save_hierarchy_tree(tree_path, linkage, kmeans_labels, coordinates_fingerprint, tree_params)
+    cluster_results = hierarchy_levels(linkage, kmeans_labels, cluster_nums)
+    config["hierarchical_clustering_stats"] = {
+        "n_samples": n_samples,
+        "large_scale": large_scale,
+        "umap_fit_samples": fit_sample_size or n_samples,
+        "kmeans": "MiniBatchKMeans" if large_scale else "KMeans",
+        "hierarchy_tree": "reused" if tree is not None else "computed",
+        "umap_seconds": round(umap_seconds, 2),
+        "clustering_seconds": round(time.perf_counter() - clustering_started, 2),
+        "peak_memory_mb": peak_memory_mb(),
+    }
+    print(f"Clustering stats: {config['hierarchical_clustering_stats']}")
     result_df = pd.DataFrame(
         {
             "arg-id": arguments_df["arg-id"],
@@ -53,6 +158,98 @@ def hierarchical_clustering(config):
     result_df.to_csv(path, index=False)
 
 
+def fit_umap(UMAP, embeddings_array, umap_params: dict, knn, fit_sample_size: int | None):
+    """UMAPを学習して全件の2次元の座標を返す
+
+    fit_sample_sizeを指定した場合は、無作為に選んだその件数の意見だけで学習し、
+    残りの意見は学習したUMAPでUMAP_TRANSFORM_CHUNK_SIZE件ずつtransformする。
+
+    Returns:
+        (学習したUMAP, 全件の座標)
+    """
+    if fit_sample_size is None:
+        umap_kwargs = {"precomputed_knn": (knn[0], knn[1], None)} if knn is not None else {}
+        umap_model = UMAP(**umap_params, **umap_kwargs)
+        return umap_model, umap_model.fit_transform(embeddings_array)
+
+    n_samples = embeddings_array.shape[0]
+    sample = np.sort(np.random.default_rng(42).choice(n_samples, size=fit_sample_size, replace=False))
+    print(f"Fitting UMAP on {fit_sample_size} of {n_samples} arguments")
+    umap_model = UMAP(**umap_params)
+    umap_embeds = np.empty((n_samples, umap_params["n_components"]), dtype=np.float32)
+    umap_embeds[sample] = umap_model.fit_transform(np.asarray(embeddings_array[sample]))
+    rest = np.setdiff1d(np.arange(n_samples), sample)
+    for start in range(0, len(rest), UMAP_TRANSFORM_CHUNK_SIZE):
+        chunk = rest[start : start + UMAP_TRANSFORM_CHUNK_SIZE]
+        umap_embeds[chunk] = umap_model.transform(np.asarray(embeddings_array[chunk]))
+    return umap_model, umap_embeds
+
+
+def peak_memory_mb() -> float | None:
+    """このプロセスの最大常駐メモリ(MB)。resourceモジュールのないWindowsではNone"""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrssの単位はLinuxではKB、macOSではバイト
+    return round(peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024, 1)
+
+
+def append_to_clusters(config):
+    """--appendモード: 新しい意見だけを既存のUMAPの空間に射影し、既存のクラスタに割り当てる
+
+    既存の意見の座標とクラスタはそのまま残す。本文が変わって抽出し直した意見は、新しい意見として扱う。
+    ラベリングし直すクラスタはconfig["hierarchical_append"]["relabel"]に階層ごとに記録する。
+    """
+    dataset = config["output_dir"]
+    options = config["hierarchical_clustering"]
+    path = f"outputs/{dataset}/hierarchical_clusters.csv"
+    previous_df = pd.read_csv(path)
+    arguments_df = pd.read_csv(f"outputs/{dataset}/args.csv", usecols=["arg-id", "argument"])
+    arg_ids, embeddings_array = load_embeddings(f"outputs/{dataset}")
+    columns = cluster_id_columns(previous_df)
+
+    result_df = arguments_df.merge(previous_df, on=["arg-id", "argument"], how="left")
+    is_new = result_df["x"].isna().to_numpy()
+    new_arg_ids = set(result_df.loc[is_new, "arg-id"])
+    new_rows = [i for i, arg_id in enumerate(arg_ids) if arg_id in new_arg_ids]
+    print(f"Appending {len(new_rows)} new arguments to {len(previous_df)} clustered arguments")
+
+    if new_rows:
+        model_path = f"outputs/{dataset}/{UMAP_MODEL_FILENAME}"
+        if not os.path.exists(model_path):
+            raise FileNotFoundError(
+                f"{model_path} not found, so the new arguments cannot be projected. "
+                "Set hierarchical_clustering.enable_append to true and re-run without --append to save the UMAP."
+            )
+        umap_model = load_umap_model(model_path)
+        new_coordinates = umap_model.transform(np.asarray(embeddings_array[new_rows]))
+    else:
+        new_coordinates = np.zeros((0, 2))
+    cluster_ids, centroids, sizes = cluster_centroids(previous_df, columns[-1])
+    labels, _ = assign_to_centroids(new_coordinates, centroids, sizes, refine=options["append_refine_centroids"])
+    bottom_ids = np.array(cluster_ids, dtype=object)[labels]
+
+    result_df.loc[is_new, "x"] = new_coordinates[:, 0]
+    result_df.loc[is_new, "y"] = new_coordinates[:, 1]
+    result_df.loc[is_new, columns[-1]] = bottom_ids
+    # 上位の階層は、最下層のクラスタが以前に併合された先のクラスタに割り当てる
+    mapping = upper_level_mapping(previous_df, columns)
+    for column in columns[:-1]:
+        result_df.loc[is_new, column] = mapping.loc[bottom_ids, column].to_numpy()
+
+    relabel = find_relabel_clusters(previous_df, result_df, columns, options["append_relabel_threshold"])
+    config[APPEND_STATUS_KEY] = {
+        "new_arguments": len(new_rows),
+        "removed_arguments": len(previous_df) + len(new_rows) - len(result_df),
+        "refined_centroids": options["append_refine_centroids"],
+        "relabel": relabel,
+    }
+    print(f"Clusters to relabel: { {column: len(ids) for column, ids in relabel.items()} }")
+    result_df.to_csv(path, index=False)
+
+
 def generate_cluster_count_list(min_clusters: int, max_clusters: int):
     cluster_counts = []
     current = min_clusters
@@ -82,51 +279,18 @@ def generate_cluster_count_list(min_clusters: int, max_clusters: int):
     return cluster_counts
 
 
-def merge_clusters_with_hierarchy(
-    cluster_centers: np.ndarray,
-    kmeans_labels: np.ndarray,
-    umap_array: np.ndarray,
-    n_cluster_cut: int,
-):
-    Z = sch.linkage(cluster_centers, method="ward")
-    cluster_labels_merged = sch.fcluster(Z, t=n_cluster_cut, criterion="maxclust")
+def fit_initial_clusters(
+    umap_embeds: np.ndarray, n_clusters: int, minibatch_size: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """最大分割数でKMeansを実行し、(意見ごとのラベル, 重心)を返す
 
-    n_samples = umap_array.shape[0]
-    final_labels = np.zeros(n_samples, dtype=int)
-
-    for i in range(n_samples):
-        original_label = kmeans_labels[i]
-        final_labels[i] = cluster_labels_merged[original_label]
-
-    return final_labels
-
-
-def hierarchical_clustering_embeddings(
-    umap_embeds,
-    cluster_nums,
-):
-    # 最大分割数でクラスタリングを実施
+    minibatch_sizeを指定した場合は、全件ではなくミニバッチごとに重心を更新するMiniBatchKMeansを使う。
+    """
     print("start initial clustering")
-    initial_cluster_num = cluster_nums[-1]
-    kmeans_model = KMeans(n_clusters=initial_cluster_num, random_state=42)
+    if minibatch_size is not None:
+        kmeans_model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=minibatch_size, random_state=42)
+    else:
+        kmeans_model = KMeans(n_clusters=n_clusters, random_state=42)
     kmeans_model.fit(umap_embeds)
     print("end initial clustering")
-
-    results = {}
-    print("start hierarchical clustering")
-    cluster_nums.sort()
-    print(cluster_nums)
-    for n_cluster_cut in cluster_nums[:-1]:
-        print("n_cluster_cut: ", n_cluster_cut)
-        final_labels = merge_clusters_with_hierarchy(
-            cluster_centers=kmeans_model.cluster_centers_,
-            kmeans_labels=kmeans_model.labels_,
-            umap_array=umap_embeds,
-            n_cluster_cut=n_cluster_cut,
-        )
-        results[n_cluster_cut] = final_labels
-
-    results[initial_cluster_num] = kmeans_model.labels_
-    print("end hierarchical clustering")
-
-    return results
+    return kmeans_model.labels_, kmeans_model.cluster_centers_
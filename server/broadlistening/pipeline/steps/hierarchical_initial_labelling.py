@@ -1,11 +1,17 @@
 import json
-from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from typing import TypedDict
 
 import pandas as pd
 from pydantic import BaseModel, Field
 
+from services.adaptive_concurrency import (
+    create_concurrency_controller,
+    record_adaptive_concurrency,
+    run_in_sliding_window,
+)
+from services.batch_runner import BATCH_EXECUTION_MODE, BatchChatRequest, run_chat_batch
+from services.incremental_clustering import relabel_targets
 from services.llm import request_to_chat_ai
 
 
@@ -27,7 +33,8 @@ def hierarchical_initial_labelling(config: dict) -> None:
                 - sampling_num: サンプリング数
                 - prompt: LLMへのプロンプト
                 - model: 使用するLLMモデル名
-                - workers: 並列処理のワーカー数
+                - workers: 並列処理のワーカー数。"auto"の場合は同時実行数を自動調整する
+                - execution_mode: "batch"の場合はBatch APIでまとめて実行する
             - provider: LLMプロバイダー
     """
     dataset = config["output_dir"]
@@ -44,16 +51,32 @@ def hierarchical_initial_labelling(config: dict) -> None:
     # トークン使用量を追跡するための変数を初期化
     config["total_token_usage"] = config.get("total_token_usage", 0)
 
+    # --appendモードでは、所属する意見が大きく変わったクラスタだけをラベリングし直し、それ以外は以前のラベルを使う
+    relabel = relabel_targets(config, initial_cluster_id_column)
+    previous_label_df = None
+    target_df = clusters_argument_df
+    if relabel is not None:
+        previous_label_df = _load_previous_labels(path, initial_cluster_id_column, relabel)
+        target_df = clusters_argument_df[
+            ~clusters_argument_df[initial_cluster_id_column].isin(previous_label_df["cluster_id"])
+        ]
+        print(
+            f"Relabelling {target_df[initial_cluster_id_column].nunique()} clusters, reusing {len(previous_label_df)}"
+        )
+
     initial_label_df = initial_labelling(
         initial_labelling_prompt,
-        clusters_argument_df,
+        target_df,
         sampling_num,
         model,
         workers,
         config["provider"],
         config.get("local_llm_address"),
         config,  # configを渡して、トークン使用量を累積できるようにする
+        config["hierarchical_initial_labelling"]["execution_mode"],
     )
+    if previous_label_df is not None:
+        initial_label_df = pd.concat([previous_label_df, initial_label_df], ignore_index=True)
     print("start initial labelling")
     initial_clusters_argument_df = clusters_argument_df.merge(
         initial_label_df,
@@ -70,15 +93,28 @@ def hierarchical_initial_labelling(config: dict) -> None:
     initial_clusters_argument_df.to_csv(path, index=False)
 
 
+def _load_previous_labels(path: str, cluster_id_column: str, relabel: set[str]) -> pd.DataFrame:
+    """以前の初期ラベリングの結果から、relabelに含まれないクラスタのラベルと説明を返す"""
+    label_column = f"{cluster_id_column.replace('-id', '')}-label"
+    description_column = f"{cluster_id_column.replace('-id', '')}-description"
+    previous_df = pd.read_csv(path, usecols=[cluster_id_column, label_column, description_column])
+    previous_df = previous_df.drop_duplicates(subset=cluster_id_column)
+    previous_df = previous_df[~previous_df[cluster_id_column].astype(str).isin(relabel)]
+    return previous_df.rename(
+        columns={cluster_id_column: "cluster_id", label_column: "label", description_column: "description"}
+    )
+
+
 def initial_labelling(
     prompt: str,
     clusters_df: pd.DataFrame,
     sampling_num: int,
     model: str,
-    workers: int,
+    workers: int | str,
     provider: str = "openai",
     local_llm_address: str | None = None,
     config: dict | None = None,  # configを追加
+    execution_mode: str = "thread",
 ) -> pd.DataFrame:
     """各クラスタに対して初期ラベリングを実行する
 
@@ -87,10 +123,11 @@ def initial_labelling(
         clusters_df: クラスタリング結果のDataFrame
         sampling_num: 各クラスタからサンプリングする意見の数
         model: 使用するLLMモデル名
-        workers: 並列処理のワーカー数
+        workers: 並列処理のワーカー数。"auto"の場合は同時実行数を自動調整する
         provider: LLMプロバイダー
         local_llm_address: ローカルLLMのアドレス
         config: 設定情報を含む辞書（トークン使用量の累積に使用）
+        execution_mode: "batch"の場合はBatch APIでまとめて実行する
 
     Returns:
         各クラスタのラベリング結果を含むDataFrame
@@ -98,6 +135,12 @@ def initial_labelling(
     cluster_columns = [col for col in clusters_df.columns if col.startswith("cluster-level-")]
     initial_cluster_column = cluster_columns[-1]
     cluster_ids = clusters_df[initial_cluster_column].unique()
+    if len(cluster_ids) == 0:
+        return pd.DataFrame(columns=list(LabellingResult.__annotations__))
+    if execution_mode == BATCH_EXECUTION_MODE:
+        return initial_labelling_with_batch(
+            prompt, clusters_df, cluster_ids, sampling_num, initial_cluster_column, model, provider, config
+        )
     process_func = partial(
         process_initial_labelling,
         df=clusters_df,
@@ -109,8 +152,48 @@ def initial_labelling(
         local_llm_address=local_llm_address,
         config=config,  # configを渡す
     )
-    with ThreadPoolExecutor(max_workers=workers) as executor:
-        results = list(executor.map(process_func, cluster_ids))
+    controller = create_concurrency_controller(workers)
+    tasks = [partial(process_func, cluster_id) for cluster_id in cluster_ids]
+    results = [future.result() for _, future in run_in_sliding_window(tasks, controller or workers)]
+    if controller is not None and config is not None:
+        record_adaptive_concurrency(config, "hierarchical_initial_labelling", controller)
+    return pd.DataFrame(results)
+
+
+def initial_labelling_with_batch(
+    prompt: str,
+    clusters_df: pd.DataFrame,
+    cluster_ids,
+    sampling_num: int,
+    target_column: str,
+    model: str,
+    provider: str,
+    config: dict,
+) -> pd.DataFrame:
+    """全クラスタのラベリングをBatch APIでまとめて実行する"""
+    requests = [
+        BatchChatRequest(
+            custom_id=f"cluster-{cluster_id}",
+            messages=_initial_labelling_messages(cluster_id, clusters_df, prompt, sampling_num, target_column),
+            json_schema=LabellingFromat,
+        )
+        for cluster_id in cluster_ids
+    ]
+    responses = run_chat_batch(
+        requests, model, provider, f"outputs/{config['output_dir']}/batches", "hierarchical_initial_labelling"
+    )
+    results = []
+    for cluster_id in cluster_ids:
+        response = responses[f"cluster-{cluster_id}"]
+        if isinstance(response, Exception):
+            print(response)
+            results.append(_failed_labelling_result(cluster_id))
+            continue
+        response_text, token_input, token_output, token_total = response
+        config["total_token_usage"] = config.get("total_token_usage", 0) + token_total
+        config["token_usage_input"] = config.get("token_usage_input", 0) + token_input
+        config["token_usage_output"] = config.get("token_usage_output", 0) + token_output
+        results.append(_parse_labelling_response(cluster_id, response_text))
     return pd.DataFrame(results)
 
 
@@ -148,14 +231,7 @@ def process_initial_labelling(
     Returns:
         クラスタのラベリング結果
     """
-    cluster_data = df[df[target_column] == cluster_id]
-    sampling_num = min(sampling_num, len(cluster_data))
-    cluster = cluster_data.sample(sampling_num)
-    input = "\n".join(cluster["argument"].values)
-    messages = [
-        {"role": "system", "content": prompt},
-        {"role": "user", "content": input},
-    ]
+    messages = _initial_labelling_messages(cluster_id, df, prompt, sampling_num, target_column)
     try:
         response_text, token_input, token_output, token_total = request_to_chat_ai(
             messages=messages,
@@ -171,16 +247,41 @@ def process_initial_labelling(
             config["token_usage_input"] = config.get("token_usage_input", 0) + token_input
             config["token_usage_output"] = config.get("token_usage_output", 0) + token_output
 
-        response_json = json.loads(response_text) if isinstance(response_text, str) else response_text
-        return LabellingResult(
-            cluster_id=cluster_id,
-            label=response_json.get("label", "エラーでラベル名が取得できませんでした"),
-            description=response_json.get("description", "エラーで解説が取得できませんでした"),
-        )
+        return _parse_labelling_response(cluster_id, response_text)
     except Exception as e:
         print(e)
-        return LabellingResult(
-            cluster_id=cluster_id,
-            label="エラーでラベル名が取得できませんでした",
-            description="エラーで解説が取得できませんでした",
-        )
+        return _failed_labelling_result(cluster_id)
+
+
+def _initial_labelling_messages(
+    cluster_id: str, df: pd.DataFrame, prompt: str, sampling_num: int, target_column: str
+) -> list[dict]:
+    cluster_data = df[df[target_column] == cluster_id]
+    sampling_num = min(sampling_num, len(cluster_data))
+    cluster = cluster_data.sample(sampling_num)
+    input = "\n".join(cluster["argument"].values)
+    return [
+        {"role": "system", "content": prompt},
+        {"role": "user", "content": input},
+    ]
+
+
+def _parse_labelling_response(cluster_id: str, response_text: str | dict) -> LabellingResult:
+    try:
+        response_json = json.loads(response_text) if isinstance(response_text, str) else response_text
+    except json.JSONDecodeError as e:
+        print(e)
+        return _failed_labelling_result(cluster_id)
+    return LabellingResult(
+        cluster_id=cluster_id,
+        label=response_json.get("label", "エラーでラベル名が取得できませんでした"),
+        description=response_json.get("description", "エラーで解説が取得できませんでした"),
+    )
+
+
+def _failed_labelling_result(cluster_id: str) -> LabellingResult:
+    return LabellingResult(
+        cluster_id=cluster_id,
+        label="エラーでラベル名が取得できませんでした",
+        description="エラーで解説が取得できませんでした",
+    )
@@ -1,5 +1,4 @@
 import json
-from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from functools import partial
 
@@ -8,6 +7,12 @@ import pandas as pd
 from pydantic import BaseModel, Field
 from tqdm import tqdm
 
+from services.adaptive_concurrency import (
+    create_concurrency_controller,
+    record_adaptive_concurrency,
+    run_in_sliding_window,
+)
+from services.incremental_clustering import is_append_mode, relabel_targets
 from services.llm import request_to_chat_ai
 
 
@@ -50,7 +55,7 @@ def hierarchical_merge_labelling(config: dict) -> None:
                 - sampling_num: サンプリング数
                 - prompt: LLMへのプロンプト
                 - model: 使用するLLMモデル名
-                - workers: 並列処理のワーカー数
+                - workers: 並列処理のワーカー数。"auto"の場合は同時実行数を自動調整する
             - provider: LLMプロバイダー
     """
     dataset = config["output_dir"]
@@ -58,11 +63,14 @@ def hierarchical_merge_labelling(config: dict) -> None:
     clusters_df = pd.read_csv(f"outputs/{dataset}/hierarchical_initial_labels.csv")
 
     cluster_id_columns: list[str] = _filter_id_columns(clusters_df.columns)
+    # --appendモードでは、所属する意見が大きく変わっていないクラスタに以前のラベルを使う
+    previous_labels = pd.read_csv(merge_path) if is_append_mode(config) else None
     # ボトムクラスタのラベル・説明とクラスタid付きの各argumentを入力し、各階層のクラスタラベル・説明を生成し、argumentに付けたdfを作成
     merge_result_df = merge_labelling(
         clusters_df=clusters_df,
         cluster_id_columns=sorted(cluster_id_columns, reverse=True),
         config=config,
+        previous_labels=previous_labels,
     )
     # 上記のdfから各クラスタのlevel, id, label, description, valueを取得してdfを作成
     melted_df = melt_cluster_data(merge_result_df)
@@ -166,17 +174,25 @@ def melt_cluster_data(df: pd.DataFrame) -> pd.DataFrame:
     return pd.DataFrame(all_rows)
 
 
-def merge_labelling(clusters_df: pd.DataFrame, cluster_id_columns: list[str], config) -> pd.DataFrame:
+def merge_labelling(
+    clusters_df: pd.DataFrame,
+    cluster_id_columns: list[str],
+    config,
+    previous_labels: pd.DataFrame | None = None,
+) -> pd.DataFrame:
     """階層的なクラスタのマージラベリングを実行する
 
     Args:
         clusters_df: クラスタリング結果のDataFrame
         cluster_id_columns: クラスタIDのカラム名のリスト
         config: 設定情報を含む辞書
+        previous_labels: 以前のマージラベリングの結果。指定した場合、ラベリングし直す対象でないクラスタはこのラベルを使う
 
     Returns:
         マージラベリング結果を含むDataFrame
     """
+    workers = config["hierarchical_merge_labelling"]["workers"]
+    controller = create_concurrency_controller(workers)
     for idx in tqdm(range(len(cluster_id_columns) - 1)):
         previous_columns = ClusterColumns.from_id_column(cluster_id_columns[idx])
         current_columns = ClusterColumns.from_id_column(cluster_id_columns[idx + 1])
@@ -190,19 +206,33 @@ def merge_labelling(clusters_df: pd.DataFrame, cluster_id_columns: list[str], co
         )
 
         current_cluster_ids = sorted(clusters_df[current_columns.id].unique())
-        with ThreadPoolExecutor(max_workers=config["hierarchical_merge_labelling"]["workers"]) as executor:
-            responses = list(
-                tqdm(
-                    executor.map(process_fn, current_cluster_ids),
-                    total=len(current_cluster_ids),
-                )
-            )
+        reused = (
+            _reusable_labels(previous_labels, current_columns, relabel_targets(config, current_columns.id))
+            if previous_labels is not None
+            else {}
+        )
+        tasks = [partial(process_fn, cluster_id) for cluster_id in current_cluster_ids if cluster_id not in reused]
+        responses = [reused[cluster_id] for cluster_id in current_cluster_ids if cluster_id in reused] + [
+            future.result() for _, future in tqdm(run_in_sliding_window(tasks, controller or workers), total=len(tasks))
+        ]
 
         current_result_df = pd.DataFrame(responses)
         clusters_df = clusters_df.merge(current_result_df, on=[current_columns.id])
+    if controller is not None:
+        record_adaptive_concurrency(config, "hierarchical_merge_labelling", controller)
     return clusters_df
 
 
+def _reusable_labels(previous_labels: pd.DataFrame, columns: ClusterColumns, relabel: set[str]) -> dict[str, dict]:
+    """以前のマージラベリングの結果から、relabelに含まれないクラスタのラベルと説明を返す"""
+    level = int(columns.id.replace("cluster-level-", "").replace("-id", ""))
+    records = previous_labels[(previous_labels["level"] == level) & ~previous_labels["id"].astype(str).isin(relabel)]
+    return {
+        row["id"]: {columns.id: row["id"], columns.label: row["label"], columns.description: row["description"]}
+        for _, row in records.iterrows()
+    }
+
+
 class LabellingFromat(BaseModel):
     """ラベリング結果のフォーマットを定義する"""
 
@@ -1,11 +1,13 @@
 """Create summaries for the clusters."""
 
 import json
+import os
 import re
 
 import pandas as pd
 from pydantic import BaseModel, Field
 
+from services.incremental_clustering import relabel_targets
 from services.llm import request_to_chat_ai
 
 
@@ -17,6 +19,11 @@ def hierarchical_overview(config):
     dataset = config["output_dir"]
     path = f"outputs/{dataset}/hierarchical_overview.txt"
 
+    # --appendモードで最上位のクラスタのラベルが変わっていない場合は、以前の要約をそのまま使う
+    if relabel_targets(config, "cluster-level-1-id") == set() and os.path.exists(path):
+        print("Top level clusters are unchanged, keeping the previous overview")
+        return
+
     hierarchical_label_df = pd.read_csv(f"outputs/{dataset}/hierarchical_merge_labels.csv")
 
     prompt = config["hierarchical_overview"]["prompt"]
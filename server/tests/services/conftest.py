@@ -0,0 +1,29 @@
+import importlib
+import os
+from pathlib import Path
+
+import pytest
+
+PIPELINE_DIR = Path(__file__).resolve().parents[2] / "broadlistening" / "pipeline"
+
+
+@pytest.fixture
+def load_pipeline_module(monkeypatch, tmp_path):
+    """パイプラインのモジュール(steps.extractionなど)を読み込む関数を返すフィクスチャ
+
+    パイプラインはbroadlistening/pipelineをカレントディレクトリにして実行され、モジュール同士は"services.llm"のように
+    インポートし合い、読み込み時にspecs.jsonを開く。読み込んだ後はtmp_pathをカレントディレクトリにするため、
+    テストではoutputs/・inputs/を一時ディレクトリに作ってステップを実行できる。
+    """
+    monkeypatch.syspath_prepend(str(PIPELINE_DIR))
+    monkeypatch.chdir(tmp_path)
+
+    def load(name: str):
+        cwd = os.getcwd()
+        os.chdir(PIPELINE_DIR)
+        try:
+            return importlib.import_module(name)
+        finally:
+            os.chdir(cwd)
+
+    return load
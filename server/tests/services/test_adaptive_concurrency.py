@@ -0,0 +1,242 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from broadlistening.pipeline.services import llm
+from broadlistening.pipeline.services.adaptive_concurrency import (
+    AdaptiveConcurrencyController,
+    RequestTimeoutError,
+    TaskRunStats,
+    create_concurrency_controller,
+    run_in_sliding_window,
+)
+from broadlistening.pipeline.services.async_runner import run_async_in_order
+
+
+class TestAdaptiveConcurrencyController:
+    """AIMDによる同時実行数の調整のテスト"""
+
+    def test_additive_increase(self):
+        """レイテンシが安定している間は、limit件成功するごとに同時実行数が1増える"""
+        controller = AdaptiveConcurrencyController(initial=2, max_limit=4)
+        for _ in range(2):
+            controller.record_success(1.0)
+        assert controller.limit == 3
+        for _ in range(20):
+            controller.record_success(1.0)
+        assert controller.limit == 4
+        assert controller.stats()["peak"] == 4
+
+    def test_multiplicative_decrease_on_throttling(self):
+        """429・タイムアウトでは同時実行数が半分になり、直後の連続したエラーでは減らしすぎない"""
+        controller = AdaptiveConcurrencyController(initial=16)
+        controller.record_success(10.0)
+        controller.record_error(TimeoutError())
+        controller.record_error(TimeoutError())
+        assert controller.limit == 8
+        assert controller.stats()["throttled"] == 2
+
+    def test_other_errors_do_not_decrease(self):
+        """レート制限以外のエラーでは同時実行数を減らさない"""
+        controller = AdaptiveConcurrencyController(initial=8)
+        controller.record_error(ValueError("bad request"))
+        assert controller.limit == 8
+
+    def test_decrease_on_latency_degradation(self):
+        """レイテンシが最良時から大きく悪化した場合は同時実行数を減らす"""
+        controller = AdaptiveConcurrencyController(initial=8, latency_tolerance=2.0)
+        controller.record_success(0.001)
+        for _ in range(10):
+            controller.record_success(1.0)
+        assert controller.limit < 8
+
+    def test_create_concurrency_controller(self):
+        """workersが"auto"の場合のみコントローラーを作成する"""
+        assert isinstance(create_concurrency_controller("auto"), AdaptiveConcurrencyController)
+        assert create_concurrency_controller(4) is None
+        with pytest.raises(ValueError):
+            create_concurrency_controller("many")
+
+
+class TestRunInSlidingWindow:
+    """スライディングウィンドウでのタスク実行のテスト"""
+
+    def test_yields_in_input_order(self):
+        """完了順に関わらず入力順に結果を返す"""
+
+        def task(i):
+            time.sleep(0.01 * (5 - i))
+            return i
+
+        tasks = [lambda i=i: task(i) for i in range(5)]
+        results = [(index, future.result()) for index, future in run_in_sliding_window(tasks, 3)]
+        assert results == [(i, i) for i in range(5)]
+
+    def test_respects_fixed_workers(self):
+        """整数を指定した場合は同時実行数がその値を超えない"""
+        running = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def task():
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.01)
+            with lock:
+                running -= 1
+
+        list(run_in_sliding_window([task] * 10, 2))
+        assert peak <= 2
+
+    def test_task_exception_is_raised_to_caller(self):
+        """タスクの例外は結果のfutureから呼び出し元に送出され、他のタスクの結果は返す"""
+
+        def failing():
+            raise ValueError("bad request")
+
+        futures = dict(run_in_sliding_window([lambda: "ok", failing, lambda: "ok"], 2))
+
+        assert futures[0].result() == "ok"
+        with pytest.raises(ValueError, match="bad request"):
+            futures[1].result()
+        assert futures[2].result() == "ok"
+
+    def test_controller_receives_request_outcomes(self):
+        """タスク内のrequest_to_chat_aiの結果がコントローラーに通知される"""
+        messages = [{"role": "user", "content": "Hello"}]
+
+        def task():
+            return llm.request_to_chat_ai(messages, model="gpt-4o", provider="openai")
+
+        controller = AdaptiveConcurrencyController(initial=1, max_limit=4)
+        with patch("broadlistening.pipeline.services.llm.request_to_openai", return_value=("response", 1, 1, 2)):
+            results = [future.result() for _, future in run_in_sliding_window([task] * 10, controller)]
+
+        assert len(results) == 10
+        assert controller.stats()["successes"] == 10
+        assert controller.limit > 1
+
+    def test_hung_task_is_abandoned_and_requeued(self):
+        """期限を過ぎたタスクは完了を待たずに見捨てて再投入し、他のタスクを止めない"""
+        release = threading.Event()
+        attempts = []
+
+        def hung_once():
+            attempts.append(1)
+            if len(attempts) == 1:
+                release.wait(10)
+            return "done"
+
+        stats = TaskRunStats()
+        started_at = time.monotonic()
+        results = [
+            future.result()
+            for _, future in run_in_sliding_window(
+                [hung_once, lambda: "ok"], 2, timeout=0.1, timeout_retries=1, stats=stats
+            )
+        ]
+        release.set()
+
+        assert results == ["done", "ok"]
+        assert time.monotonic() - started_at < 5
+        assert stats.timed_out_attempts == 1
+        assert stats.requeued == 1
+
+    def test_timed_out_task_gives_up_after_retries(self):
+        """再投入の上限に達したタスクにはRequestTimeoutErrorが設定される"""
+        release = threading.Event()
+        stats = TaskRunStats()
+        futures = dict(
+            run_in_sliding_window(
+                [lambda: release.wait(10), lambda: "ok"], 2, timeout=0.05, timeout_retries=1, stats=stats
+            )
+        )
+        release.set()
+
+        with pytest.raises(RequestTimeoutError):
+            futures[0].result()
+        assert futures[1].result() == "ok"
+        assert stats.timed_out_attempts == 2
+
+    def test_abandoned_threads_are_bounded(self):
+        """見捨てたタスクが溜まっても、スレッドは同時実行数の上限の2倍を超えて増えない"""
+        running = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def slow():
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.1)
+            with lock:
+                running -= 1
+
+        threads_before = threading.active_count()
+        stats = TaskRunStats()
+        futures = dict(run_in_sliding_window([slow] * 6, 2, timeout=0.02, timeout_retries=2, stats=stats))
+
+        assert peak <= 4
+        assert threading.active_count() - threads_before <= 4
+        assert stats.timed_out_attempts == 18
+        for future in futures.values():
+            with pytest.raises(RequestTimeoutError):
+                future.result()
+
+    def test_task_that_never_returns_does_not_stall_window(self):
+        """応答しないタスクは見捨てて同時実行数に含めず、他のタスクはworkers件で並行して実行し続ける"""
+        release = threading.Event()
+        running = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def quick():
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.05)
+            with lock:
+                running -= 1
+            return "ok"
+
+        stats = TaskRunStats()
+        started_at = time.monotonic()
+        try:
+            futures = dict(
+                run_in_sliding_window(
+                    [lambda: release.wait(60)] + [quick] * 12, 2, timeout=0.1, timeout_retries=1, stats=stats
+                )
+            )
+        finally:
+            release.set()
+
+        assert time.monotonic() - started_at < 5
+        with pytest.raises(RequestTimeoutError):
+            futures[0].result()
+        assert [futures[i].result() for i in range(1, 13)] == ["ok"] * 12
+        assert peak == 2
+        assert stats.timed_out_attempts == 2
+
+    def test_async_timed_out_task_is_cancelled(self):
+        """非同期版でも期限を過ぎたタスクはキャンセルして実行し直し、上限に達したらRequestTimeoutErrorになる"""
+        stats = TaskRunStats()
+
+        async def hang():
+            await asyncio.sleep(10)
+
+        async def ok():
+            return "ok"
+
+        futures = dict(run_async_in_order([hang, ok], 2, timeout=0.05, timeout_retries=2, stats=stats))
+
+        with pytest.raises(RequestTimeoutError):
+            futures[0].result()
+        assert futures[1].result() == "ok"
+        assert stats.timed_out_attempts == 3
+        assert stats.requeued == 2
@@ -0,0 +1,214 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from broadlistening.pipeline.services.batch_runner import (
+    BatchChatRequest,
+    BatchRequestError,
+    BatchTransport,
+    OpenAIBatchTransport,
+    build_chat_request_body,
+    configure_batch,
+    run_chat_batch,
+)
+from broadlistening.pipeline.services.llm_clients import configure_llm_clients
+from pydantic import BaseModel
+
+
+class Answer(BaseModel):
+    answer: str
+
+
+def answer_line(request: dict) -> dict:
+    """リクエストの最後のメッセージをそのまま返す結果の行"""
+    content = request["body"]["messages"][-1]["content"]
+    if content == "fail":
+        return {"custom_id": request["custom_id"], "response": None, "error": {"message": "server error"}}
+    body = {
+        "choices": [{"message": {"content": json.dumps({"answer": content})}}],
+        "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+    }
+    return {"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body}, "error": None}
+
+
+class FakeTransport(BatchTransport):
+    """アップロードしたファイルを、2回目の状態確認で完了させるBatch API"""
+
+    def __init__(self, skip_ids=()):
+        self.skip_ids = set(skip_ids)
+        self.files: dict[str, str] = {}
+        self.batches: dict[str, dict] = {}
+        self.uploads = 0
+
+    def upload(self, path):
+        self.uploads += 1
+        file_id = f"file-{len(self.files)}"
+        with open(path, encoding="utf-8") as f:
+            self.files[file_id] = f.read()
+        return file_id
+
+    def create_batch(self, input_file_id, completion_window):
+        batch_id = f"batch-{len(self.batches)}"
+        self.batches[batch_id] = {"input_file_id": input_file_id, "polls": 0}
+        return batch_id
+
+    def retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        batch["polls"] += 1
+        if batch["polls"] < 2:
+            return {"status": "in_progress"}
+        lines = [json.loads(line) for line in self.files[batch["input_file_id"]].splitlines()]
+        output, errors = [], []
+        for line in lines:
+            if line["custom_id"] in self.skip_ids:
+                continue
+            result = answer_line(line)
+            (errors if result["error"] else output).append(json.dumps(result))
+        self.files[f"{batch_id}-output"] = "\n".join(output)
+        self.files[f"{batch_id}-errors"] = "\n".join(errors)
+        return {"status": "completed", "output_file_id": f"{batch_id}-output", "error_file_id": f"{batch_id}-errors"}
+
+    def download(self, file_id):
+        return self.files[file_id]
+
+
+def requests_for(contents: list[str]) -> list[BatchChatRequest]:
+    return [
+        BatchChatRequest(custom_id=f"req-{i}", messages=[{"role": "user", "content": content}], json_schema=Answer)
+        for i, content in enumerate(contents)
+    ]
+
+
+class TestBatchRunner:
+    """Batch APIでの実行のテスト"""
+
+    @pytest.fixture(autouse=True)
+    def reset_batch_config(self):
+        yield
+        configure_batch(None)
+
+    def test_results_are_mapped_by_custom_id(self, tmp_path):
+        """結果をcustom_idごとに返し、失敗・欠落したリクエストはBatchRequestErrorにする"""
+        transport = FakeTransport(skip_ids={"req-2"})
+        configure_batch({"poll_interval": 0}, transport=transport)
+
+        results = run_chat_batch(requests_for(["a", "fail", "c"]), "gpt-4o-mini", "openai", str(tmp_path), "test")
+
+        assert results["req-0"] == ('{"answer": "a"}', 3, 2, 5)
+        assert isinstance(results["req-1"], BatchRequestError)
+        assert isinstance(results["req-2"], BatchRequestError)
+        request_lines = (tmp_path / "test_0.jsonl").read_text().splitlines()
+        assert json.loads(request_lines[0])["body"]["response_format"]["json_schema"]["name"] == "Answer"
+
+    def test_resumes_submitted_batch(self, tmp_path):
+        """同じリクエストで再実行した場合は、作成済みのバッチの結果を待つ"""
+        transport = FakeTransport()
+        configure_batch({"poll_interval": 0}, transport=transport)
+        run_chat_batch(requests_for(["a"]), "gpt-4o-mini", "openai", str(tmp_path), "test")
+        run_chat_batch(requests_for(["a"]), "gpt-4o-mini", "openai", str(tmp_path), "test")
+        assert transport.uploads == 1
+
+        run_chat_batch(requests_for(["b"]), "gpt-4o-mini", "openai", str(tmp_path), "test")
+        assert transport.uploads == 2
+
+    def test_build_chat_request_body(self):
+        """request_to_openaiと同じパラメータでリクエストする"""
+        body = build_chat_request_body([{"role": "user", "content": "hi"}], "gpt-4o-mini", is_json=True)
+        assert body["temperature"] == 0
+        assert body["seed"] == 0
+        assert body["response_format"] == {"type": "json_object"}
+
+    def test_build_chat_request_body_with_pydantic_model(self):
+        """Pydanticモデルはstrictなjson_schemaのresponse_formatにする"""
+
+        class Answers(BaseModel):
+            answers: list[Answer]
+
+        body = build_chat_request_body([{"role": "user", "content": "hi"}], "gpt-4o-mini", json_schema=Answers)
+        response_format = body["response_format"]
+        assert response_format["type"] == "json_schema"
+        assert response_format["json_schema"]["name"] == "Answers"
+        assert response_format["json_schema"]["strict"]
+        schema = response_format["json_schema"]["schema"]
+        assert schema["additionalProperties"] is False
+        assert schema["$defs"]["Answer"]["additionalProperties"] is False
+        assert schema["$defs"]["Answer"]["required"] == ["answer"]
+
+    def test_openai_transport_with_stand_in_server(self, tmp_path, stand_in_server):
+        """OpenAI互換のローカルの代替サーバーに対してバッチを実行できる"""
+        configure_llm_clients(None)
+        configure_batch(
+            {"poll_interval": 0}, transport=OpenAIBatchTransport("openai", base_url=f"{stand_in_server}/v1")
+        )
+        results = run_chat_batch(requests_for(["x", "y"]), "gpt-4o-mini", "openai", str(tmp_path), "test")
+        assert results["req-0"][0] == '{"answer": "x"}'
+        assert results["req-1"][0] == '{"answer": "y"}'
+
+    @pytest.fixture
+    def stand_in_server(self):
+        """Batch APIのファイル・バッチのエンドポイントだけを持つローカルの代替サーバー"""
+        files: dict[str, bytes] = {}
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _send_json(self, payload):
+                data = json.dumps(payload).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _batch(self, batch_id):
+                return {
+                    "id": batch_id,
+                    "object": "batch",
+                    "endpoint": "/v1/chat/completions",
+                    "input_file_id": "file-input",
+                    "completion_window": "24h",
+                    "created_at": 0,
+                    "status": "completed",
+                    "output_file_id": "file-output",
+                    "request_counts": {"total": 2, "completed": 2, "failed": 0},
+                }
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if self.path == "/v1/files":
+                    # multipartの本文から、リクエストの行だけを取り出す
+                    lines = [line for line in body.split(b"\r\n") if line.startswith(b'{"custom_id"')]
+                    requests = [json.loads(line) for line in b"\n".join(lines).splitlines()]
+                    files["file-output"] = "\n".join(json.dumps(answer_line(r)) for r in requests).encode()
+                    self._send_json(
+                        {
+                            "id": "file-input",
+                            "object": "file",
+                            "bytes": len(body),
+                            "created_at": 0,
+                            "filename": "requests.jsonl",
+                            "purpose": "batch",
+                        }
+                    )
+                else:
+                    self._send_json(self._batch("batch-1"))
+
+            def do_GET(self):
+                if self.path.startswith("/v1/batches/"):
+                    self._send_json(self._batch(self.path.rsplit("/", 1)[1]))
+                    return
+                data = files["file-output"]
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+        server.shutdown()
@@ -0,0 +1,176 @@
+import json
+from unittest.mock import patch
+
+import pandas as pd
+import pytest
+from broadlistening.pipeline.services import category_classification, llm
+from broadlistening.pipeline.services.category_classification import (
+    _parse_classification_response,
+    build_classification_schema,
+    classify_args,
+    load_classification_embeddings,
+)
+
+CATEGORIES = {"感情": {"ポジティブ": "肯定的な意見", "ネガティブ": "否定的な意見"}}
+
+
+def classify_all_positive(messages, model, json_schema, provider, local_llm_address):
+    """プロンプトに含まれる意見をすべてポジティブに分類するrequest_to_chat_aiの代わり"""
+    arg_ids = [line[2:].split(":")[0] for line in messages[0]["content"].splitlines() if line.startswith("- A")]
+    response = {"results": [{"argId": arg_id, "感情": "ポジティブ"} for arg_id in arg_ids]}
+    return json.dumps(response, ensure_ascii=False), 10, 5, 15
+
+
+class TestCategoryClassification:
+    """カテゴリ分類のテスト"""
+
+    @pytest.fixture
+    def config(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        return {
+            "output_dir": "test",
+            "provider": "azure",
+            "local_llm_address": None,
+            "extraction": {
+                "model": "gpt-4o-mini",
+                "categories": CATEGORIES,
+                "category_batch_size": 3,
+                "category_token_budget": 2000,
+                "category_classification_mode": "llm",
+                "execution_mode": "thread",
+            },
+        }
+
+    @pytest.fixture
+    def args(self):
+        return pd.DataFrame({"arg-id": [f"A{i}_0" for i in range(7)], "argument": [f"意見{i}" for i in range(7)]})
+
+    def test_batches_do_not_overlap(self, config, args):
+        """各意見は1つのバッチでだけ分類され、providerが渡される"""
+        with patch.object(
+            category_classification, "request_to_chat_ai", side_effect=classify_all_positive
+        ) as mock_request:
+            result = classify_args(args, config, workers=2)
+
+        assert mock_request.call_count == 3
+        classified = [
+            line
+            for call in mock_request.call_args_list
+            for line in call.kwargs["messages"][0]["content"].splitlines()
+            if line.startswith("- A")
+        ]
+        assert len(classified) == 7
+        assert {call.kwargs["provider"] for call in mock_request.call_args_list} == {"azure"}
+        assert list(result["感情"]) == ["ポジティブ"] * 7
+        assert config["total_token_usage"] == 45
+
+    def test_batches_respect_token_budget(self, config, args):
+        """推定トークン数の予算を超える場合はバッチを分ける"""
+        config["extraction"]["category_token_budget"] = 3
+        with patch.object(
+            category_classification, "request_to_chat_ai", side_effect=classify_all_positive
+        ) as mock_request:
+            classify_args(args, config, workers=1)
+        assert mock_request.call_count == 7
+
+    def test_resume_skips_journaled_arguments(self, config, args):
+        """再開時はジャーナルに記録済みの意見を分類し直さない"""
+        with patch.object(category_classification, "request_to_chat_ai", side_effect=classify_all_positive):
+            classify_args(args.iloc[:3], config, workers=1)
+
+        with patch.object(
+            category_classification, "request_to_chat_ai", side_effect=classify_all_positive
+        ) as mock_request:
+            result = classify_args(args, config, workers=1, resume=True)
+
+        assert mock_request.call_count == 2
+        assert "A0_0" not in mock_request.call_args_list[0].kwargs["messages"][0]["content"]
+        assert list(result["感情"]) == ["ポジティブ"] * 7
+
+    def test_failed_batch_leaves_categories_empty(self, config, args):
+        """失敗したバッチの意見は分類結果を空にする"""
+
+        def fail_first_batch(messages, **kwargs):
+            if "A0_0" in messages[0]["content"]:
+                raise RuntimeError("server error")
+            return classify_all_positive(messages, **kwargs)
+
+        with patch.object(category_classification, "request_to_chat_ai", side_effect=fail_first_batch):
+            result = classify_args(args, config, workers=1)
+        assert result["感情"].isna().sum() == 3
+
+    def test_schema_restricts_category_values(self):
+        """スキーマはカテゴリ名をキーとし、値を分類先に制限する"""
+        schema = build_classification_schema(CATEGORIES).model_json_schema()
+        item = schema["$defs"]["ClassificationItem"]
+        assert item["properties"]["感情"]["enum"] == ["ポジティブ", "ネガティブ"]
+
+    def test_parse_response_with_field_names(self):
+        """パース済みのdict(フィールド名)のレスポンスも読み取れる"""
+        response = {"results": [{"argId": "A1_0", "category_0": "ネガティブ"}]}
+        assert _parse_classification_response(response, ["感情"]) == {"A1_0": {"感情": "ネガティブ"}}
+        assert _parse_classification_response("not json", ["感情"]) == {}
+
+
+def embed_by_keyword(texts, model, is_embedded_at_local, provider, local_llm_address, dimensions=None):
+    """「良い」「悪い」を含むかどうかで2次元のベクトルを返すrequest_to_embedの代わり"""
+    return [[float("良い" in t or "肯定" in t), float("悪い" in t or "否定" in t)] for t in texts]
+
+
+class TestEmbeddingClassification:
+    """埋め込みの類似度によるカテゴリ分類のテスト"""
+
+    @pytest.fixture
+    def config(self, tmp_path, monkeypatch):
+        monkeypatch.chdir(tmp_path)
+        (tmp_path / "outputs" / "test").mkdir(parents=True)
+        return {
+            "output_dir": "test",
+            "provider": "openai",
+            "local_llm_address": None,
+            "is_embedded_at_local": False,
+            "embedding": {
+                "model": "text-embedding-3-small",
+                "dimensions": None,
+                "workers": 1,
+                "batch_token_budget": 50000,
+                "batch_size": 1000,
+            },
+            "extraction": {
+                "model": "gpt-4o-mini",
+                "categories": CATEGORIES,
+                "category_batch_size": 5,
+                "category_token_budget": 2000,
+                "category_classification_mode": "embedding",
+                "category_embedding_margin": 0.1,
+                "execution_mode": "thread",
+            },
+        }
+
+    def test_low_margin_arguments_are_escalated(self, config):
+        """類似度の差が小さい意見だけをLLMで分類する"""
+        args = pd.DataFrame({"arg-id": ["A0_0", "A1_0", "A2_0"], "argument": ["良い政策", "悪い政策", "良いが悪い"]})
+        with (
+            patch.object(llm, "request_to_embed", side_effect=embed_by_keyword),
+            patch.object(
+                category_classification, "request_to_chat_ai", side_effect=classify_all_positive
+            ) as mock_request,
+        ):
+            result = classify_args(args, config, workers=1)
+
+        assert mock_request.call_count == 1
+        assert "A2_0" in mock_request.call_args.kwargs["messages"][0]["content"]
+        assert "A0_0" not in mock_request.call_args.kwargs["messages"][0]["content"]
+        assert list(result["感情"]) == ["ポジティブ", "ネガティブ", "ポジティブ"]
+        assert config["category_classification"]["assigned_by_embedding"] == 2
+        assert config["category_classification"]["escalated_to_llm"] == 1
+
+    def test_saved_embeddings_are_reused_with_same_model(self, config):
+        """保存した意見の埋め込みは、同じモデルの場合だけ読み込む"""
+        args = pd.DataFrame({"arg-id": ["A0_0"], "argument": ["良い政策"]})
+        with patch.object(llm, "request_to_embed", side_effect=embed_by_keyword):
+            classify_args(args, config, workers=1)
+
+        assert load_classification_embeddings(config) == {"良い政策": [1.0, 0.0]}
+        config["embedding"]["model"] = "text-embedding-3-large"
+        assert load_classification_embeddings(config) == {}
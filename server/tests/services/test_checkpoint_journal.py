@@ -0,0 +1,84 @@
+from broadlistening.pipeline.services.checkpoint_journal import CheckpointJournal
+
+
+class TestCheckpointJournal:
+    """チェックポイントジャーナルのテスト"""
+
+    def test_append_and_load(self, tmp_path):
+        """追記した結果を再開時に読み込める"""
+        path = str(tmp_path / "journal.jsonl")
+        journal = CheckpointJournal(path, header={"model": "gpt-4o"})
+        journal.open(resume=False)
+        journal.append("1", ["意見1", "意見2"])
+        journal.append("2", [])
+        journal.close()
+
+        assert CheckpointJournal(path, header={"model": "gpt-4o"}).load() == {"1": ["意見1", "意見2"], "2": []}
+
+    def test_resume_appends_to_existing_entries(self, tmp_path):
+        """resume=Trueで開いた場合は既存の記録を残したまま追記する"""
+        path = str(tmp_path / "journal.jsonl")
+        journal = CheckpointJournal(path, header={"model": "gpt-4o"})
+        journal.open(resume=False)
+        journal.append("1", ["意見1"])
+        journal.close()
+
+        journal = CheckpointJournal(path, header={"model": "gpt-4o"})
+        journal.open(resume=True)
+        journal.append("2", ["意見2"])
+        journal.close()
+
+        assert journal.load() == {"1": ["意見1"], "2": ["意見2"]}
+
+    def test_header_mismatch_discards_entries(self, tmp_path):
+        """異なる設定で書かれたジャーナルは読み込まず、開き直すと破棄される"""
+        path = str(tmp_path / "journal.jsonl")
+        journal = CheckpointJournal(path, header={"model": "gpt-4o"})
+        journal.open(resume=False)
+        journal.append("1", ["意見1"])
+        journal.close()
+
+        other = CheckpointJournal(path, header={"model": "gpt-4o-mini"})
+        assert other.load() == {}
+        other.open(resume=True)
+        other.close()
+        assert CheckpointJournal(path, header={"model": "gpt-4o"}).load() == {}
+
+    def test_skips_broken_last_line(self, tmp_path):
+        """クラッシュで書きかけになった行は読み飛ばす"""
+        path = tmp_path / "journal.jsonl"
+        journal = CheckpointJournal(str(path), header={"model": "gpt-4o"})
+        journal.open(resume=False)
+        journal.append("1", ["意見1"])
+        journal.close()
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"key": "2", "val')
+
+        assert journal.load() == {"1": ["意見1"]}
+
+    def test_resume_after_broken_last_line(self, tmp_path):
+        """書きかけの行があるジャーナルを再開しても、再開後に追記した結果は失われない"""
+        path = tmp_path / "journal.jsonl"
+        journal = CheckpointJournal(str(path), header={"model": "gpt-4o"})
+        journal.open(resume=False)
+        journal.append("1", ["意見1"])
+        journal.close()
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"key": "2", "val')
+
+        journal.open(resume=True)
+        journal.append("3", ["意見3"])
+        journal.close()
+
+        assert journal.load() == {"1": ["意見1"], "3": ["意見3"]}
+
+    def test_is_resumable(self, tmp_path):
+        """ジャーナルが存在し、ヘッダーが一致する場合だけ再開できる"""
+        path = str(tmp_path / "journal.jsonl")
+        journal = CheckpointJournal(path, header={"model": "gpt-4o"})
+        assert not journal.is_resumable()
+        journal.open(resume=False)
+        journal.close()
+
+        assert journal.is_resumable()
+        assert not CheckpointJournal(path, header={"model": "gpt-4o-mini"}).is_resumable()
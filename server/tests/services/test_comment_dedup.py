@@ -0,0 +1,32 @@
+from broadlistening.pipeline.services.comment_dedup import find_duplicate_comments, normalize_comment
+
+
+class TestCommentDedup:
+    """重複コメント集約のテスト"""
+
+    def test_normalize_comment(self):
+        """normalize_comment: 全角・半角、空白、句読点の違いを無視する"""
+        assert normalize_comment("ＡＩの 規制に、反対です！") == normalize_comment("AIの規制に反対です")
+
+    def test_exact_duplicates(self):
+        """正規化後に完全一致するコメントは最初に出現したコメントに集約される"""
+        result = find_duplicate_comments(
+            ["AIの規制に反対です。", "環境問題が大事です", "ＡＩの規制に 反対です！"],
+            similarity_threshold=1.0,
+        )
+        assert result.representatives == [0, 1, 0]
+        assert result.exact_duplicates == 1
+        assert result.near_duplicates == 0
+        assert result.unique_count == 2
+
+    def test_near_duplicates(self):
+        """一部だけ異なるコメントは類似度の閾値を満たす場合に集約される"""
+        base = "生成AIの学習に著作物を無断で利用することには反対です。クリエイターへの対価の還元が必要だと考えます。"
+        bodies = [base, base + "以上です。", "公共交通機関の充実を優先してほしいです。"]
+
+        result = find_duplicate_comments(bodies, similarity_threshold=0.8)
+        assert result.representatives == [0, 0, 2]
+        assert result.near_duplicates == 1
+
+        # 完全一致のみの場合は集約されない
+        assert find_duplicate_comments(bodies, similarity_threshold=1.0).representatives == [0, 1, 2]
@@ -0,0 +1,83 @@
+from unittest.mock import patch
+
+import pytest
+from broadlistening.pipeline.services import llm
+from broadlistening.pipeline.services.embedding_cache import EmbeddingCache, text_hash
+
+
+def fake_embed(args, model, is_embedded_at_local=False, provider="openai", local_llm_address=None, dimensions=None):
+    """テキストの長さを要素にしたベクトルを返す_request_to_embedの代わり"""
+    return [[float(len(text)), 0.5] for text in args]
+
+
+class TestEmbeddingCache:
+    """埋め込みキャッシュのテスト"""
+
+    @pytest.fixture
+    def enabled_cache(self, tmp_path):
+        """request_to_embedのキャッシュを一時ディレクトリで有効化するフィクスチャ"""
+        llm.configure_embedding_cache({"enabled": True, "path": str(tmp_path / "embeddings.sqlite3")})
+        yield
+        llm.configure_embedding_cache(None)
+
+    def test_text_hash_ignores_whitespace_differences(self):
+        """text_hash: 前後・連続する空白の違いは同じテキストとみなす"""
+        assert text_hash(" 駅前に 駐輪場を\n作ってほしい ") == text_hash("駅前に 駐輪場を 作ってほしい")
+        assert text_hash("駅前に駐輪場") != text_hash("駅前に駐車場")
+
+    def test_vectors_are_stored_per_model_as_float32(self, tmp_path):
+        """get_many/set_many: ベクトルはモデルごとにfloat32で保存され、別インスタンスからも参照できる"""
+        path = str(tmp_path / "embeddings.sqlite3")
+        EmbeddingCache(path=path).set_many("openai/text-embedding-3-small", ["意見"], [[0.1, 0.25]])
+
+        cache = EmbeddingCache(path=path)
+        vectors = cache.get_many("openai/text-embedding-3-small", ["意見", "別の意見"])
+        assert vectors[0] == pytest.approx([0.1, 0.25], abs=1e-7)
+        assert vectors[1] is None
+        assert cache.get_many("openai/text-embedding-3-large", ["意見"]) == [None]
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 2
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """合計サイズが上限を超えた場合は最後に参照された時刻が古いものから削除する"""
+        # 2次元のfloat32ベクトル(8バイト)を2件まで保存できる上限
+        cache = EmbeddingCache(path=str(tmp_path / "embeddings.sqlite3"), max_size_mb=20 / (1024 * 1024))
+        cache.set_many("m", ["old"], [[1.0, 1.0]])
+        cache.set_many("m", ["recent"], [[2.0, 2.0]])
+        cache.get_many("m", ["old"])  # oldを参照してrecentより新しくする
+        cache.set_many("m", ["new"], [[3.0, 3.0]])
+
+        assert cache.get_many("m", ["recent", "old", "new"])[0] is None
+        assert cache.stats()["evictions"] == 1
+        assert cache.stats()["entries"] == 2
+
+    def test_request_to_embed_only_sends_misses(self, enabled_cache):
+        """request_to_embed: キャッシュにないテキストだけをリクエストし、順序を保って返す"""
+        with patch.object(llm, "_request_to_embed", side_effect=fake_embed) as mock_embed:
+            first = llm.request_to_embed(["a", "bb"], "text-embedding-3-small")
+            second = llm.request_to_embed(["bb", "ccc", "a"], "text-embedding-3-small")
+            third = llm.request_to_embed(["a", "bb", "ccc"], "text-embedding-3-small")
+
+        assert first == [[1.0, 0.5], [2.0, 0.5]]
+        assert second == [[2.0, 0.5], [3.0, 0.5], [1.0, 0.5]]
+        assert third == [[1.0, 0.5], [2.0, 0.5], [3.0, 0.5]]
+        assert [call.args[0] for call in mock_embed.call_args_list] == [["a", "bb"], ["ccc"]]
+        assert llm.get_embedding_cache_stats()["hits"] == 5
+
+    def test_request_to_embed_without_cache(self):
+        """request_to_embed: キャッシュが無効な場合は毎回リクエストする"""
+        with patch.object(llm, "_request_to_embed", side_effect=fake_embed) as mock_embed:
+            llm.request_to_embed(["a"], "text-embedding-3-small")
+            llm.request_to_embed(["a"], "text-embedding-3-small")
+
+        assert mock_embed.call_count == 2
+        assert llm.get_embedding_cache_stats() is None
+
+    def test_dimensions_are_part_of_cache_key(self, enabled_cache):
+        """request_to_embed: 次元数を変えた埋め込みは別のキャッシュとして扱う"""
+        with patch.object(llm, "_request_to_embed", side_effect=fake_embed) as mock_embed:
+            llm.request_to_embed(["a"], "text-embedding-3-small", dimensions=256)
+            llm.request_to_embed(["a"], "text-embedding-3-small")
+            llm.request_to_embed(["a"], "text-embedding-3-small", dimensions=256)
+
+        assert [call.args[5] for call in mock_embed.call_args_list] == [256, None]
@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+from broadlistening.pipeline.services.embedding_store import load_embeddings, save_embeddings
+
+
+class TestEmbeddingStore:
+    """埋め込みの保存・読み込みのテスト"""
+
+    def test_round_trip_as_memory_mapped_float32(self, tmp_path):
+        """保存した埋め込みはfloat32の行列としてメモリマップで読み込める"""
+        save_embeddings(str(tmp_path), ["A1_0", "A2_0"], iter([[0.1, 0.2], [0.3, 0.4]]), dimension=2)
+
+        arg_ids, matrix = load_embeddings(str(tmp_path))
+
+        assert arg_ids == ["A1_0", "A2_0"]
+        assert isinstance(matrix, np.memmap)
+        assert matrix.dtype == np.float32
+        np.testing.assert_allclose(matrix, [[0.1, 0.2], [0.3, 0.4]], rtol=1e-6)
+
+    def test_load_legacy_pickle(self, tmp_path):
+        """以前の形式(embeddings.pkl)しかない場合はpickleから読み込む"""
+        pd.DataFrame({"arg-id": ["A1_0"], "embedding": [[0.5, 0.25]]}).to_pickle(tmp_path / "embeddings.pkl")
+
+        arg_ids, matrix = load_embeddings(str(tmp_path))
+
+        assert arg_ids == ["A1_0"]
+        assert matrix.dtype == np.float32
+        np.testing.assert_allclose(matrix, [[0.5, 0.25]])
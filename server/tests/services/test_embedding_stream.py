@@ -0,0 +1,75 @@
+import threading
+
+from broadlistening.pipeline.services.embedding_stream import (
+    EmbeddingStream,
+    start_embedding_stream,
+    take_streamed_embeddings,
+)
+
+
+class RecordingEmbedder:
+    """受け取ったバッチを記録し、文字数のベクトルを返す埋め込み関数"""
+
+    def __init__(self, fail_on: str | None = None):
+        self.fail_on = fail_on
+        self.batches: list[list[str]] = []
+        self._lock = threading.Lock()
+
+    def __call__(self, texts):
+        with self._lock:
+            self.batches.append(list(texts))
+        if self.fail_on in texts:
+            raise RuntimeError("server error")
+        return [[float(len(text))] for text in texts]
+
+
+def stream_config(streaming=True, run_embedding=True):
+    return {
+        "provider": "openai",
+        "is_embedded_at_local": False,
+        "plan": [{"step": "embedding", "run": run_embedding}],
+        "embedding": {
+            "model": "text-embedding-3-small",
+            "dimensions": None,
+            "streaming": streaming,
+            "workers": 2,
+            "batch_token_budget": 50000,
+            "batch_size": 1000,
+        },
+    }
+
+
+class TestEmbeddingStream:
+    """抽出と並行した埋め込みのテスト"""
+
+    def test_batches_follow_budget_and_skip_duplicates(self):
+        """意見は予算ごとのバッチにまとめ、同じ本文は1度だけ埋め込む"""
+        embedder = RecordingEmbedder()
+        stream = EmbeddingStream(embedder, workers=2, token_budget=4, batch_size=10, flush_interval=60)
+        stream.submit(["ああ", "いい"])
+        stream.submit(["ああ", "ううう"])
+        embeddings = stream.close()
+
+        assert embeddings == {"ああ": [2.0], "いい": [2.0], "ううう": [3.0]}
+        assert sorted(map(len, embedder.batches)) == [1, 2]
+
+    def test_failed_batches_are_left_to_embedding_step(self):
+        """失敗したバッチの意見は結果に含めず、件数だけ記録する"""
+        embedder = RecordingEmbedder(fail_on="bad")
+        stream = EmbeddingStream(embedder, workers=1, token_budget=10, batch_size=1, flush_interval=60)
+        stream.submit(["bad", "good"])
+        embeddings = stream.close()
+
+        assert embeddings == {"good": [4.0]}
+        assert stream.failed_batches == 1
+
+    def test_started_only_when_embedding_step_runs(self):
+        """streamingが無効、またはembeddingステップを実行しない場合はストリームを作らない"""
+        assert start_embedding_stream(stream_config(streaming=False)) is None
+        assert start_embedding_stream(stream_config(run_embedding=False)) is None
+
+        config = stream_config()
+        assert start_embedding_stream(config) is not None
+        assert take_streamed_embeddings(config) == {}
+        assert config["embedding_stream"] == {"streamed": 0, "failed_batches": 0}
+        assert take_streamed_embeddings(config) == {}
@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+SPECS_PATH = Path(__file__).resolve().parents[2] / "broadlistening" / "pipeline" / "hierarchical_specs.json"
+DATASET = "test"
+
+
+class TestExtractInSlidingWindow:
+    """extract_in_sliding_windowの並行実行のテスト"""
+
+    @pytest.fixture
+    def extraction(self, load_pipeline_module):
+        return load_pipeline_module("steps.extraction")
+
+    def test_yields_in_input_order(self, extraction, monkeypatch):
+        """後のコメントほど早く完了しても、抽出結果は入力順に返す"""
+
+        def extract_arguments(comment, prompt, model, provider, local_llm_address):
+            time.sleep(0.01 * (5 - int(comment)))
+            return [f"意見{comment}"], 1, 1, 2
+
+        monkeypatch.setattr(extraction, "extract_arguments", extract_arguments)
+        config = {}
+        results = list(
+            extraction.extract_in_sliding_window([str(i) for i in range(5)], "prompt", "gpt-4o", 3, config=config)
+        )
+
+        assert results == [(i, [f"意見{i}"], None) for i in range(5)]
+        assert config["total_token_usage"] == 10
+
+    def test_respects_workers(self, extraction, monkeypatch):
+        """同時に実行するリクエストはworkers件を超えない"""
+        running = 0
+        peak = 0
+        lock = threading.Lock()
+
+        def extract_arguments(comment, prompt, model, provider, local_llm_address):
+            nonlocal running, peak
+            with lock:
+                running += 1
+                peak = max(peak, running)
+            time.sleep(0.01)
+            with lock:
+                running -= 1
+            return [comment], 0, 0, 0
+
+        monkeypatch.setattr(extraction, "extract_arguments", extract_arguments)
+        results = list(extraction.extract_in_sliding_window([str(i) for i in range(10)], "prompt", "gpt-4o", 2))
+
+        assert len(results) == 10
+        assert peak == 2
+
+    def test_request_error_is_surfaced(self, extraction, monkeypatch):
+        """失敗したリクエストのエラーは該当するコメントの結果として返し、他のコメントの抽出は続ける"""
+
+        def extract_arguments(comment, prompt, model, provider, local_llm_address):
+            if comment == "1":
+                raise ValueError("bad request")
+            return [comment], 0, 0, 0
+
+        monkeypatch.setattr(extraction, "extract_arguments", extract_arguments)
+        config = {"extraction_request_errors": {"failed": 0, "timed_out": 0}}
+        results = list(extraction.extract_in_sliding_window(["0", "1", "2"], "prompt", "gpt-4o", 2, config=config))
+
+        assert results == [(0, ["0"], None), (1, None, "ValueError: bad request"), (2, ["2"], None)]
+        assert config["extraction_request_errors"]["failed"] == 1
+
+    def test_request_error_is_not_hidden(self, extraction, monkeypatch):
+        """リクエスト自体がValueErrorを送出した場合は、そのまま呼び出し元に送出する"""
+
+        def request_to_chat_ai(**kwargs):
+            raise ValueError(f"Unknown provider: {kwargs['provider']}")
+
+        monkeypatch.setattr(extraction, "request_to_chat_ai", request_to_chat_ai)
+        with pytest.raises(ValueError, match="Unknown provider: unknown"):
+            extraction.extract_arguments("コメント", "prompt", "gpt-4o", provider="unknown")
+
+
+def extraction_config(**options) -> dict:
+    with open(SPECS_PATH) as f:
+        specs = {step["step"]: step for step in json.load(f)}
+    return {
+        "input": DATASET,
+        "output_dir": DATASET,
+        "provider": "openai",
+        "plan": [{"step": "extraction", "run": True}],
+        "embedding": specs["embedding"]["options"],
+        "extraction": {
+            **specs["extraction"]["options"],
+            "model": "gpt-4o-mini",
+            "prompt": "意見を抽出してください",
+            **options,
+        },
+    }
+
+
+class TestExtractionRetries:
+    """抽出に失敗したコメントの再試行のテスト"""
+
+    @pytest.fixture
+    def extraction(self, load_pipeline_module, monkeypatch):
+        Path("inputs").mkdir()
+        Path(f"outputs/{DATASET}").mkdir(parents=True)
+        pd.DataFrame({"comment-id": [1, 2, 3], "comment-body": ["一", "二", "三"]}).to_csv(
+            f"inputs/{DATASET}.csv", index=False
+        )
+        extraction = load_pipeline_module("steps.extraction")
+        self.requests = []
+
+        def request_to_chat_ai(messages, **kwargs):
+            body = messages[1]["content"]
+            self.requests.append(body)
+            # 「二」は最初の1回だけ、「三」は毎回失敗する
+            if body == "三" or (body == "二" and self.requests.count(body) == 1):
+                raise ConnectionError("connection reset")
+            return json.dumps({"extractedOpinionList": [f"{body}の意見"]}, ensure_ascii=False), 1, 1, 2
+
+        monkeypatch.setattr(extraction, "request_to_chat_ai", request_to_chat_ai)
+        return extraction
+
+    def test_failed_comments_are_retried_and_recorded(self, extraction, load_pipeline_module):
+        """失敗したコメントは再試行し、失敗し続けたコメントはextraction_failures.jsonlとステータスに記録する"""
+        config = extraction_config(workers=2, failure_retries=2, failure_retry_backoff=0)
+        load_pipeline_module("hierarchical_utils").run_step("extraction", extraction.extraction, config)
+
+        assert sorted(self.requests) == ["一", "三", "三", "三", "二", "二"]
+        args = pd.read_csv(f"outputs/{DATASET}/args.csv")
+        assert sorted(args["argument"]) == ["一の意見", "二の意見"]
+
+        with open(f"outputs/{DATASET}/extraction_failures.jsonl", encoding="utf-8") as f:
+            failures = [json.loads(line) for line in f]
+        assert failures == [
+            {"comment-id": 3, "comment-body": "三", "error": "ConnectionError: connection reset", "attempts": 3}
+        ]
+
+        with open(f"outputs/{DATASET}/hierarchical_status.json") as f:
+            status = json.load(f)
+        assert status["extraction_failures"] == {"first_pass": 2, "recovered": 1, "failed": 1}
+        assert status["extraction_request_errors"]["failed"] == 4
+        assert status["extraction_request_errors"]["timed_out"] == 0
+
+    def test_failures_file_is_removed_when_all_recovered(self, extraction):
+        """再試行ですべて抽出できた場合は、前回の実行で書き出した失敗の記録を残さない"""
+        Path(f"outputs/{DATASET}/extraction_failures.jsonl").write_text("{}\n")
+        config = extraction_config(limit=2, failure_retries=1, failure_retry_backoff=0)
+        extraction.extraction(config)
+
+        assert config["extraction_failures"] == {"first_pass": 1, "recovered": 1, "failed": 0}
+        assert not Path(f"outputs/{DATASET}/extraction_failures.jsonl").exists()
+
+
+class TestExtractionWithLLMCache:
+    """LLMのレスポンスキャッシュを有効にした抽出のテスト"""
+
+    @pytest.fixture
+    def llm(self, load_pipeline_module, tmp_path):
+        llm = load_pipeline_module("services.llm")
+        llm.configure_llm_cache({"enabled": True, "path": str(tmp_path / "cache.sqlite3")})
+        yield llm
+        llm.configure_llm_cache(None)
+
+    def test_retry_recovers_from_invalid_response(self, load_pipeline_module, llm, monkeypatch):
+        """解釈できないレスポンスはキャッシュせず、再試行ではAPIにリクエストし直して抽出できる"""
+        Path("inputs").mkdir()
+        Path(f"outputs/{DATASET}").mkdir(parents=True)
+        pd.DataFrame({"comment-id": [1], "comment-body": ["一"]}).to_csv(f"inputs/{DATASET}.csv", index=False)
+        responses = ["not json", json.dumps({"extractedOpinionList": ["一の意見"]}, ensure_ascii=False)]
+        requests = []
+
+        def dispatch(messages, model, is_json, json_schema, provider, local_llm_address):
+            requests.append(messages)
+            return responses[len(requests) - 1], 1, 1, 2
+
+        monkeypatch.setattr(llm, "_dispatch_chat_request", dispatch)
+        extraction = load_pipeline_module("steps.extraction")
+        config = extraction_config(failure_retries=1, failure_retry_backoff=0)
+        extraction.extraction(config)
+
+        assert len(requests) == 2
+        assert config["extraction_failures"] == {"first_pass": 1, "recovered": 1, "failed": 0}
+        assert list(pd.read_csv(f"outputs/{DATASET}/args.csv")["argument"]) == ["一の意見"]
+        # 検証を通ったレスポンスはキャッシュされ、次の実行ではAPIを呼ばない
+        assert extraction.extract_arguments("一", config["extraction"]["prompt"], "gpt-4o-mini") == (
+            ["一の意見"],
+            0,
+            0,
+            0,
+        )
+        assert len(requests) == 2
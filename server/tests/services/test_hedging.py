@@ -0,0 +1,202 @@
+import asyncio
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from broadlistening.pipeline.services import hedging, llm
+from broadlistening.pipeline.services.async_runner import run_coroutine
+from broadlistening.pipeline.services.hedging import (
+    ChatTarget,
+    CircuitBreaker,
+    HedgingPolicy,
+    ProviderUnavailableError,
+    configure_hedging,
+    get_hedging_stats,
+)
+
+PRIMARY = ChatTarget("openai", "gpt-4o-mini")
+FALLBACK = ChatTarget("openrouter", "google/gemini-2.0-flash")
+
+
+def warmed_policy(**kwargs) -> HedgingPolicy:
+    """プライマリのレイテンシを記録済みで、すぐにヘッジするポリシー"""
+    policy = HedgingPolicy(min_samples=1, min_delay=0.05, **kwargs)
+    policy._record_outcome(PRIMARY, 0.01, None)
+    return policy
+
+
+class TestCircuitBreaker:
+    """サーキットブレーカーのテスト"""
+
+    def test_opens_after_consecutive_failures(self):
+        """連続で失敗すると開き、リセットまでの間はリクエストを拒否する"""
+        now = [0.0]
+        with patch.object(hedging.time, "monotonic", lambda: now[0]):
+            breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10)
+            breaker.record_failure()
+            assert breaker.allow_request()
+            breaker.record_failure()
+            assert breaker.state == "open"
+            assert not breaker.allow_request()
+
+            # リセット後は1件だけ試しに送り、成功すれば閉じる
+            now[0] = 11.0
+            assert breaker.allow_request()
+            assert not breaker.allow_request()
+            breaker.record_success()
+            assert breaker.state == "closed"
+            assert breaker.opened == 1
+            assert breaker.rejected == 2
+
+    def test_half_open_failure_reopens(self):
+        """半開状態での試行が失敗すると再び開く"""
+        now = [0.0]
+        with patch.object(hedging.time, "monotonic", lambda: now[0]):
+            breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10)
+            breaker.record_failure()
+            now[0] = 11.0
+            assert breaker.allow_request()
+            breaker.record_failure()
+            assert breaker.state == "open"
+            assert breaker.opened == 2
+
+
+class TestHedgingPolicy:
+    """ヘッジ・フォールバックのテスト"""
+
+    @pytest.fixture(autouse=True)
+    def reset_policy(self):
+        yield
+        configure_hedging(None)
+
+    def test_no_hedge_without_latency_samples(self):
+        """レイテンシの記録が足りない間は重複リクエストを送らない"""
+        policy = HedgingPolicy(min_samples=5, fallbacks=[FALLBACK])
+        assert policy.hedge_delay(PRIMARY) is None
+        assert policy.call(lambda target: (target.provider, 1, 1, 2), PRIMARY) == (PRIMARY, ("openai", 1, 1, 2))
+        assert policy.stats()["hedged_requests"] == 0
+
+    def test_hedge_to_fallback_wins(self):
+        """プライマリが遅い場合はフォールバック先に重複リクエストを送り、先に返った応答を使う"""
+        policy = warmed_policy(fallbacks=[FALLBACK])
+        release = threading.Event()
+
+        def send(target):
+            if target == PRIMARY:
+                release.wait(5)
+                return "primary", 10, 10, 20
+            return "fallback", 5, 5, 10
+
+        assert policy.call(send, PRIMARY) == (FALLBACK, ("fallback", 5, 5, 10))
+        release.set()
+        deadline = time.monotonic() + 5
+        while policy.stats()["wasted_tokens"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        stats = policy.stats()
+        assert stats["hedged_requests"] == 1
+        assert stats["hedge_wins"] == 1
+        assert stats["hedged_tokens"] == 10
+        # 負けたプライマリのトークンは無駄になった分として数える
+        assert stats["wasted_tokens"] == 20
+
+    def test_failover_on_error(self):
+        """プライマリが失敗した場合はフォールバック先に送り直す"""
+        policy = HedgingPolicy(fallbacks=[FALLBACK])
+
+        def send(target):
+            if target == PRIMARY:
+                raise RuntimeError("server error")
+            return "fallback", 5, 5, 10
+
+        assert policy.call(send, PRIMARY) == (FALLBACK, ("fallback", 5, 5, 10))
+        assert policy.stats()["failovers"] == 1
+
+    def test_skips_open_circuit(self):
+        """サーキットブレーカーが開いているプロバイダーには送らない"""
+        policy = HedgingPolicy(fallbacks=[FALLBACK], failure_threshold=1)
+        policy.breaker("openai").record_failure()
+        sent = []
+
+        def send(target):
+            sent.append(target)
+            return "ok", 1, 1, 2
+
+        policy.call(send, PRIMARY)
+        assert sent == [FALLBACK]
+
+        policy.breaker("openrouter").record_failure()
+        with pytest.raises(ProviderUnavailableError):
+            policy.call(send, PRIMARY)
+
+    def test_raises_last_error_when_all_fail(self):
+        """すべての送信先が失敗した場合は最後のエラーを送出する"""
+        policy = HedgingPolicy(fallbacks=[FALLBACK])
+
+        def send(target):
+            raise RuntimeError(target.provider)
+
+        with pytest.raises(RuntimeError, match="openrouter"):
+            policy.call(send, PRIMARY)
+
+    def test_async_hedge_cancels_loser(self):
+        """非同期版では、負けたリクエストをキャンセルする"""
+        policy = warmed_policy(fallbacks=[FALLBACK])
+        cancelled = []
+
+        async def send(target):
+            if target == PRIMARY:
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(target)
+                    raise
+            return target.provider, 5, 5, 10
+
+        assert run_coroutine(policy.call_async(send, PRIMARY)) == (FALLBACK, ("openrouter", 5, 5, 10))
+        time.sleep(0.05)
+        assert cancelled == [PRIMARY]
+        assert policy.stats()["cancelled_requests"] == 1
+        assert policy.stats()["hedge_wins"] == 1
+
+    def test_request_to_chat_ai_fails_over(self):
+        """request_to_chat_aiは設定したフォールバック先に切り替える"""
+        configure_hedging({"fallbacks": [{"provider": "openrouter", "model": "google/gemini-2.0-flash"}]})
+
+        def dispatch(messages, model, is_json, json_schema, provider, local_llm_address):
+            if provider == "openai":
+                raise RuntimeError("server error")
+            return f"{provider}:{model}", 1, 1, 2
+
+        with patch.object(llm, "_dispatch_chat_request", side_effect=dispatch):
+            result = llm.request_to_chat_ai([{"role": "user", "content": "hi"}], model="gpt-4o-mini")
+
+        assert result[0] == "openrouter:google/gemini-2.0-flash"
+        stats = get_hedging_stats()
+        assert stats["failovers"] == 1
+        assert stats["circuit_breakers"]["openai"]["state"] == "closed"
+
+    def test_fallback_response_is_cached_under_its_own_key(self, tmp_path):
+        """フォールバック先の応答は、プライマリではなく応答した送信先のキーでキャッシュする"""
+        configure_hedging({"fallbacks": [{"provider": "openrouter", "model": "google/gemini-2.0-flash"}]})
+        llm.configure_llm_cache({"enabled": True, "path": str(tmp_path / "cache.sqlite3")})
+        messages = [{"role": "user", "content": "hi"}]
+        primary_fails = True
+
+        def dispatch(messages, model, is_json, json_schema, provider, local_llm_address):
+            if provider == "openai" and primary_fails:
+                raise RuntimeError("server error")
+            return f"{provider}:{model}", 1, 1, 2
+
+        try:
+            with patch.object(llm, "_dispatch_chat_request", side_effect=dispatch):
+                assert llm.request_to_chat_ai(messages, model="gpt-4o-mini")[0] == "openrouter:google/gemini-2.0-flash"
+                primary_fails = False
+                assert llm.request_to_chat_ai(messages, model="gpt-4o-mini")[0] == "openai:gpt-4o-mini"
+                fallback = llm.request_to_chat_ai(messages, model="google/gemini-2.0-flash", provider="openrouter")
+        finally:
+            llm.configure_llm_cache(None)
+
+        # フォールバック先のキーには保存済みのため、APIを呼ばずにキャッシュから返す
+        assert fallback == ("openrouter:google/gemini-2.0-flash", 0, 0, 0)
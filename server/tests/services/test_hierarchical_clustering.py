@@ -0,0 +1,170 @@
+import json
+import sys
+import types
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+SPECS_PATH = Path(__file__).resolve().parents[2] / "broadlistening" / "pipeline" / "hierarchical_specs.json"
+DATASET = "test"
+
+
+class FakeUMAP:
+    """umap.UMAPの代わりに、主成分分析で2次元に射影する
+
+    umap-learnと同様に、k近傍グラフを渡して学習した場合は近傍探索のインデックスを持たず、transformできない。
+    """
+
+    fitted: list["FakeUMAP"] = []
+
+    def __init__(self, n_neighbors, n_components, random_state, metric, low_memory=False, precomputed_knn=None):
+        self.n_neighbors = n_neighbors
+        self.n_components = n_components
+        self.low_memory = low_memory
+        self.precomputed_knn = precomputed_knn
+        self.fit_size = None
+
+    def fit_transform(self, X):
+        X = np.asarray(X, dtype=np.float64)
+        self.fit_size = len(X)
+        self._mean = X.mean(axis=0)
+        self._components = np.linalg.svd(X - self._mean, full_matrices=False)[2][: self.n_components]
+        if self.precomputed_knn is None:
+            distances = np.linalg.norm(X[:, None, :] - X[None, :, :], axis=2)
+            self._knn_indices = np.argsort(distances, axis=1)[:, : self.n_neighbors]
+            self._knn_dists = np.take_along_axis(distances, self._knn_indices, axis=1)
+            self._search_index = "index"
+        else:
+            self._knn_indices, self._knn_dists, self._search_index = self.precomputed_knn
+        FakeUMAP.fitted.append(self)
+        return (X - self._mean) @ self._components.T
+
+    def transform(self, X):
+        if self._search_index is None:
+            raise ValueError("search index is required to transform new data")
+        return (np.asarray(X, dtype=np.float64) - self._mean) @ self._components.T
+
+
+def write_arguments(n_per_cluster: int, seed: int = 0) -> None:
+    """3つの塊に分かれた埋め込みの意見をoutputs/{DATASET}に書き出す"""
+    rng = np.random.default_rng(seed)
+    centers = np.eye(3, 8) * 10
+    vectors = np.vstack([center + rng.normal(size=(n_per_cluster, 8)) for center in centers])
+    arg_ids = [f"A{i}_0" for i in range(len(vectors))]
+    output_dir = Path("outputs") / DATASET
+    output_dir.mkdir(parents=True, exist_ok=True)
+    pd.DataFrame({"arg-id": arg_ids, "argument": [f"意見{i}" for i in range(len(vectors))]}).to_csv(
+        output_dir / "args.csv", index=False
+    )
+    np.save(output_dir / "embeddings.npy", vectors.astype(np.float32))
+    pd.DataFrame({"arg-id": arg_ids}).to_csv(output_dir / "embedding_ids.csv", index=False)
+
+
+def clustering_config(**options) -> dict:
+    with open(SPECS_PATH) as f:
+        spec = next(step for step in json.load(f) if step["step"] == "hierarchical_clustering")
+    return {"output_dir": DATASET, "hierarchical_clustering": {**spec["options"], "cluster_nums": [2, 3], **options}}
+
+
+class TestHierarchicalClustering:
+    """hierarchical_clusteringステップのテスト"""
+
+    @pytest.fixture
+    def step(self, load_pipeline_module, monkeypatch):
+        monkeypatch.setitem(sys.modules, "umap", types.SimpleNamespace(UMAP=FakeUMAP))
+        FakeUMAP.fitted = []
+        return load_pipeline_module("steps.hierarchical_clustering")
+
+    def test_append_projects_new_arguments(self, step):
+        """--appendモードでは、保存したUMAPで新しい意見だけを射影して既存のクラスタに割り当てる"""
+        write_arguments(10)
+        step.hierarchical_clustering(clustering_config(enable_append=True))
+        previous = pd.read_csv(f"outputs/{DATASET}/hierarchical_clusters.csv")
+
+        write_arguments(12)
+        config = clustering_config(enable_append=True)
+        config["append"] = True
+        step.hierarchical_clustering(config)
+
+        result = pd.read_csv(f"outputs/{DATASET}/hierarchical_clusters.csv")
+        assert len(result) == 36
+        assert result[["cluster-level-1-id", "cluster-level-2-id"]].notna().all().all()
+        assert config["hierarchical_append"]["new_arguments"] == 6
+        pd.testing.assert_frame_equal(result[result["arg-id"].isin(previous["arg-id"])], previous, check_like=True)
+
+    def test_umap_model_is_saved_only_with_enable_append(self, step):
+        """enable_appendでない場合は学習したUMAPを保存せず、以前に保存したものも削除する"""
+        write_arguments(10)
+        step.hierarchical_clustering(clustering_config(enable_append=True))
+        assert Path(f"outputs/{DATASET}/umap_model.joblib").exists()
+
+        step.hierarchical_clustering(clustering_config(large_scale_threshold=1, umap_fit_sample_size=1000))
+        assert not Path(f"outputs/{DATASET}/umap_model.joblib").exists()
+
+        write_arguments(12)
+        config = clustering_config()
+        config["append"] = True
+        with pytest.raises(FileNotFoundError, match="enable_append"):
+            step.hierarchical_clustering(config)
+
+    def test_append_after_fit_with_cached_knn_graph(self, step):
+        """enable_appendの場合は保存したk近傍グラフを使わずに学習し、transformできるUMAPを保存する"""
+        write_arguments(10)
+        step.hierarchical_clustering(clustering_config())
+        # 省メモリの設定に切り替わると座標は計算し直すが、k近傍グラフは再利用できる
+        config = clustering_config(large_scale_threshold=1, umap_fit_sample_size=1000)
+        step.hierarchical_clustering(config)
+        assert config["umap_cache"] == {"projection": "computed", "knn": "reused"}
+        assert not Path(f"outputs/{DATASET}/umap_model.joblib").exists()
+
+        config = clustering_config(large_scale_threshold=1, umap_fit_sample_size=1000, enable_append=True)
+        step.hierarchical_clustering(config)
+        assert config["umap_cache"] == {"projection": "computed", "knn": "computed"}
+        assert FakeUMAP.fitted[-1].precomputed_knn is None
+
+        write_arguments(12)
+        config = clustering_config(large_scale_threshold=1, umap_fit_sample_size=1000, enable_append=True)
+        config["append"] = True
+        step.hierarchical_clustering(config)
+        assert config["hierarchical_append"]["new_arguments"] == 6
+
+    def test_cached_projection_is_refitted_to_save_umap_model(self, step):
+        """enable_appendに切り替えた再実行では、保存した座標を使わずにUMAPを学習し直して保存する"""
+        write_arguments(10)
+        step.hierarchical_clustering(clustering_config())
+        config = clustering_config(enable_append=True)
+        step.hierarchical_clustering(config)
+
+        assert config["umap_cache"]["projection"] == "computed"
+        assert Path(f"outputs/{DATASET}/umap_model.joblib").exists()
+
+    def test_large_scale_path(self, step, load_pipeline_module, monkeypatch):
+        """件数がlarge_scale_threshold以上の場合は、サンプルで学習したUMAPとMiniBatchKMeansで全件を分類する"""
+        minibatch_models = []
+
+        class SpyMiniBatchKMeans(step.MiniBatchKMeans):
+            def fit(self, X):
+                minibatch_models.append(self)
+                return super().fit(X)
+
+        monkeypatch.setattr(step, "MiniBatchKMeans", SpyMiniBatchKMeans)
+        write_arguments(20)
+        config = clustering_config(large_scale_threshold=30, umap_fit_sample_size=25, kmeans_batch_size=16)
+        config["plan"] = [{"step": "hierarchical_clustering", "run": True}]
+        load_pipeline_module("hierarchical_utils").run_step(
+            "hierarchical_clustering", step.hierarchical_clustering, config
+        )
+
+        assert FakeUMAP.fitted[-1].fit_size == 25
+        assert FakeUMAP.fitted[-1].low_memory
+        assert len(minibatch_models) == 1
+        result = pd.read_csv(f"outputs/{DATASET}/hierarchical_clusters.csv")
+        assert len(result) == 60
+        assert result[["x", "y", "cluster-level-1-id", "cluster-level-2-id"]].notna().all().all()
+        with open(f"outputs/{DATASET}/hierarchical_status.json") as f:
+            stats = json.load(f)["hierarchical_clustering_stats"]
+        assert stats["large_scale"]
+        assert stats["umap_fit_samples"] == 25
+        assert stats["kmeans"] == "MiniBatchKMeans"
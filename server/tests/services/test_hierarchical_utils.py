@@ -0,0 +1,65 @@
+from pathlib import Path
+
+import pytest
+
+DATASET = "test"
+
+
+def append_config(enable_append: bool = True, prompt: str = "意見を抽出してください") -> dict:
+    return {
+        "output_dir": DATASET,
+        "append": True,
+        "provider": "openai",
+        "extraction": {"model": "gpt-4o-mini", "prompt": prompt, "pack_comments": False},
+        "embedding": {"model": "text-embedding-3-small"},
+        "hierarchical_clustering": {"cluster_nums": [2, 3], "enable_append": enable_append},
+    }
+
+
+PREVIOUS = {
+    "status": "completed",
+    "completed_jobs": [
+        {"step": "embedding", "params": {"model": "text-embedding-3-small"}},
+        {"step": "hierarchical_clustering", "params": {"cluster_nums": [2, 3], "enable_append": True}},
+    ],
+}
+
+
+class TestValidateAppend:
+    """--appendモードで実行できるかの検証のテスト"""
+
+    @pytest.fixture
+    def utils(self, load_pipeline_module):
+        output_dir = Path("outputs") / DATASET
+        output_dir.mkdir(parents=True)
+        for filename in ["hierarchical_clusters.csv", "hierarchical_merge_labels.csv", "umap_model.joblib"]:
+            (output_dir / filename).touch()
+        journal = load_pipeline_module("services.checkpoint_journal").extraction_journal(append_config())
+        journal.open(resume=False)
+        journal.close()
+        return load_pipeline_module("hierarchical_utils")
+
+    def test_valid(self, utils):
+        utils.validate_append(append_config(), PREVIOUS)
+
+    def test_requires_enable_append(self, utils):
+        """enable_appendでない場合は、UMAPが保存されないため実行できない"""
+        with pytest.raises(Exception, match="enable_append"):
+            utils.validate_append(append_config(enable_append=False), PREVIOUS)
+
+    def test_requires_umap_model(self, utils):
+        """UMAPが保存されていない場合は、enable_appendで一度実行し直すよう促す"""
+        Path(f"outputs/{DATASET}/umap_model.joblib").unlink()
+        with pytest.raises(Exception, match="umap_model.joblib.*enable_append"):
+            utils.validate_append(append_config(), PREVIOUS)
+
+    def test_requires_extraction_journal(self, utils):
+        """抽出のジャーナルがない場合は、全件を抽出し直さないよう実行しない"""
+        Path(f"outputs/{DATASET}/extraction_journal.jsonl").unlink()
+        with pytest.raises(Exception, match="extraction_journal.jsonl"):
+            utils.validate_append(append_config(), PREVIOUS)
+
+    def test_requires_matching_journal_header(self, utils):
+        """プロンプトなどが変わりジャーナルを使えない場合も、実行しない"""
+        with pytest.raises(Exception, match="extraction_journal.jsonl"):
+            utils.validate_append(append_config(prompt="別のプロンプト"), PREVIOUS)
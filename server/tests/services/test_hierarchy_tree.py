@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+from broadlistening.pipeline.services.hierarchy_tree import (
+    build_hierarchy_tree,
+    hierarchy_levels,
+    load_hierarchy_tree,
+    save_hierarchy_tree,
+)
+
+# 3つのまとまり(0,1 / 2,3 / 4)に分かれた5つの重心
+CENTERS = np.array([[0.0, 0.0], [0.0, 1.0], [10.0, 0.0], [10.0, 1.0], [50.0, 50.0]])
+KMEANS_LABELS = np.array([0, 1, 2, 3, 4, 4, 1])
+
+
+class TestHierarchyTree:
+    """Ward法の樹形図の保存と切り直しのテスト"""
+
+    def test_levels_follow_ward_merges(self):
+        """hierarchy_levels: 各クラスタ数で切った所属を意見ごとに返し、最下層はKMeansのラベルのまま"""
+        levels = hierarchy_levels(build_hierarchy_tree(CENTERS), KMEANS_LABELS, [5, 3, 2])
+        assert list(levels) == [2, 3, 5]
+        assert len(set(levels[2])) == 2
+        # 同じ重心に属する意見は同じクラスタになり、近い重心どうしが先にまとまる
+        level3 = levels[3]
+        assert level3[0] == level3[1] == level3[6]
+        assert level3[2] == level3[3]
+        assert level3[4] == level3[5]
+        assert len(set(level3)) == 3
+        np.testing.assert_array_equal(levels[5], KMEANS_LABELS)
+
+    def test_largest_level_must_match_kmeans(self):
+        """最も多いクラスタ数はKMeansのクラスタ数と一致しなければならない"""
+        with pytest.raises(ValueError):
+            hierarchy_levels(build_hierarchy_tree(CENTERS), KMEANS_LABELS, [2, 6])
+
+    def test_round_trip(self, tmp_path):
+        """保存した樹形図は、座標のフィンガープリントとパラメータが同じ場合だけ読み込む"""
+        path = str(tmp_path / "hierarchical_linkage.npz")
+        linkage = build_hierarchy_tree(CENTERS)
+        params = {"n_clusters": 5, "minibatch_size": None, "random_state": 42}
+        save_hierarchy_tree(path, linkage, KMEANS_LABELS, "abc", params)
+
+        loaded_linkage, loaded_labels = load_hierarchy_tree(path, "abc", params)
+        np.testing.assert_array_equal(loaded_linkage, linkage)
+        np.testing.assert_array_equal(loaded_labels, KMEANS_LABELS)
+        assert load_hierarchy_tree(path, "xyz", params) is None
+        assert load_hierarchy_tree(path, "abc", {**params, "n_clusters": 6}) is None
+        assert load_hierarchy_tree(str(tmp_path / "missing.npz")) is None
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+from broadlistening.pipeline.services.incremental_clustering import (
+    assign_to_centroids,
+    cluster_centroids,
+    cluster_id_columns,
+    find_relabel_clusters,
+    relabel_targets,
+    upper_level_mapping,
+)
+
+
+def clusters_df(rows):
+    return pd.DataFrame(rows, columns=["arg-id", "argument", "x", "y", "cluster-level-1-id", "cluster-level-2-id"])
+
+
+PREVIOUS = clusters_df(
+    [
+        ["A1_0", "a", 0.0, 0.0, "1_1", "2_0"],
+        ["A2_0", "b", 0.0, 2.0, "1_1", "2_0"],
+        ["A3_0", "c", 10.0, 0.0, "1_1", "2_1"],
+        ["A4_0", "d", 10.0, 2.0, "1_1", "2_1"],
+        ["A5_0", "e", 50.0, 50.0, "1_2", "2_2"],
+    ]
+)
+
+
+class TestIncrementalClustering:
+    """--appendモードのクラスタリング処理のテスト"""
+
+    def test_centroids_are_cluster_means(self):
+        """cluster_centroids: 最下層のクラスタごとに座標の平均と件数を返す"""
+        ids, centroids, sizes = cluster_centroids(PREVIOUS, "cluster-level-2-id")
+        assert ids == ["2_0", "2_1", "2_2"]
+        np.testing.assert_allclose(centroids, [[0.0, 1.0], [10.0, 1.0], [50.0, 50.0]])
+        np.testing.assert_array_equal(sizes, [2, 2, 1])
+
+    def test_assign_to_nearest_centroid(self):
+        """assign_to_centroids: 新しい意見は最も近い重心のクラスタに割り当てる"""
+        centroids = np.array([[0.0, 1.0], [10.0, 1.0], [50.0, 50.0]])
+        labels, used = assign_to_centroids(np.array([[9.0, 0.0], [1.0, 1.0]]), centroids, np.array([2.0, 2.0, 1.0]))
+        assert labels.tolist() == [1, 0]
+        np.testing.assert_array_equal(used, centroids)
+
+    def test_refinement_weights_existing_members(self):
+        """refine=True: 重心は既存の件数で重み付けした平均に動き、件数の多いクラスタほど動きにくい"""
+        centroids = np.array([[0.0, 0.0], [10.0, 0.0]])
+        labels, refined = assign_to_centroids(np.array([[4.0, 0.0]]), centroids, np.array([3.0, 100.0]), refine=True)
+        np.testing.assert_allclose(refined, [[1.0, 0.0], [10.0, 0.0]])
+        assert labels.tolist() == [0]
+
+    def test_upper_levels_follow_previous_merge(self):
+        """upper_level_mapping: 最下層のクラスタIDから以前に併合された上位のクラスタIDを引ける"""
+        columns = cluster_id_columns(PREVIOUS)
+        assert columns == ["cluster-level-1-id", "cluster-level-2-id"]
+        mapping = upper_level_mapping(PREVIOUS, columns)
+        assert mapping.loc[["2_1", "2_2"], "cluster-level-1-id"].tolist() == ["1_1", "1_2"]
+
+    def test_relabel_only_clusters_changed_beyond_threshold(self):
+        """find_relabel_clusters: 追加・削除された件数が以前の件数のthresholdの割合を超えたクラスタだけを返す"""
+        current = pd.concat(
+            [
+                PREVIOUS[PREVIOUS["arg-id"] != "A5_0"],
+                clusters_df(
+                    [
+                        ["A6_0", "f", 1.0, 1.0, "1_1", "2_0"],
+                        ["A7_0", "g", 1.0, 1.0, "1_1", "2_0"],
+                        ["A8_0", "h", 11.0, 1.0, "1_1", "2_1"],
+                    ]
+                ),
+            ]
+        )
+        relabel = find_relabel_clusters(PREVIOUS, current, cluster_id_columns(PREVIOUS), threshold=0.6)
+        # 2_0は2件から2件追加(100%)、2_1は2件から1件追加(50%)、2_2は意見がなくなったので対象外
+        assert relabel == {"cluster-level-1-id": ["1_1"], "cluster-level-2-id": ["2_0"]}
+
+    def test_relabel_targets_only_in_append_mode(self):
+        """relabel_targets: --appendモードでない場合はNoneを返す"""
+        assert relabel_targets({}, "cluster-level-1-id") is None
+        config = {"append": True, "hierarchical_append": {"relabel": {"cluster-level-1-id": ["1_1"]}}}
+        assert relabel_targets(config, "cluster-level-1-id") == {"1_1"}
+        assert relabel_targets(config, "cluster-level-2-id") == set()
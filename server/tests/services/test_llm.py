@@ -5,11 +5,14 @@ import openai
 import pytest
 from broadlistening.pipeline.services.llm import (
     _validate_model,
+    request_embedding_batch,
     request_to_azure_chatcompletion,
     request_to_azure_embed,  # noqa: F401
     request_to_chat_ai,
-    request_to_embed,  # noqa: F401
+    request_to_embed,
+    request_to_embed_in_batches,
     request_to_openai,
+    supports_embedding_dimensions,
 )
 from openai import AzureOpenAI  # noqa: F401
 from pydantic import BaseModel, Field
@@ -739,3 +742,132 @@ class TestLLMService:
             with patch("broadlistening.pipeline.services.llm.OpenAI", return_value=mock_client):
                 with pytest.raises(openai.RateLimitError):
                     request_to_chat_ai(messages=messages, model=model, provider="openrouter")
+
+
+class TestRequestToEmbedInBatches:
+    """request_to_embed_in_batchesのテスト"""
+
+    @staticmethod
+    def embed_lengths(texts, model, is_embedded_at_local, provider, local_llm_address, dimensions=None):
+        return [[float(len(text))] for text in texts]
+
+    def test_batches_follow_token_budget_and_keep_order(self):
+        """推定トークン数の予算で区切って並行にリクエストし、入力順に結果を返す"""
+        texts = ["あ" * n for n in range(1, 8)]
+        with patch("broadlistening.pipeline.services.llm.request_to_embed", side_effect=self.embed_lengths) as mock:
+            embeddings = request_to_embed_in_batches(
+                texts, "text-embedding-3-small", workers=3, token_budget=6, batch_size=10
+            )
+
+        assert embeddings == [[float(n)] for n in range(1, 8)]
+        assert sorted(len(call.args[0]) for call in mock.call_args_list) == [1, 1, 1, 1, 3]
+
+    def test_transient_errors_are_retried(self):
+        """一時的なエラーが発生したバッチは再送する"""
+        calls = []
+
+        def flaky(texts, *args, **kwargs):
+            calls.append(texts)
+            if len(calls) == 1:
+                raise openai.APIConnectionError(request=MagicMock())
+            return self.embed_lengths(texts, *args, **kwargs)
+
+        with (
+            patch("broadlistening.pipeline.services.llm.request_to_embed", side_effect=flaky),
+            patch.object(request_embedding_batch.retry, "sleep", lambda seconds: None),
+        ):
+            embeddings = request_to_embed_in_batches(["a", "bb"], "text-embedding-3-small", batch_size=1)
+
+        assert embeddings == [[1.0], [2.0]]
+        assert len(calls) == 3
+
+    def test_dimensions_are_sent_to_openai(self):
+        """次元数を指定した場合はOpenAIのリクエストに含め、対応していないモデルでは指定しない"""
+        mock_client = MagicMock()
+        mock_client.embeddings.create.return_value.data = [MagicMock(embedding=[0.1, 0.2])]
+        with patch("broadlistening.pipeline.services.llm.get_llm_client", return_value=mock_client):
+            assert request_to_embed(["a"], "text-embedding-3-small", dimensions=2) == [[0.1, 0.2]]
+
+        mock_client.embeddings.create.assert_called_once_with(input=["a"], model="text-embedding-3-small", dimensions=2)
+        assert supports_embedding_dimensions("text-embedding-3-large", provider="azure")
+        assert not supports_embedding_dimensions("text-embedding-3-small", is_embedded_at_local=True)
+        assert not supports_embedding_dimensions("nomic-embed-text", provider="local")
+
+
+class FakeRateLimiter:
+    """RateLimiterの代わりに、予約と精算の呼び出しを記録する"""
+
+    def __init__(self):
+        self.calls = []
+
+    def acquire(self, tokens):
+        self.calls.append(("acquire", tokens))
+
+    async def acquire_async(self, tokens):
+        self.calls.append(("acquire", tokens))
+
+    def settle(self, reserved_tokens, actual_tokens):
+        self.calls.append(("settle", reserved_tokens, actual_tokens))
+
+
+class TestRateLimitedRequests:
+    """レート制限の予約と精算のテスト"""
+
+    messages = [{"role": "user", "content": "Hello, world!"}]
+
+    @pytest.fixture
+    def limiter(self):
+        limiter = FakeRateLimiter()
+        with (
+            patch("broadlistening.pipeline.services.llm.get_rate_limiter", return_value=limiter),
+            patch.object(request_to_openai.retry, "sleep", lambda seconds: None),
+        ):
+            yield limiter
+
+    @staticmethod
+    def chat_response(total_tokens):
+        response = MagicMock()
+        response.choices[0].message.content = "ok"
+        response.configure_mock(
+            **{"usage.prompt_tokens": total_tokens, "usage.completion_tokens": 0, "usage.total_tokens": total_tokens}
+        )
+        return response
+
+    @staticmethod
+    def rate_limit_error():
+        return openai.RateLimitError(message="Rate limit exceeded", response=MagicMock(), body=MagicMock())
+
+    def test_each_retry_attempt_reserves_budget(self, limiter):
+        """リトライの試行ごとに予算を予約し直し、失敗した試行は入力の見積もり分で精算する"""
+        side_effects = [self.rate_limit_error(), self.chat_response(42)]
+        with patch("openai.chat.completions.create", side_effect=side_effects):
+            assert request_to_chat_ai(self.messages, model="gpt-4o")[3] == 42
+
+        (_, reserved), (_, _, failed_tokens), second, last = limiter.calls
+        assert [call[0] for call in limiter.calls] == ["acquire", "settle", "acquire", "settle"]
+        assert second == ("acquire", reserved)
+        assert 0 < failed_tokens < reserved
+        assert last == ("settle", reserved, 42)
+
+    def test_failed_request_is_settled(self, limiter):
+        """リトライしても失敗した場合も、予約した予算を精算する"""
+        with patch("openai.chat.completions.create", side_effect=[self.rate_limit_error()] * 3):
+            with pytest.raises(openai.RateLimitError):
+                request_to_chat_ai(self.messages, model="gpt-4o")
+
+        assert [call[0] for call in limiter.calls] == ["acquire", "settle"] * 3
+
+    def test_embedding_is_settled_with_usage(self, limiter):
+        """埋め込みもトークン使用量で精算し、失敗した場合は見積もりで精算する"""
+        mock_client = MagicMock()
+        mock_client.embeddings.create.return_value.data = [MagicMock(embedding=[0.1])]
+        mock_client.embeddings.create.return_value.usage.total_tokens = 7
+        with patch("broadlistening.pipeline.services.llm.get_llm_client", return_value=mock_client):
+            request_to_embed(["a"], "text-embedding-3-small")
+            mock_client.embeddings.create.side_effect = openai.APIConnectionError(request=MagicMock())
+            with pytest.raises(openai.APIConnectionError):
+                request_to_embed(["a"], "text-embedding-3-small")
+
+        (_, reserved), settled, _, failed = limiter.calls
+        assert settled == ("settle", reserved, 7)
+        assert failed == ("settle", reserved, reserved)
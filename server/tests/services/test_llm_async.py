@@ -0,0 +1,134 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import openai
+import pytest
+from broadlistening.pipeline.services import llm
+from broadlistening.pipeline.services.async_runner import run_async_in_order, run_coroutine
+
+
+class TestAsyncLLMService:
+    """非同期版のLLMサービスのテスト"""
+
+    @pytest.fixture
+    def messages(self):
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "Hello, world!"},
+        ]
+
+    @pytest.fixture
+    def mock_async_client(self):
+        """AsyncOpenAIのクライアントをモック化するフィクスチャ"""
+        mock_choice = MagicMock()
+        mock_choice.message.content = "This is a test response"
+        mock_response = MagicMock()
+        mock_response.choices = [mock_choice]
+        mock_response.configure_mock(
+            **{"usage.prompt_tokens": 10, "usage.completion_tokens": 5, "usage.total_tokens": 15}
+        )
+
+        mock_item = MagicMock()
+        mock_item.embedding = [0.1, 0.2, 0.3]
+        mock_embedding_response = MagicMock()
+        mock_embedding_response.data = [mock_item]
+
+        client = MagicMock()
+        client.chat.completions.create = AsyncMock(return_value=mock_response)
+        client.embeddings.create = AsyncMock(return_value=mock_embedding_response)
+        with patch("broadlistening.pipeline.services.llm.AsyncOpenAI", return_value=client):
+            yield client
+
+    def test_request_to_chat_ai_async(self, messages, mock_async_client):
+        """request_to_chat_ai_async: レスポンスとトークン使用量を返す"""
+        result = run_coroutine(llm.request_to_chat_ai_async(messages, model="gpt-4o", provider="openai"))
+
+        assert result == ("This is a test response", 10, 5, 15)
+        kwargs = mock_async_client.chat.completions.create.call_args.kwargs
+        assert kwargs["model"] == "gpt-4o"
+        assert kwargs["temperature"] == 0
+        assert "response_format" not in kwargs
+
+    def test_request_to_chat_ai_async_json(self, messages, mock_async_client):
+        """request_to_chat_ai_async: is_json=Trueの場合はJSONモードでリクエストする"""
+        run_coroutine(llm.request_to_chat_ai_async(messages, model="gpt-4o", is_json=True, provider="openai"))
+
+        kwargs = mock_async_client.chat.completions.create.call_args.kwargs
+        assert kwargs["response_format"] == {"type": "json_object"}
+
+    def test_async_client_is_reused(self, messages, mock_async_client):
+        """非同期クライアントはリクエストごとに作成せず使い回す"""
+        with patch("broadlistening.pipeline.services.llm.AsyncOpenAI", return_value=mock_async_client) as factory:
+            for _ in range(3):
+                run_coroutine(llm.request_to_chat_ai_async(messages, model="gpt-4o", provider="openai"))
+        factory.assert_called_once()
+
+    def test_request_to_embed_async(self, mock_async_client):
+        """request_to_embed_async: 埋め込みベクトルのリストを返す"""
+        result = run_coroutine(llm.request_to_embed_async(["Hello"], "text-embedding-3-small", provider="openai"))
+
+        assert result == [[0.1, 0.2, 0.3]]
+        mock_async_client.embeddings.create.assert_awaited_once_with(input=["Hello"], model="text-embedding-3-small")
+
+    def test_rate_limit_is_reserved_per_retry_attempt(self, messages, mock_async_client):
+        """リトライの試行ごとにレート制限の予算を予約し直し、すべての予約を精算する"""
+        limiter = MagicMock()
+        limiter.acquire_async = AsyncMock()
+        error = openai.RateLimitError(message="Rate limit exceeded", response=MagicMock(), body=MagicMock())
+        mock_async_client.chat.completions.create.side_effect = [
+            error,
+            mock_async_client.chat.completions.create.return_value,
+        ]
+        with (
+            patch("broadlistening.pipeline.services.llm.get_rate_limiter", return_value=limiter),
+            patch.object(llm._request_chat_completion_async.retry, "sleep", AsyncMock()),
+        ):
+            result = run_coroutine(llm.request_to_chat_ai_async(messages, model="gpt-4o", provider="openai"))
+
+        assert result[3] == 15
+        assert limiter.acquire_async.await_count == 2
+        assert limiter.settle.call_count == 2
+        assert limiter.settle.call_args.args[1] == 15
+
+    def test_request_to_chat_ai_async_unknown_provider(self, messages):
+        """request_to_chat_ai_async: 不明なプロバイダーの場合はエラーを送出する"""
+        with pytest.raises(ValueError):
+            run_coroutine(llm.request_to_chat_ai_async(messages, model="gpt-4o", provider="unknown"))
+
+
+class TestRunAsyncInOrder:
+    """非同期タスクのファンアウトのテスト"""
+
+    def test_yields_in_input_order_with_bounded_concurrency(self):
+        """同時実行数を超えずに並行実行し、入力順に結果を返す"""
+        running = 0
+        peak = 0
+
+        async def task(i):
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.001 * (20 - i))
+            running -= 1
+            return i
+
+        tasks = [lambda i=i: task(i) for i in range(20)]
+        results = [(index, future.result()) for index, future in run_async_in_order(tasks, 5)]
+
+        assert results == [(i, i) for i in range(20)]
+        assert peak == 5
+
+    def test_exceptions_are_returned_per_task(self):
+        """一部のタスクが失敗しても、他のタスクの結果は取得できる"""
+
+        async def task(i):
+            if i == 1:
+                raise RuntimeError("failed")
+            return i
+
+        futures = dict(run_async_in_order([lambda i=i: task(i) for i in range(3)], 2))
+
+        assert futures[0].result() == 0
+        with pytest.raises(RuntimeError):
+            futures[1].result()
+        assert futures[2].result() == 2
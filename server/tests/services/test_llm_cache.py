@@ -0,0 +1,131 @@
+from unittest.mock import patch
+
+import pytest
+from broadlistening.pipeline.services import llm
+from broadlistening.pipeline.services.llm_cache import LLMResponseCache, build_cache_key
+from pydantic import BaseModel, Field
+
+
+class TestLLMResponseCache:
+    """LLMレスポンスキャッシュのテスト"""
+
+    @pytest.fixture
+    def messages(self):
+        return [
+            {"role": "system", "content": "You are a helpful assistant."},
+            {"role": "user", "content": "Hello, world!"},
+        ]
+
+    @pytest.fixture
+    def enabled_cache(self, tmp_path):
+        """request_to_chat_aiのキャッシュを一時ディレクトリで有効化するフィクスチャ"""
+        llm.configure_llm_cache({"enabled": True, "path": str(tmp_path / "llm_cache.sqlite3")})
+        yield
+        llm.configure_llm_cache(None)
+
+    def test_build_cache_key_is_stable(self, messages):
+        """build_cache_key: 同じリクエストからは同じキーが生成される"""
+        assert build_cache_key("openai", "gpt-4o", messages) == build_cache_key("openai", "gpt-4o", list(messages))
+
+    def test_build_cache_key_depends_on_request(self, messages):
+        """build_cache_key: プロバイダー・モデル・スキーマが異なれば別のキーになる"""
+
+        class TestModel(BaseModel):
+            test: str = Field(..., description="テスト用フィールド")
+
+        base = build_cache_key("openai", "gpt-4o", messages)
+        assert base != build_cache_key("azure", "gpt-4o", messages)
+        assert base != build_cache_key("openai", "gpt-4o-mini", messages)
+        assert base != build_cache_key("openai", "gpt-4o", messages, json_schema=TestModel)
+        assert base != build_cache_key("openai", "gpt-4o", messages, is_json=True)
+
+    def test_build_cache_key_depends_on_azure_deployment(self, messages, monkeypatch):
+        """build_cache_key: Azureはデプロイメント・エンドポイントが異なれば別のキーになる"""
+        monkeypatch.setenv("AZURE_CHATCOMPLETION_ENDPOINT", "https://a.openai.azure.com")
+        monkeypatch.setenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME", "gpt-4o")
+        base = build_cache_key("azure", "gpt-4o", messages)
+        openai_key = build_cache_key("openai", "gpt-4o", messages)
+
+        monkeypatch.setenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME", "gpt-4o-mini")
+        assert base != build_cache_key("azure", "gpt-4o", messages)
+        assert openai_key == build_cache_key("openai", "gpt-4o", messages)
+
+        monkeypatch.setenv("AZURE_CHATCOMPLETION_DEPLOYMENT_NAME", "gpt-4o")
+        monkeypatch.setenv("AZURE_CHATCOMPLETION_ENDPOINT", "https://b.openai.azure.com")
+        assert base != build_cache_key("azure", "gpt-4o", messages)
+
+    def test_invalid_response_is_not_cached(self, messages, enabled_cache):
+        """validateを通らないレスポンスはキャッシュせず、キャッシュ済みでも検証を通らなければリクエストし直す"""
+
+        def validate(response):
+            if response != "valid":
+                raise ValueError("invalid response")
+
+        with patch.object(llm, "_dispatch_chat_request", side_effect=[("invalid", 1, 1, 2), ("valid", 1, 1, 2)]):
+            with pytest.raises(ValueError, match="invalid response"):
+                llm.request_to_chat_ai(messages, model="gpt-4o", validate=validate)
+            assert llm.request_to_chat_ai(messages, model="gpt-4o", validate=validate) == ("valid", 1, 1, 2)
+        assert llm.request_to_chat_ai(messages, model="gpt-4o", validate=validate) == ("valid", 0, 0, 0)
+
+        # validateなしで保存されたレスポンスも、検証を通らなければ使わない
+        other = [{"role": "user", "content": "other"}]
+        with patch.object(llm, "_dispatch_chat_request", side_effect=[("invalid", 1, 1, 2), ("valid", 1, 1, 2)]):
+            llm.request_to_chat_ai(other, model="gpt-4o")
+            assert llm.request_to_chat_ai(other, model="gpt-4o", validate=validate) == ("valid", 1, 1, 2)
+
+    def test_get_and_set(self, tmp_path):
+        """get/set: 保存したレスポンスを取得でき、ヒット数・ミス数が記録される"""
+        cache = LLMResponseCache(path=str(tmp_path / "cache.sqlite3"))
+        assert cache.get("key") is None
+
+        cache.set("key", ({"label": "ラベル"}, 10, 5, 15))
+        assert cache.get("key") == ({"label": "ラベル"}, 10, 5, 15)
+
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["entries"] == 1
+
+    def test_persisted_across_instances(self, tmp_path):
+        """保存したレスポンスは別インスタンス(再実行)からも参照できる"""
+        path = str(tmp_path / "cache.sqlite3")
+        LLMResponseCache(path=path).set("key", ("response", 1, 2, 3))
+        assert LLMResponseCache(path=path).get("key") == ("response", 1, 2, 3)
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        """合計サイズが上限を超えた場合は最後に参照された時刻が古いものから削除する"""
+        cache = LLMResponseCache(path=str(tmp_path / "cache.sqlite3"), max_size_mb=250 / (1024 * 1024))
+        cache.set("old", ("a" * 100, 0, 0, 0))
+        cache.set("recent", ("b" * 100, 0, 0, 0))
+        cache.get("old")  # oldを参照してrecentより新しくする
+        cache.set("new", ("c" * 100, 0, 0, 0))
+
+        assert cache.get("recent") is None
+        assert cache.get("old") is not None
+        assert cache.get("new") is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_request_to_chat_ai_uses_cache(self, messages, enabled_cache):
+        """request_to_chat_ai: 2回目の同一リクエストはAPIを呼ばずにキャッシュから返す"""
+        with patch(
+            "broadlistening.pipeline.services.llm.request_to_openai", return_value=("OpenAI response", 50, 50, 100)
+        ) as mock_request_to_openai:
+            first = llm.request_to_chat_ai(messages, model="gpt-4o", provider="openai")
+            second = llm.request_to_chat_ai(messages, model="gpt-4o", provider="openai")
+
+        assert first == ("OpenAI response", 50, 50, 100)
+        # キャッシュヒット時はトークンを消費していないため0を返す
+        assert second == ("OpenAI response", 0, 0, 0)
+        mock_request_to_openai.assert_called_once()
+        assert llm.get_llm_cache_stats()["hits"] == 1
+
+    def test_request_to_chat_ai_without_cache(self, messages):
+        """request_to_chat_ai: キャッシュが無効な場合は毎回APIを呼ぶ"""
+        with patch(
+            "broadlistening.pipeline.services.llm.request_to_openai", return_value=("OpenAI response", 50, 50, 100)
+        ) as mock_request_to_openai:
+            llm.request_to_chat_ai(messages, model="gpt-4o", provider="openai")
+            llm.request_to_chat_ai(messages, model="gpt-4o", provider="openai")
+
+        assert mock_request_to_openai.call_count == 2
+        assert llm.get_llm_cache_stats() is None
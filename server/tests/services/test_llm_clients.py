@@ -0,0 +1,113 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+import pytest
+from broadlistening.pipeline.services import llm_clients
+from broadlistening.pipeline.services.llm import request_to_azure_embed, request_to_chat_ai
+from broadlistening.pipeline.services.llm_clients import configure_llm_clients, get_llm_client, get_llm_client_stats
+
+
+class TestLLMClientRegistry:
+    """クライアントの使い回しとコネクションプールのテスト"""
+
+    @pytest.fixture(autouse=True)
+    def reset_registry(self):
+        configure_llm_clients(None)
+        yield
+        configure_llm_clients(None)
+
+    def test_client_is_reused_per_credentials(self):
+        """同じ接続先・認証情報のクライアントは1度だけ作成する"""
+        factory = MagicMock(side_effect=lambda **kwargs: MagicMock())
+        first = get_llm_client(factory, base_url="http://localhost:11434/v1", api_key="key")
+        second = get_llm_client(factory, base_url="http://localhost:11434/v1", api_key="key")
+        other = get_llm_client(factory, base_url="http://localhost:11434/v1", api_key="other-key")
+
+        assert first is second
+        assert factory.call_count == 2
+        assert other is not first
+        stats = get_llm_client_stats()
+        assert stats["clients"] == 2
+        assert stats["client_reuses"] == 1
+
+    def test_pool_is_sized_to_concurrency(self):
+        """クライアントには同時実行数に合わせたコネクションプールを渡す"""
+        configure_llm_clients(64)
+        factory = MagicMock()
+        get_llm_client(factory, api_key="key")
+
+        pool = factory.call_args.kwargs["http_client"]._transport._pool
+        assert pool._max_connections == 64
+        assert pool._max_keepalive_connections == 64
+        assert get_llm_client_stats()["max_connections"] == 64
+
+    def test_openrouter_client_is_reused(self):
+        """OpenRouterへのリクエストごとにクライアントを作成しない"""
+        mock_choice = MagicMock()
+        mock_choice.message.content = "response"
+        mock_client = MagicMock()
+        mock_client.chat.completions.create.return_value = MagicMock(choices=[mock_choice], usage=None)
+        messages = [{"role": "user", "content": "Hello!"}]
+
+        with patch.dict(os.environ, {"OPENROUTER_API_KEY": "test-api-key"}):
+            with patch("broadlistening.pipeline.services.llm.OpenAI", return_value=mock_client) as factory:
+                for _ in range(3):
+                    request_to_chat_ai(messages=messages, model="openai/gpt-4o", provider="openrouter")
+
+        factory.assert_called_once()
+        assert factory.call_args.kwargs["base_url"] == "https://openrouter.ai/api/v1"
+
+    def test_azure_embed_client_is_reused(self):
+        """Azureの埋め込みのリクエストごとにクライアントを作成しない"""
+        mock_item = MagicMock()
+        mock_item.embedding = [0.1, 0.2]
+        mock_client = MagicMock()
+        mock_client.embeddings.create.return_value = MagicMock(data=[mock_item])
+        env_vars = {
+            "AZURE_EMBEDDING_ENDPOINT": "https://example.azure.com",
+            "AZURE_EMBEDDING_API_KEY": "test-api-key",
+            "AZURE_EMBEDDING_VERSION": "2023-05-15",
+            "AZURE_EMBEDDING_DEPLOYMENT_NAME": "test-deployment",
+        }
+
+        with patch.dict(os.environ, env_vars):
+            with patch("broadlistening.pipeline.services.llm.AzureOpenAI", return_value=mock_client) as factory:
+                for _ in range(3):
+                    assert request_to_azure_embed(["Hello"], "text-embedding-3-small") == [[0.1, 0.2]]
+
+        factory.assert_called_once()
+
+    def test_connection_reuse_is_counted(self, keep_alive_server):
+        """keep-aliveで接続を使い回したリクエストを数える"""
+        http_client = llm_clients._create_http_client(is_async=False)
+        for _ in range(3):
+            assert http_client.get(keep_alive_server).status_code == 200
+
+        stats = get_llm_client_stats()
+        assert stats["requests"] == 3
+        assert stats["new_connections"] == 1
+        assert stats["reused_connections"] == 2
+
+    @pytest.fixture
+    def keep_alive_server(self):
+        """keep-aliveに対応したローカルのHTTPサーバー"""
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Length", "2")
+                self.end_headers()
+                self.wfile.write(b"{}")
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        yield f"http://127.0.0.1:{server.server_address[1]}/"
+        server.shutdown()
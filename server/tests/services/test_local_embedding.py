@@ -0,0 +1,54 @@
+import threading
+from http.server import ThreadingHTTPServer
+from unittest.mock import patch
+
+import pytest
+from broadlistening.pipeline.services import llm, local_embedding_server
+from broadlistening.pipeline.services.llm_clients import configure_llm_clients
+
+
+def embed_lengths(texts, *args, **kwargs):
+    return [[float(len(text))] for text in texts]
+
+
+class TestLocalEmbedding:
+    """is_embedded_at_localの埋め込みのテスト"""
+
+    @pytest.fixture(autouse=True)
+    def reset_local_embedding(self):
+        yield
+        llm.configure_local_embedding(None)
+
+    @pytest.fixture
+    def embedding_server(self):
+        """モデルの代わりに文字数を返すlocal_embedding_server"""
+        server = ThreadingHTTPServer(("127.0.0.1", 0), local_embedding_server.EmbeddingRequestHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        with patch.object(local_embedding_server, "request_to_local_embed", side_effect=embed_lengths):
+            thread.start()
+            yield f"127.0.0.1:{server.server_address[1]}"
+            server.shutdown()
+
+    def test_requests_resident_server(self, embedding_server):
+        """server_addressを指定した場合はモデルを読み込まずにサーバーで埋め込む"""
+        configure_llm_clients(None)
+        llm.configure_local_embedding({"server_address": embedding_server})
+        assert llm.request_to_local_embed(["a", "bbb"]) == [[1.0], [3.0]]
+        assert llm.local_embedding_model_key() == f"local-embedding-server/{embedding_server}"
+
+    def test_quantized_model_has_separate_cache_key(self):
+        """量子化したモデルの埋め込みは、PyTorchのモデルとは別のキーでキャッシュする"""
+        torch_key = llm.local_embedding_model_key()
+        llm.configure_local_embedding({"backend": "onnx", "model_file": "onnx/model_qint8_avx512_vnni.onnx"})
+        assert llm.local_embedding_model_key() != torch_key
+
+    def test_batches_are_length_sorted(self):
+        """ローカルの埋め込みは長さ順にバッチを組み、結果は入力順に戻す"""
+        texts = ["ccc", "a", "bbbb", "dd"]
+        with patch.object(llm, "request_to_embed", side_effect=embed_lengths) as mock_embed:
+            embeddings = llm.request_to_embed_in_batches(
+                texts, "text-embedding-3-small", is_embedded_at_local=True, batch_size=2
+            )
+
+        assert embeddings == [[3.0], [1.0], [4.0], [2.0]]
+        assert [call.args[0] for call in mock_embed.call_args_list] == [["a", "dd"], ["ccc", "bbbb"]]
@@ -1,4 +1,10 @@
-from broadlistening.pipeline.services.parse_json_list import parse_extraction_response
+import json
+
+import pytest
+from broadlistening.pipeline.services.parse_json_list import (
+    parse_extraction_response,
+    parse_packed_extraction_response,
+)
 
 
 class TestParseJsonList:
@@ -38,3 +44,40 @@ class TestParseJsonList:
         response = '{"extractedOpinionList": null}'
         result = parse_extraction_response(response)
         assert result == []  # 実際の実装ではNoneが返されるかもしれないが、空リストを期待
+
+    def test_parse_extraction_response_strict(self):
+        """parse_extraction_response: strict=Trueの場合、解釈できないレスポンスは例外を送出する"""
+        assert parse_extraction_response('{"extractedOpinionList": ["テスト1"]}', strict=True) == ["テスト1"]
+        with pytest.raises(json.JSONDecodeError):
+            parse_extraction_response('{"extractedOpinionList": ["テスト1"', strict=True)
+        with pytest.raises(ValueError):
+            parse_extraction_response('{"results": ["テスト1"]}', strict=True)
+        with pytest.raises(ValueError):
+            parse_extraction_response('{"extractedOpinionList": null}', strict=True)
+
+    def test_parse_packed_extraction_response_valid(self):
+        """parse_packed_extraction_response: commentIdごとの意見のリストを返す"""
+        response = (
+            '{"results": [{"commentId": "1", "extractedOpinionList": ["テスト1"]},'
+            ' {"commentId": "2", "extractedOpinionList": []}]}'
+        )
+        result = parse_packed_extraction_response(response)
+        assert result == {"1": ["テスト1"], "2": []}
+
+    def test_parse_packed_extraction_response_dict(self):
+        """parse_packed_extraction_response: dict形式のレスポンスもパースできる"""
+        response = {"results": [{"commentId": 1, "extractedOpinionList": ["テスト1"]}]}
+        assert parse_packed_extraction_response(response) == {"1": ["テスト1"]}
+
+    def test_parse_packed_extraction_response_skips_invalid_items(self):
+        """parse_packed_extraction_response: 不正な形式のコメントは結果に含めない"""
+        response = (
+            '{"results": [{"commentId": "1", "extractedOpinionList": null},'
+            ' {"commentId": "2", "extractedOpinionList": ["テスト2"]}, "invalid"]}'
+        )
+        assert parse_packed_extraction_response(response) == {"2": ["テスト2"]}
+
+    def test_parse_packed_extraction_response_invalid_json(self):
+        """parse_packed_extraction_response: 無効なJSONの場合は空のdictを返す"""
+        assert parse_packed_extraction_response('{"results": [') == {}
+        assert parse_packed_extraction_response('{"other": []}') == {}
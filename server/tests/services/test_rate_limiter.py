@@ -0,0 +1,85 @@
+from unittest.mock import patch
+
+import pytest
+from broadlistening.pipeline.services import rate_limiter
+from broadlistening.pipeline.services.rate_limiter import (
+    RateLimiter,
+    configure_rate_limits,
+    get_rate_limiter,
+    get_rate_limiter_stats,
+)
+
+
+class FakeClock:
+    """time.monotonic/time.sleepを置き換えて、待機時間を実際には待たずに進める"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class TestRateLimiter:
+    """レート制限のテスト"""
+
+    @pytest.fixture
+    def clock(self):
+        clock = FakeClock()
+        with (
+            patch.object(rate_limiter.time, "monotonic", clock.monotonic),
+            patch.object(rate_limiter.time, "sleep", clock.sleep),
+        ):
+            yield clock
+
+    @pytest.fixture(autouse=True)
+    def reset_registry(self):
+        yield
+        configure_rate_limits(None)
+
+    def test_rpm_limit(self, clock):
+        """RPMの上限に達した場合は補充されるまで待つ"""
+        limiter = RateLimiter(rpm=60)
+        for _ in range(60):
+            limiter.acquire(0)
+        assert clock.sleeps == []
+
+        limiter.acquire(0)
+        assert sum(clock.sleeps) == pytest.approx(1.0)
+        assert limiter.stats()["throttled_requests"] == 1
+
+    def test_tpm_limit(self, clock):
+        """TPMの予算が足りない場合は見積もりトークン数の分だけ補充されるまで待つ"""
+        limiter = RateLimiter(tpm=6000)
+        limiter.acquire(6000)
+        limiter.acquire(1000)
+        assert sum(clock.sleeps) == pytest.approx(10.0)
+
+    def test_settle_refunds_overestimate(self, clock):
+        """見積もりより実際の使用量が少なかった場合は差分を返却する"""
+        limiter = RateLimiter(tpm=6000)
+        limiter.acquire(6000)
+        limiter.settle(reserved_tokens=6000, actual_tokens=1000)
+        limiter.acquire(5000)
+        assert clock.sleeps == []
+
+    def test_registry_prefers_specific_key(self):
+        """より具体的なキーの設定が優先され、プロバイダー・モデルごとに独立したバケットを持つ"""
+        configure_rate_limits({"default": {"rpm": 10}, "openai/gpt-4o": {"rpm": 100, "tpm": 1000}})
+
+        assert get_rate_limiter("openai", "gpt-4o").rpm == 100
+        assert get_rate_limiter("openai", "gpt-4o-mini").rpm == 10
+        assert get_rate_limiter("openai", "gpt-4o-mini") is get_rate_limiter("openai", "gpt-4o-mini")
+        assert get_rate_limiter("openai", "gpt-4o") is not get_rate_limiter("openai", "gpt-4o-mini")
+        assert set(get_rate_limiter_stats()) == {"openai/gpt-4o", "openai/gpt-4o-mini"}
+
+    def test_registry_disabled(self):
+        """設定がない場合はレート制限を行わない"""
+        configure_rate_limits(None)
+        assert get_rate_limiter("openai", "gpt-4o") is None
+        assert get_rate_limiter_stats() is None
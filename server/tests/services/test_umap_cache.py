@@ -0,0 +1,63 @@
+import numpy as np
+from broadlistening.pipeline.services import umap_cache
+from broadlistening.pipeline.services.umap_cache import (
+    embeddings_fingerprint,
+    load_projection_cache,
+    save_projection_cache,
+)
+
+PARAMS = {"n_neighbors": 2, "n_components": 2, "random_state": 42, "metric": "euclidean"}
+
+
+class TestUmapCache:
+    """UMAPの射影結果のキャッシュのテスト"""
+
+    def test_fingerprint_is_independent_of_chunking(self, monkeypatch):
+        """embeddings_fingerprint: 行のまとまりの大きさによらず同じ値になり、内容が変われば変わる"""
+        matrix = np.arange(12, dtype=np.float32).reshape(4, 3)
+        fingerprint = embeddings_fingerprint(matrix)
+        monkeypatch.setattr(umap_cache, "FINGERPRINT_CHUNK_ROWS", 1)
+        assert embeddings_fingerprint(matrix) == fingerprint
+
+        changed = matrix.copy()
+        changed[3, 2] = 0.5
+        assert embeddings_fingerprint(changed) != fingerprint
+        assert embeddings_fingerprint(matrix.reshape(3, 4)) != fingerprint
+
+    def test_round_trip(self, tmp_path):
+        """同じ埋め込みとパラメータなら保存した座標とk近傍グラフを返す"""
+        path = str(tmp_path / "umap_projection_cache.npz")
+        coordinates = np.random.default_rng(0).random((4, 2)).astype(np.float32)
+        knn_indices = np.array([[0, 1, 2], [1, 0, 2], [2, 3, 1], [3, 2, 1]])
+        knn_dists = np.linspace(0, 1, 12).reshape(4, 3)
+        save_projection_cache(path, "abc", PARAMS, coordinates, knn_indices, knn_dists)
+
+        loaded, knn = load_projection_cache(path, "abc", PARAMS)
+        np.testing.assert_array_equal(loaded, coordinates)
+        # 近傍数が少ない場合は保存したグラフの先頭の近傍だけを使う
+        np.testing.assert_array_equal(knn[0], knn_indices[:, :2])
+        np.testing.assert_array_equal(knn[1], knn_dists[:, :2])
+
+    def test_params_change_reuses_only_knn(self, tmp_path):
+        """UMAPのパラメータが変わった場合は座標を再計算し、k近傍グラフは近傍数が足りる場合だけ使う"""
+        path = str(tmp_path / "umap_projection_cache.npz")
+        knn_indices = np.array([[0, 1], [1, 0], [2, 1]])
+        save_projection_cache(path, "abc", PARAMS, np.zeros((3, 2)), knn_indices, np.zeros((3, 2)))
+
+        coordinates, knn = load_projection_cache(path, "abc", {**PARAMS, "random_state": 0})
+        assert coordinates is None
+        np.testing.assert_array_equal(knn[0], knn_indices)
+
+        assert load_projection_cache(path, "abc", {**PARAMS, "n_neighbors": 3}) == (None, None)
+        assert load_projection_cache(path, "abc", {**PARAMS, "metric": "cosine", "random_state": 0}) == (None, None)
+
+    def test_different_embeddings_miss(self, tmp_path):
+        """埋め込みが変わった場合やキャッシュがない場合は何も再利用しない"""
+        path = str(tmp_path / "umap_projection_cache.npz")
+        assert load_projection_cache(path, "abc", PARAMS) == (None, None)
+
+        save_projection_cache(path, "abc", PARAMS, np.zeros((3, 2)))
+        assert load_projection_cache(path, "xyz", PARAMS) == (None, None)
+        coordinates, knn = load_projection_cache(path, "abc", PARAMS)
+        assert coordinates is not None
+        assert knn is None